@@ -1,103 +1,568 @@
-from collections import deque
-from twisted.internet import defer
+import datetime
+import itertools
+import threading
+import time
+
+from collections import OrderedDict
+from grokcore.component import Adapter, context
+from twisted.internet import defer, reactor, threads
 from twisted.python import log
+from twisted.python.threadable import isInIOThread
+from ZODB.POSException import POSKeyError
+from ZODB.utils import oid_repr
 from zope.component import provideSubscriptionAdapter
 from zope.interface import implements
 from zope.keyreference.interfaces import NotYet
 
-from opennode.oms.endpoint.ssh.detached import DetachedProtocol
-from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
-from opennode.oms.model.model.search import ReindexAction
+from opennode.oms.config import get_config
+from opennode.oms.model.model.proc import IProcess, IProcessStateRenderer, Proc, DaemonProcess
+from opennode.oms.model.model.search import ReindexCursor, is_indexable
 from opennode.oms.util import subscription_factory, async_sleep
 from opennode.oms.zodb import db
 from opennode.oms.model.model.events import IModelDeletedEvent
 from opennode.oms.model.traversal import canonical_path, traverse_path
 
 
+def is_reachable(obj):
+    """Whether `obj` is still attached to the model tree."""
+    try:
+        objs, unresolved_path = traverse_path(db.get_root()['oms_root'], canonical_path(obj))
+    except Exception:
+        log.msg("cannot resolve the path of %s" % obj, system="indexer")
+        return False
+    return not unresolved_path and getattr(objs[-1], '_p_oid', None) == obj._p_oid
+
+
+@db.ro_transact(proxy=False, lane=db.LANE_BACKGROUND)
+def extract_documents(keys, by_path=False):
+    """Extracts the search documents of the objects identified by `keys`, oids or canonical paths
+    if `by_path` is set, in a read only transaction.
+
+    Returns a dict mapping each key of an indexable, reachable object to its oid, serial and
+    document, to be applied with `SearchContainer.apply_document` by the writer.
+
+    """
+    root = db.get_root()['oms_root']
+    search = root['search']
+    connection = db.get_connection()
+
+    documents = {}
+    for key in keys:
+        if by_path:
+            objs, unresolved_path = traverse_path(root, key)
+            if unresolved_path:
+                continue
+            obj = objs[-1]
+        else:
+            try:
+                obj = connection.get(key)
+            except POSKeyError:
+                continue
+            if not is_reachable(obj):
+                continue
+
+        if is_indexable(obj):
+            documents[key] = (obj._p_oid, obj._p_serial, search.extract_document(obj))
+    return documents
+
+
+@defer.inlineCallbacks
+def extract_in_parallel(keys, by_path=False):
+    """Splits the extraction of the documents among `[indexer] extract_workers` concurrent
+    read only transactions and merges their results.
+
+    """
+    workers = max(1, get_config().getint('indexer', 'extract_workers', 3))
+    chunks = [keys[i::workers] for i in xrange(workers)]
+    results = yield defer.gatherResults([extract_documents(chunk, by_path) for chunk in chunks if chunk])
+
+    documents = {}
+    for result in results:
+        documents.update(result)
+    defer.returnValue(documents)
+
+
 class BlackHoleQueue(object):
+    overflowed = False
+
     def append(self, val):
         pass
 
+    def __len__(self):
+        return 0
+
+
+class CoalescingQueue(object):
+    """Queue of the pending (un)index operations which keeps at most one operation per object.
+
+    Operations are keyed by the canonical path of the object, so that an object modified many
+    times between two indexer batches is indexed only once. A deletion overrides the pending
+    modifications of the same path; deletions are never coalesced with each other, since
+    unindexing needs the deleted object itself.
+
+    The queue is bounded: once `max_size` operations are pending, further operations are dropped
+    and the queue is marked as `overflowed`, so that the indexer catches up from its watermark.
+
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.overflowed = False
+
+        self.enqueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            self._max_size = get_config().getint('indexer', 'queue_size', 10000)
+        return self._max_size
+
+    def append(self, (model, event)):
+        deleted = IModelDeletedEvent.providedBy(event)
+        try:
+            path = canonical_path(model)
+        except AssertionError:
+            # not attached to the tree yet, the path will be resolved by the indexer
+            path = None
+
+        with self.lock:
+            self.enqueued += 1
+
+            index_key = ('index', path or id(model))
+            if index_key in self.pending:
+                self.coalesced += 1
+                del self.pending[index_key]
+
+            if len(self.pending) >= self.max_size:
+                self.dropped += 1
+                self.overflowed = True
+                return
+
+            key = ('unindex', path, model._p_oid) if deleted else index_key
+            self.pending[key] = (path, model, event)
+            self.max_depth = max(self.max_depth, len(self.pending))
+
+    def drain(self):
+        """Removes and returns all the pending operations, in the order they were queued."""
+        with self.lock:
+            pending, self.pending = self.pending, OrderedDict()
+            return pending.values()
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.overflowed = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def stats(self):
+        with self.lock:
+            return {'depth': len(self.pending),
+                    'max_size': self.max_size,
+                    'max_depth': self.max_depth,
+                    'enqueued': self.enqueued,
+                    'coalesced': self.coalesced,
+                    'dropped': self.dropped,
+                    'overflowed': self.overflowed}
+
 
 class IndexerDaemonProcess(DaemonProcess):
     implements(IProcess)
 
     __name__ = "indexer"
 
-    queue = deque()
+    queue = CoalescingQueue()
 
     black_hole = BlackHoleQueue()
 
+    caught_up = False
+
+    batches = 0
+
+    last_batch = None
+
     @defer.inlineCallbacks
     def run(self):
+        interval = get_config().getfloat('indexer', 'batch_interval', 1.0)
+
         while True:
             try:
                 if not self.paused:
-                    if IndexerDaemonProcess.queue == self.black_hole:
-                        IndexerDaemonProcess.queue = deque()
+                    if IndexerDaemonProcess.queue is self.black_hole:
+                        IndexerDaemonProcess.queue = CoalescingQueue()
+                        self.caught_up = False
 
-                        self.reindex()
-                        yield self.process()
-                    else:
-                        IndexerDaemonProcess.queue = self.black_hole
+                    if IndexerDaemonProcess.queue.overflowed:
+                        log.msg("indexer queue overflowed, catching up from the watermark", system="indexer")
+                        IndexerDaemonProcess.queue.clear()
+                        self.caught_up = False
+
+                    if not self.caught_up:
+                        yield self.catch_up()
+                        self.caught_up = True
+
+                    yield self.process()
+                else:
+                    # events are dropped while paused, the index catches up on them when continued
+                    IndexerDaemonProcess.queue = self.black_hole
 
             except Exception:
                 log.err(system='indexer')
 
-            yield async_sleep(1)
+            yield async_sleep(interval)
 
     @classmethod
     def enqueue(cls, model, event):
         cls.queue.append((model, event))
 
+    @classmethod
+    def stats(cls):
+        stats = cls.queue.stats() if isinstance(cls.queue, CoalescingQueue) else {'depth': 0}
+        stats['batches'] = cls.batches
+        stats['last_batch'] = cls.last_batch
+        return stats
+
     @defer.inlineCallbacks
     def process(self):
         if self.queue:
-            yield self._process()
+            # read before the batch transaction starts and before draining the queue: the changes
+            # committed up to this transaction are either visible to the batch or already indexed
+            last_tid = db.last_transaction()
+            started = time.time()
+            batch = self.queue.drain()
 
-    @db.transact
-    def _process(self):
+            # large batches are tokenized beforehand by concurrent read only transactions,
+            # which keeps the write transaction short
+            documents = {}
+            paths = [path for path, model, event in batch
+                     if path and not IModelDeletedEvent.providedBy(event)]
+            if len(paths) >= get_config().getint('indexer', 'bulk_threshold', 100):
+                documents = yield extract_in_parallel(paths, by_path=True)
+
+            yield self._process(last_tid, batch, documents)
+            IndexerDaemonProcess.batches += 1
+            IndexerDaemonProcess.last_batch = {'size': len(batch), 'duration': time.time() - started}
+
+    @db.transact(lane=db.LANE_BACKGROUND)
+    def _process(self, last_tid, batch, documents):
         log.msg("indexing a batch of objects", system="indexer")
 
         searcher = db.get_root()['oms_root']['search']
 
-        def currently_queued():
-            while self.queue:
-                yield self.queue.popleft()
+        complete = True
+        for path, model, event in batch:
+            complete = self.index(searcher, path, model, event, documents.get(path)) and complete
 
-        for model, event in currently_queued():
-            self.index(searcher, model, event)
+        # if something couldn't be indexed leave the watermark behind,
+        # so that the catch up on the next start will retry it
+        if complete and searcher.watermark is not None and searcher.watermark < last_tid:
+            searcher.watermark = last_tid
 
         log.msg("done", system="indexer")
 
-    def index(self, searcher, model, event):
-        if not self.try_index(searcher, model, event):
+    def index(self, searcher, path, model, event, document=None):
+        if not self.try_index(searcher, path, model, event, document):
             log.msg("cannot (un)index %s %s" % (model, type(event).__name__), system="indexer")
+            return False
+        return True
 
-    def try_index(self, searcher, model, event):
-        path = canonical_path(model)
+    def try_index(self, searcher, path, model, event, document=None):
+        path = path or canonical_path(model)
         op = 'un' if IModelDeletedEvent.providedBy(event) else ''
 
         log.msg("%sindexing %s %s" % (op, path, type(event).__name__), system="indexer")
 
-        objs, unresolved_path = traverse_path(db.get_root()['oms_root'], path)
-        if unresolved_path and not IModelDeletedEvent.providedBy(event):
-            return False
+        if IModelDeletedEvent.providedBy(event):
+            # the path doesn't resolve anymore (or resolves to another object)
+            searcher.unindex_deleted(model)
+        else:
+            objs, unresolved_path = traverse_path(db.get_root()['oms_root'], path)
+            if unresolved_path:
+                return False
+
+            obj = objs[-1]
+            try:
+                if document is not None and document[0] == obj._p_oid:
+                    searcher.apply_document(obj, *document[1:])
+                else:
+                    searcher._index_object(obj)
+            except NotYet:
+                return False
+
+        log.msg("%sindexed %s %s" % (op, path, type(event).__name__), system="indexer")
+        return True
+
+    @defer.inlineCallbacks
+    def catch_up(self):
+        last_tid = db.last_transaction()
+        needs_reindex = yield self._catch_up(last_tid)
+        if needs_reindex:
+            ReindexProcess.start()
+
+    @db.transact(lane=db.LANE_BACKGROUND)
+    def _catch_up(self, last_tid):
+        """Brings the index up to date with the transactions committed since its watermark, which
+        are found with the storage transaction iterator.
+
+        Returns True if the whole index has to be rebuilt instead, because it has no watermark,
+        a previous reindex hasn't completed, new field indexes have been configured or the
+        storage cannot be iterated.
+
+        """
+        searcher = db.get_root()['oms_root']['search']
+
+        if searcher.watermark is None or searcher.reindex_cursor is not None:
+            return True
 
-        obj = objs[-1]
+        if searcher.missing_field_indexes():
+            log.msg("new field indexes %s, reindexing" % searcher.missing_field_indexes(), system="indexer")
+            return True
 
         try:
-            if IModelDeletedEvent.providedBy(event):
+            oids = db.changed_oids(searcher.watermark, last_tid)
+        except NotImplementedError as e:
+            log.msg("cannot catch up incrementally: %s" % e, system="indexer")
+            return True
+
+        log.msg("catching up on %s changed objects" % len(oids), system="indexer")
+
+        indexed = unindexed = 0
+        connection = db.get_connection()
+        for oid in oids:
+            try:
+                obj = connection.get(oid)
+            except POSKeyError:
+                continue
+
+            if not is_indexable(obj) or searcher.is_up_to_date(obj):
+                continue
+
+            if is_reachable(obj):
+                searcher.index_object(obj)
+                indexed += 1
+            elif searcher.ids.queryId(obj) is not None:
                 searcher.unindex_object(obj)
-            else:
-                searcher._index_object(obj)
-        except NotYet:
-            return False
+                unindexed += 1
 
-        log.msg("%sindexed %s %s" % (op, path, type(event).__name__), system="indexer")
-        return True
+        searcher.watermark = last_tid
+        log.msg("caught up: %s objects indexed, %s unindexed" % (indexed, unindexed), system="indexer")
+
+provideSubscriptionAdapter(subscription_factory(IndexerDaemonProcess), adapts=(Proc,))
+
+
+class ReindexProcess(DaemonProcess):
+    """Rebuilds the whole search index in the background, in batches of `[indexer]
+    reindex_batch_size` objects per transaction.
+
+    The objects are collected a batch at a time and those still to be indexed are persisted in
+    the `ReindexCursor` of the search container, so an interrupted reindex is resumed by the
+    indexer on the next start. The task can be
+    paused and continued with the STOP and CONT signals and aborted with TERM.
+
+    """
+    implements(IProcess)
+
+    __name__ = "reindex"
+
+    current = None
+
+    def __init__(self, restart=False):
+        self.pid = None
+        self.paused = False
+        self.terminated = False
+        self.restart = restart
+        self.batch_size = get_config().getint('indexer', 'reindex_batch_size', 500)
+        self.retries = get_config().getint('indexer', 'reindex_retries', 3)
+        self.retry_delay = get_config().getint('indexer', 'reindex_retry_delay', 30)
+
+        self.total = None
+        self.done = 0
+        self.done_here = 0
+        self.active_time = 0.0
+
+    @classmethod
+    def start(cls, restart=False):
+        """Spawns the reindex task unless it's already running, returns its task id.
+
+        With `restart` the index is cleared and rebuilt from scratch, otherwise
+        an interrupted reindex is resumed.
+
+        """
+        if not isInIOThread():
+            return threads.blockingCallFromThread(reactor, cls.start, restart)
+
+        if cls.current is not None:
+            return cls.current.pid
+
+        process = cls.current = cls(restart)
+        process.pid = Proc().spawn(process)
+        return process.pid
+
+    def signal_handler(self, name):
+        super(ReindexProcess, self).signal_handler(name)
+        if name == 'TERM':
+            log.msg("Terminating %s, it will resume on the next start" % self.__name__, system='proc')
+            self.terminated = True
+
+    @defer.inlineCallbacks
+    def run(self):
+        retries = self.retries
+        try:
+            while True:
+                try:
+                    yield self.reindex()
+                    break
+                except Exception:
+                    log.err(system='indexer')
+                    if retries <= 0 or self.terminated:
+                        yield self.abandon()
+                        break
+                    retries -= 1
+                    log.msg("resuming reindex in %s seconds" % self.retry_delay, system="indexer")
+                    yield async_sleep(self.retry_delay)
+        except Exception:
+            log.err(system='indexer')
+        finally:
+            ReindexProcess.current = None
 
+    @defer.inlineCallbacks
     def reindex(self):
-        ReindexAction(None).execute(DetachedProtocol(), object())
+        last_tid = db.last_transaction()
+        self.done, self.total = yield self.prepare(last_tid)
+        # a retry resumes the reindex instead of starting over
+        self.restart = False
 
-provideSubscriptionAdapter(subscription_factory(IndexerDaemonProcess), adapts=(Proc,))
+        while not self.terminated:
+            if self.paused:
+                yield async_sleep(1)
+                continue
+
+            started = time.time()
+            progress = yield self.index_batch()
+            self.active_time += time.time() - started
+
+            if progress is None:
+                log.msg("reindex aborted, the index has been cleared", system="indexer")
+                break
+
+            done, total, finished = progress
+            self.done_here += done - self.done
+            self.done, self.total = done, total
+            if finished:
+                log.msg("reindexed %s objects" % self.total, system="indexer")
+                break
+
+    @db.transact(lane=db.LANE_BACKGROUND)
+    def abandon(self):
+        """Gives up a reindex which keeps failing, so that the indexes are used again instead of
+        being bypassed until the next start; the objects not indexed yet are missing from them
+        until the reindex action is run."""
+        search = db.get_root()['oms_root']['search']
+        cursor = search.reindex_cursor
+        if cursor is None:
+            return
+
+        log.msg("giving up reindex, %s objects are not indexed; run the reindex action on /search "
+                "to rebuild the index" % len(cursor.pending), system="indexer")
+        search.watermark = cursor.tid
+        search.reindex_cursor = None
+
+    @db.transact(lane=db.LANE_BACKGROUND)
+    def prepare(self, last_tid):
+        search = db.get_root()['oms_root']['search']
+        cursor = search.reindex_cursor
+
+        if cursor is None or self.restart:
+            search.clear()
+            cursor = search.reindex_cursor = ReindexCursor(last_tid, db.get_root()['oms_root'])
+            log.msg("reindexing", system="indexer")
+        else:
+            log.msg("resuming reindex at %s/%s objects" % (cursor.done, cursor.total), system="indexer")
+
+        return cursor.done, cursor.total
+
+    @defer.inlineCallbacks
+    def index_batch(self):
+        """Indexes the next batch of objects: the documents are extracted by concurrent read only
+        transactions and then applied to the catalog in a single write transaction.
+
+        """
+        oids = yield self.collect_batch()
+        if oids is None:
+            defer.returnValue(None)
+
+        documents = yield extract_in_parallel(oids)
+        progress = yield self.apply_batch(oids, documents)
+        defer.returnValue(progress)
+
+    @db.transact(lane=db.LANE_BACKGROUND)
+    def collect_batch(self):
+        """Collects the objects of the next batch, walking only as many containers as needed."""
+        cursor = db.get_root()['oms_root']['search'].reindex_cursor
+        if cursor is None:
+            return None
+        cursor.collect(db.get_connection(), self.batch_size)
+        return list(itertools.islice(cursor.pending, self.batch_size))
+
+    @db.transact(lane=db.LANE_BACKGROUND)
+    def apply_batch(self, oids, documents):
+        search = db.get_root()['oms_root']['search']
+        cursor = search.reindex_cursor
+        if cursor is None:
+            return None
+
+        connection = db.get_connection()
+        for oid in oids:
+            # the reindex may have been restarted meanwhile
+            if oid not in cursor.pending:
+                continue
+
+            cursor.pending.remove(oid)
+            cursor.done += 1
+            if oid not in documents:
+                continue
+
+            try:
+                search.apply_document(connection.get(oid), *documents[oid][1:])
+            except POSKeyError:
+                # deleted after the batch was extracted
+                continue
+            except Exception:
+                log.err(system='indexer')
+                log.msg("cannot index object %s, skipping it" % oid_repr(oid), system="indexer")
+        finished = cursor.finished
+        if finished:
+            search.watermark = cursor.tid
+            search.reindex_cursor = None
+
+        return cursor.done, cursor.total, finished
+
+    @property
+    def rate(self):
+        return self.done_here / self.active_time if self.active_time else 0.0
+
+    @property
+    def eta(self):
+        if not self.rate or self.total is None:
+            return None
+        return datetime.timedelta(0, int((self.total - self.done) / self.rate))
+
+
+class ReindexStateRenderer(Adapter):
+    implements(IProcessStateRenderer)
+    context(ReindexProcess)
+
+    def __str__(self):
+        process = self.context
+        if process.total is None:
+            return "[reindex: collecting objects]"
+
+        return "[reindex: %s/%s objects, %.1f objects/s, ETA %s%s]" % (
+            process.done, process.total, process.rate, process.eta or '-',
+            ', paused' if process.paused else '')
@@ -6,7 +6,7 @@ import time
 from base64 import urlsafe_b64encode as encodestring, urlsafe_b64decode as decodestring
 from grokcore.component import GlobalUtility, context, name
 from grokcore.security import require
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.cred.credentials import UsernamePassword
 from twisted.cred.error import UnauthorizedLogin
 from twisted.web.guard import BasicCredentialFactory
@@ -16,9 +16,10 @@ from zope.interface import Interface, implements
 from opennode.oms.config import get_config
 from opennode.oms.model.model.root import OmsRoot
 from opennode.oms.endpoint.httprest.base import HttpRestView
-from opennode.oms.endpoint.httprest.root import BadRequest, Unauthorized, Forbidden
-from opennode.oms.security.authentication import checkers, KeystoneChecker
-from opennode.oms.util import blocking_yield
+from opennode.oms.endpoint.httprest.root import BadRequest, Unauthorized, Forbidden, static_response
+from opennode.oms.security.authentication import (credential_cache, verify_credentials, CredentialCache,
+                                                  ExpiringCache, KeystoneChecker)
+from opennode.oms.security.sessions import session_registry
 
 
 log = logging.getLogger(__name__)
@@ -29,10 +30,13 @@ class IHttpRestAuthenticationUtility(Interface):
     def get_basic_auth_credentials(request):
         """Returns basic auth credentials object for a given request, or None"""
 
-    def authenticate(request, credentials, basic_auth=False):
+    def authenticate(request, credentials, basic_auth=False, login=True):
         """Performs authentication, adds response headers in case of success,
         throws HttpStatus exceptions in case of failure. Returns a deferred.
 
+        Unless `login` is set, the credentials are the ones sent with every request by basic auth
+        clients and the token of their previous request is reused.
+
         """
 
     # XXX: use a principal instead of the credentials
@@ -42,6 +46,12 @@ class IHttpRestAuthenticationUtility(Interface):
     def get_principal(self, token):
         """Retrieves a principal for a token"""
 
+    def renew_token(request, token):
+        """Emits a new token for the same session, if `token` is getting old"""
+
+    def revoke_token(token):
+        """Revokes the session of the token, its tokens won't be accepted anymore"""
+
 
 class HttpRestAuthenticationUtility(GlobalUtility):
     implements(IHttpRestAuthenticationUtility)
@@ -50,6 +60,12 @@ class HttpRestAuthenticationUtility(GlobalUtility):
 
     token_key = get_config().get('auth', 'token_key')
 
+    def __init__(self):
+        size = get_config().getint('auth', 'token_cache_size', 10000)
+        ttl = get_config().getint('auth', 'token_ttl')
+        self.verified_tokens = ExpiringCache(size, ttl)
+        self.basic_auth_tokens = CredentialCache(size, ttl)
+
     def get_token(self, request):
         cookie = request.getCookie('oms_auth_token')
         if cookie:
@@ -90,21 +106,20 @@ class HttpRestAuthenticationUtility(GlobalUtility):
         return keystone_token
 
     @defer.inlineCallbacks
-    def authenticate(self, request, credentials, basic_auth=False):
+    def authenticate(self, request, credentials, basic_auth=False, login=True):
         avatar = None
         if credentials:
-            for i in checkers():
-                try:
-                    log.debug('Authenticating using %s on %s' % (i, credentials.username))
-                    avatar = yield i.requestAvatarId(credentials)
-                    log.debug('Authentication successful using %s on %s!' % (i, credentials.username))
-                    break
-                except UnauthorizedLogin:
-                    log.warning('Authentication failed with %s on %s!' % (i, credentials.username))
+            avatar = credential_cache().get(credentials)
+
+        if credentials and not avatar:
+            # PAM and the passwd file block, don't check them in the reactor thread
+            avatar = yield threads.deferToThread(verify_credentials, credentials)
+            if avatar:
+                credential_cache().add(credentials, avatar)
 
         if avatar:
             # XXX: Can replace with renew_token or vice versa
-            token = self.generate_token(credentials)
+            token = self.generate_token(credentials) if login else self.basic_auth_token(credentials)
             self.emit_token(request, token)
             defer.returnValue({'status': 'success', 'token': token})
         else:
@@ -136,30 +151,93 @@ class HttpRestAuthenticationUtility(GlobalUtility):
     def generate_token(self, credentials):
         return self._generate_token(credentials.username)
 
-    def _generate_token(self, username):
-        # TODO: register sessions
-        head = '%s:%s' % (username, int(time.time() * 1000))
+    def basic_auth_token(self, credentials):
+        """Returns the token emitted for the previous request with the same credentials, until it
+        would be renewed or its session is revoked, rather than starting a session per request.
+
+        The session of a new token isn't registered here but when the token is first verified.
+
+        """
+        token = self.basic_auth_tokens.get(credentials)
+        if token is not None:
+            try:
+                self.parse_token(token)
+                return token
+            except Forbidden:
+                pass
+
+        token = self._generate_token(credentials.username, register=False)
+        ttl = get_config().getint('auth', 'token_ttl')
+        renew_fraction = get_config().getfloat('auth', 'token_renew_fraction', 0.5)
+        self.basic_auth_tokens.add(credentials, token, time.time() + ttl * renew_fraction)
+        return token
+
+    def _generate_token(self, username, session_id=None, register=True):
+        registry = session_registry()
+        if session_id is None:
+            session_id = registry.new_session_id()
+
+        issued = time.time()
+        if register:
+            registry.register(session_id, username, issued + get_config().getint('auth', 'token_ttl'))
+
+        head = '%s:%s:%s' % (username, int(issued * 1000), session_id)
         signature = hmac.new(self.token_key, head).digest()
         return encodestring('%s;%s' % (head, signature)).strip()
 
-    def get_principal(self, token):
-        if not token:
-            return 'oms.anonymous'
+    def parse_token(self, token):
+        """Returns the principal, the issue time and the session id of a valid token.
 
-        head, signature = decodestring(token).split(';', 1)
-        if signature != hmac.new(self.token_key, head).digest():
-            raise Forbidden("Invalid authentication token")
+        Verified tokens are remembered until they expire, so that checking them again is a
+        lookup, but the revocation of their session is always checked.
 
-        user, timestamp = head.split(':')
-        if int(timestamp) / 1000.0 + get_config().getint('auth', 'token_ttl') < time.time():
-            raise Forbidden("Expired authentication token (%s s ago)" %
-                            (time.time() - int(timestamp) / 1000.0))
+        """
+        ttl = get_config().getint('auth', 'token_ttl')
+        parsed = self.verified_tokens.get(token)
+        if parsed is None:
+            head, signature = decodestring(token).split(';', 1)
+            if signature != hmac.new(self.token_key, head).digest():
+                raise Forbidden("Invalid authentication token")
+
+            fields = head.split(':')
+            user, timestamp = fields[:2]
+            # tokens emitted before sessions were registered don't have a session id
+            session_id = fields[2] if len(fields) > 2 else None
+            issued = int(timestamp) / 1000.0
+            if issued + ttl < time.time():
+                raise Forbidden("Expired authentication token (%s s ago)" % (time.time() - issued))
+
+            if session_id is not None and not session_registry().register(session_id, user, issued + ttl):
+                raise Forbidden("Revoked authentication token")
+
+            parsed = (user, issued, session_id)
+            self.verified_tokens.add(token, parsed, issued + ttl)
+
+        user, issued, session_id = parsed
+        if session_id is not None and session_registry().is_revoked(session_id):
+            raise Forbidden("Revoked authentication token")
+        return parsed
 
-        return user
+    def get_principal(self, token):
+        if not token:
+            return 'oms.anonymous'
+        return self.parse_token(token)[0]
 
     def renew_token(self, request, token):
-        new_token = self._generate_token(self.get_principal(token))
-        self.emit_token(request, new_token)
+        """Emits a new token only when the current one is older than `token_renew_fraction` of
+        its lifetime, rather than signing a new token for every request."""
+        user, issued, session_id = self.parse_token(token)
+        ttl = get_config().getint('auth', 'token_ttl')
+        if time.time() - issued >= ttl * get_config().getfloat('auth', 'token_renew_fraction', 0.5):
+            self.emit_token(request, self._generate_token(user, session_id))
+
+    def revoke_token(self, token):
+        try:
+            user, issued, session_id = self.parse_token(token)
+        except Exception:
+            return
+        if session_id is not None:
+            session_registry().revoke(session_id)
 
 
 class AuthView(HttpRestView):
@@ -202,20 +280,36 @@ class AuthView(HttpRestView):
         if not credentials and request.interaction.checkPermission('rest', object):
             return {'status': 'success'}
 
-        # XXX: refactor HttpRestServer.handle_request so that it's not a db.transact
-        # so that we can use a defer.inlineCallback here
-        return blocking_yield(authentication_utility.authenticate(request, credentials, basic_auth))
+        # HttpRestServer.handle_request waits for the deferred without holding a thread
+        return authentication_utility.authenticate(request, credentials, basic_auth)
+
+
+@static_response('/logout')
+def logout(request):
+    authenticator = getUtility(IHttpRestAuthenticationUtility)
+    token = authenticator.get_token(request)
+    if token:
+        authenticator.revoke_token(token)
+    request.addCookie('oms_auth_token', '', expires='Wed, 01 Jan 2000 00:00:00 GMT')
+    return {'status': 'success'}
+
+
+@static_response('/basicauthlogout')
+def basic_auth_logout(request):
+    logout(request)
+    raise Unauthorized()
 
 
 class LogoutView(HttpRestView):
+    """Logout is answered by `logout` without reaching the view, which is kept so that the
+    path can be traversed."""
     context(OmsRoot)
     name('logout')
 
     realm = 'OMS'
 
     def render_GET(self, request):
-        request.addCookie('oms_auth_token', '', expires='Wed, 01 Jan 2000 00:00:00 GMT')
-        return {'status': 'success'}
+        return logout(request)
 
 
 class BasicAuthView(AuthView):
@@ -232,5 +326,4 @@ class BasicAuthLogoutView(LogoutView):
     require('oms.nothing')
 
     def render_GET(self, request):
-        super(BasicAuthLogoutView, self).render_GET(request)
-        raise Unauthorized()
+        return basic_auth_logout(request)
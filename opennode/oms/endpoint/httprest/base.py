@@ -13,29 +13,57 @@ class IHttpRestView(Interface):
     def rw_transaction(request):
         """Return true if we this request should be committed"""
 
+    def cache_validators(request):
+        """Return the ETag and the last modification time of the representation returned by GET,
+        or None if they cannot be determined without rendering it"""
+
 
 class IHttpRestSubViewFactory(Interface):
     def resolve(path, method):
         """Resolve a view for a given sub path"""
 
 
+def requested_fields(request):
+    """Returns the names of the attributes requested with the `fields` (or `attrs`) argument,
+    None if all were requested, and the set of the ones excluded with the `omit` argument.
+
+    Both are parsed once per request, since they are checked for every rendered object.
+
+    """
+    if not hasattr(request, '_requested_fields'):
+        def names(arg):
+            value = request.args.get(arg, [''])[0].decode('utf-8')
+            return set(name.strip() for name in value.split(',') if name.strip())
+
+        fields = names('fields') | names('attrs')
+        request._requested_fields = (fields or None, names('omit'))
+    return request._requested_fields
+
+
 class HttpRestView(Adapter):
     implements(IHttpRestView)
     baseclass()
     require('rest')
 
-    __builtin_attributes__ = ['id', 'children']
+    __builtin_attributes__ = ['id', 'children', 'totalChildren']
 
     def filter_attributes(self, request, data):
-        """Handle the filtering of attributes according to the 'attrs' parameter in the request"""
-        attrs = request.args.get('attrs', [''])[0]
-        if attrs:
-            filtered_data = {}
-            for a in attrs.decode('utf-8').split(',') + self.__builtin_attributes__:
-                if a in data:
-                    filtered_data[a] = data[a]
-            return filtered_data
-        return data
+        """Handle the filtering of attributes according to the 'fields' (or 'attrs') and 'omit'
+        parameters in the request"""
+        fields, omitted = requested_fields(request)
+        if fields is None and not omitted:
+            return data
+
+        filtered_data = {}
+        for a, value in data.items():
+            if a in self.__builtin_attributes__ or ((fields is None or a in fields) and a not in omitted):
+                filtered_data[a] = value
+        return filtered_data
+
+    def wants_attribute(self, request, name):
+        """Whether an attribute is requested, so that views can avoid computing the others."""
+        fields, omitted = requested_fields(request)
+        return (fields is None or name in fields) and name not in omitted
 
     def render_recursive(self, request, depth):
         for method in ('render_' + request.method, 'render'):
@@ -52,4 +80,7 @@ class HttpRestView(Adapter):
         return EmptyResponse
 
     def rw_transaction(self, request):
-        return request.method != 'GET'
+        return request.method not in ('GET', 'HEAD', 'OPTIONS')
+
+    def cache_validators(self, request):
+        return None
@@ -0,0 +1,190 @@
+import json
+
+from cStringIO import StringIO
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web.server import NOT_DONE_YET
+from zope.security.interfaces import Unauthorized
+
+from opennode.oms.config import get_config
+from opennode.oms.endpoint.httprest.root import BadRequest, EmptyResponse, HttpStatus, SAFE_METHODS
+from opennode.oms.zodb import db
+
+
+class BatchOperation(object):
+    """A single operation of a batch request.
+
+    It provides the part of the twisted request interface used by the views, sharing the
+    authentication of the batch request, and collects the response code and body.
+
+    """
+
+    etag = None
+
+    def __init__(self, batch_request, index, spec):
+        if not isinstance(spec, dict) or not isinstance(spec.get('path'), basestring):
+            raise BadRequest('Operation %s must be an object with a path' % index)
+
+        self.batch_request = batch_request
+        self.interaction = batch_request.interaction
+        self.index = index
+        method = spec.get('method', 'GET')
+        if not isinstance(method, basestring):
+            raise BadRequest('The method of operation %s must be a string' % index)
+        self.method = method.encode('utf-8').upper()
+        self.path = '/' + spec['path'].encode('utf-8').lstrip('/')
+        self.uri = self.path
+
+        args = spec.get('args', {})
+        if not isinstance(args, dict):
+            raise BadRequest('The args of operation %s must be an object' % index)
+        self.args = {}
+        for name, value in args.items():
+            values = value if isinstance(value, list) else [value]
+            self.args[name.encode('utf-8')] = [unicode(v).encode('utf-8') for v in values]
+
+        body = spec.get('body')
+        self.content = StringIO(json.dumps(body) if body is not None else '')
+
+        self.code = 200
+        self.headers = {}
+
+    @property
+    def read_only(self):
+        return self.method in SAFE_METHODS
+
+    def getHeader(self, name):
+        # conditional requests don't apply to the operations
+        if name.lower() in ('if-none-match', 'if-modified-since'):
+            return None
+        return self.batch_request.getHeader(name)
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+    def setETag(self, etag):
+        pass
+
+    def setLastModified(self, when):
+        pass
+
+    def getClientIP(self):
+        return self.batch_request.getClientIP()
+
+    def result(self, body):
+        if body is NOT_DONE_YET:
+            return self.failure(501, 'Streaming views cannot be used in batches')
+        return {'status': self.code, 'body': None if body is EmptyResponse else body}
+
+    def failure(self, status, message):
+        return {'status': status, 'error': message}
+
+    def error(self, e):
+        if isinstance(e, HttpStatus):
+            return {'status': e.status_code, 'error': e.body or e.message or e.status_description}
+        if isinstance(e, Unauthorized):
+            return self.failure(403, 'User does not have permission to access this resource')
+        log.err(e, system='httprest')
+        return self.failure(500, '%s: %s' % (type(e).__name__, e))
+
+
+class BatchRequest(object):
+    """Executes the operations of a POST to /batch, given as
+
+        {"operations": [{"method": "PUT", "path": "/machines/x", "args": {...}, "body": {...}},
+                        ...],
+         "atomic": false,
+         "transaction_size": 100}
+
+    and returns {"results": [{"status": 200, "body": ...}, {"status": 404, "error": ...}, ...]},
+    in the same order.
+
+    Consecutive safe operations are served by a single read only transaction, so they see the same
+    snapshot of the database. Consecutive writes are grouped into transactions of at most
+    `transaction_size` operations; a failing write is rolled back to a savepoint without
+    affecting the others ("best effort"). With `atomic` all the operations run in a single
+    transaction, which is committed only if all of them succeed; after the first failure the
+    remaining operations are not executed and reported with status 424.
+
+    """
+
+    def __init__(self, server, request, token):
+        self.server = server
+        self.request = request
+        self.token = token
+
+        try:
+            spec = json.load(request.content)
+        except ValueError:
+            raise BadRequest('The batch is not valid JSON')
+        if not isinstance(spec, dict) or not isinstance(spec.get('operations'), list):
+            raise BadRequest('The batch must contain a list of operations')
+
+        max_operations = get_config().getint('rest', 'batch_max_operations', 1000)
+        if len(spec['operations']) > max_operations:
+            raise BadRequest('A batch can contain at most %s operations' % max_operations)
+
+        self.operations = [BatchOperation(request, i, op) for i, op in enumerate(spec['operations'])]
+        self.atomic = bool(spec.get('atomic', False))
+        default_size = get_config().getint('rest', 'batch_transaction_size', 100)
+        try:
+            self.transaction_size = max(1, int(spec.get('transaction_size') or default_size))
+        except (TypeError, ValueError):
+            raise BadRequest('transaction_size must be an integer')
+
+    def groups(self):
+        """Splits the operations in runs of reads and in runs of at most `transaction_size`
+        writes, each of which is executed by a transaction."""
+        groups = []
+        for op in self.operations:
+            last = groups[-1] if groups else None
+            if (last and last[0].read_only == op.read_only and
+                    (op.read_only or len(last) < self.transaction_size)):
+                last.append(op)
+            else:
+                groups.append([op])
+        return groups
+
+    @defer.inlineCallbacks
+    def execute(self):
+        if self.atomic:
+            results = yield self.run(self.operations, read_only=False)
+        else:
+            results = []
+            for group in self.groups():
+                group_results = yield self.run(group, read_only=group[0].read_only)
+                results.extend(group_results)
+        defer.returnValue({'results': results})
+
+    def run(self, operations, read_only):
+        if read_only:
+            return self.run_ro(operations, read_only)
+        return self.run_rw(operations, read_only)
+
+    def run_operations(self, operations, read_only):
+        results = []
+        failed = False
+        for op in operations:
+            if failed:
+                results.append(op.failure(424, 'Not executed because a previous operation failed'))
+                continue
+
+            savepoint = db.savepoint() if not (read_only or self.atomic) else None
+            try:
+                renderer, needs_rw_transaction = self.server.resolve(op, self.token)
+                body = yield defer.maybeDeferred(renderer, op)
+                results.append(op.result(body))
+            except Exception as e:
+                if savepoint is not None:
+                    savepoint.rollback()
+                results.append(op.error(e))
+                failed = self.atomic
+
+        defer.returnValue(db.RollbackValue(results) if failed else results)
+
+    # decorated once, rather than on every call
+    run_ro = db.async_ro_transact(run_operations)
+    run_rw = db.async_transact(run_operations)
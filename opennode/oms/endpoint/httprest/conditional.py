@@ -0,0 +1,77 @@
+"""Cache validators for conditional GET and HEAD requests.
+
+The representation of a model object is determined by the state of the persistent objects it is
+rendered from, by the principal and its permissions, and by the request arguments, so the ETag is
+a digest of the serials of those objects (including the parents they inherit permissions from),
+the principal ids, the generation of the global roles and groups and the arguments. The
+Last-Modified time is the most recent of the times of the serials and of the last reload of the
+roles and groups.
+
+"""
+import math
+
+from hashlib import sha1
+
+from persistent.TimeStamp import TimeStamp
+from twisted.web.http import CACHED
+from zope.security.proxy import removeSecurityProxy
+
+from opennode.oms.security.interaction import permission_versions, permissions_generation
+
+
+def object_versions(obj):
+    """Returns the oids and serials of `obj`, of its persistent annotations (where roles and
+    permissions are stored) and of the parents it inherits permissions from, see
+    `permission_versions`, or None if any of them has been changed in the current transaction.
+    Non persistent objects are identified by their class and name.
+
+    """
+    obj = removeSecurityProxy(obj)
+    if getattr(obj, '_p_oid', None) is None:
+        return [((type(obj).__name__, getattr(obj, '__name__', None)), None)]
+    return permission_versions(obj)
+
+
+def cache_validators(request, objs):
+    """Returns the ETag and the modification time of the representation of `objs`, or None if
+    they cannot be determined."""
+    digest = sha1()
+    generation, last_modified = permissions_generation()
+
+    digest.update('%s\0' % generation)
+    if request.interaction:
+        for participation in request.interaction.participations:
+            digest.update('%s\0' % participation.principal.id)
+    for name, values in sorted(request.args.items()):
+        digest.update('%r=%r\0' % (name, values))
+
+    for obj in objs:
+        versions = object_versions(obj)
+        if versions is None:
+            return None
+        for key, serial in versions:
+            digest.update('%r:%r\0' % (key, serial))
+            if serial is not None:
+                modified = TimeStamp(serial).timeTime()
+                last_modified = max(last_modified, modified)
+
+    return '"%s"' % digest.hexdigest(), last_modified
+
+
+def check_not_modified(request, etag, last_modified):
+    """Sets the validator headers of the response and returns true if the client already has the
+    current representation, in which case the response code is set to 304.
+
+    If-Modified-Since is only considered in absence of If-None-Match.
+
+    """
+    if request.setETag(etag) is CACHED:
+        return True
+
+    if last_modified is not None:
+        if request.getHeader('If-None-Match'):
+            # like setLastModified, without the conditional check
+            request.lastModified = int(math.ceil(last_modified))
+        elif request.setLastModified(last_modified) is CACHED:
+            return True
+    return False
@@ -1,25 +1,33 @@
 import functools
+import itertools
 import json
 import zope.security.interfaces
 
 from twisted.internet import defer
+from twisted.internet.interfaces import IPullProducer
 from twisted.python import log, failure
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
 from twisted.python.compat import intToBytes
 
 from zope.component import queryAdapter, getUtility
+from zope.interface import implements
+from zope.security.proxy import removeSecurityProxy
 
 from opennode.oms.config import get_config
 from opennode.oms.endpoint.httprest.base import IHttpRestView, IHttpRestSubViewFactory
+from opennode.oms.endpoint.httprest.conditional import check_not_modified
 from opennode.oms.model.traversal import traverse_path
 from opennode.oms.security.checker import proxy_factory
 from opennode.oms.security.interaction import new_interaction
-from opennode.oms.util import blocking_yield
 from opennode.oms.util import JsonSetEncoder
 from opennode.oms.zodb import db
 
 
+# methods which don't change the state of the server, rendered in read only transactions
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
 class EmptyResponse(Exception):
     pass
 
@@ -100,6 +108,28 @@ class MethodNotAllowed(HttpStatus):
         self.headers = {'Allow': ','.join(allow)}
 
 
+_static_responses = {}
+
+
+def static_response(path, methods=('GET', 'HEAD')):
+    """Registers a function answering requests for `path` directly in the reactor thread,
+    without authentication, traversal or database access:
+
+        >>> @static_response('/logout')
+        ... def logout(request):
+        ...     request.addCookie('oms_auth_token', '', expires='Wed, 01 Jan 2000 00:00:00 GMT')
+        ...     return {'status': 'success'}
+
+    The function returns the data to render, or raises HttpStatus, like a view.
+
+    """
+    def register(fun):
+        for method in methods:
+            _static_responses[(method, path.rstrip('/'))] = fun
+        return fun
+    return register
+
+
 def log_wrapper(self, f, server):
     @functools.wraps(f)
     def log_(request):
@@ -126,6 +156,58 @@ def log_wrapper(self, f, server):
     return log_
 
 
+def buffered(pieces, size):
+    """Joins the strings yielded by `pieces` in chunks of about `size` bytes."""
+    chunk, length = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+class ChunkProducer(object):
+    """Writes chunks to a request when the transport asks for more data, so that a large response
+    is encoded a chunk at a time and never held in memory as a whole.
+
+    `start` returns a deferred which fires with True when all the chunks have been written, or
+    with False if the connection has been lost meanwhile.
+
+    """
+    implements(IPullProducer)
+
+    def __init__(self, request, chunks):
+        self.request = request
+        self.chunks = chunks
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        self.request.notifyFinish().addErrback(lambda _: self.stopProducing())
+        self.request.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        if self.deferred.called:
+            return
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.request.unregisterProducer()
+            self.deferred.callback(True)
+        except Exception:
+            self.request.unregisterProducer()
+            self.deferred.errback()
+        else:
+            self.request.write(chunk)
+
+    def stopProducing(self):
+        if not self.deferred.called:
+            self.deferred.callback(False)
+
+
 class HttpRestServer(resource.Resource):
     """Restful HTTP API interface for OMS.
 
@@ -144,6 +226,8 @@ class HttpRestServer(resource.Resource):
 
         self.use_security_proxy = get_config().getboolean('auth', 'security_proxy_rest')
         self.use_keystone_tokens = get_config().getboolean('auth', 'use_keystone', False)
+        self.json_chunk_size = get_config().getint('rest', 'json_chunk_size', 64 * 1024)
+        self.cors_max_age = get_config().getint('rest', 'cors_max_age', 86400)
 
     def render(self, request):
         request.site.log = log_wrapper(request.site, request.site.log, self)
@@ -169,13 +253,20 @@ class HttpRestServer(resource.Resource):
 
         ret = None
         try:
-            ret = yield self.handle_request(request)
+            static = self.find_static_response(request)
+            if static is not None:
+                ret = static(request)
+            elif request.method == 'POST' and request.path.rstrip('/') == '/batch':
+                ret = yield self.handle_batch(request)
+            else:
+                ret = yield self.handle_request(request)
             # allow views to take full control of output streaming
             if ret is not NOT_DONE_YET and ret is not EmptyResponse:
                 request.setHeader('Content-Type', 'application/json')
-                json_data = json.dumps(ret, indent=2, cls=JsonSetEncoder)
-                request.setHeader('Content-Length', intToBytes(len(json_data)))
-                request.write(json_data)
+                completed = yield self.write_json(request, ret)
+                if not completed:
+                    # the client went away, there is nothing to finish
+                    ret = NOT_DONE_YET
         except HttpStatus as exc:
             request.setResponseCode(exc.status_code, exc.status_description)
             for name, value in exc.headers.items():
@@ -202,7 +293,47 @@ class HttpRestServer(resource.Resource):
             if ret is not NOT_DONE_YET:
                 request.finish()
 
+    def find_static_response(self, request):
+        """Returns the function answering `request` in the reactor thread, if its response
+        doesn't depend on the database: CORS preflights and the paths registered with
+        `static_response`."""
+        if request.method == 'OPTIONS' and request.getHeader('Access-Control-Request-Method'):
+            return self.render_preflight
+        return _static_responses.get((request.method, request.path.rstrip('/')))
+
+    def render_preflight(self, request):
+        """The CORS headers are the same for every resource, browsers can cache them."""
+        request.setHeader('Access-Control-Max-Age', str(self.cors_max_age))
+        return EmptyResponse
+
+    def write_json(self, request, data):
+        """Writes `data` encoded as JSON, compact unless the `pretty` argument is given.
+
+        Responses fitting in one chunk are written with a Content-Length, larger ones are encoded
+        and written a chunk at a time as the client reads them, with chunked transfer encoding.
+        Returns a deferred firing with False if the connection was lost before the end.
+
+        """
+        if request.args.get('pretty', ['false'])[0] in ('1', 'true'):
+            encoder = JsonSetEncoder(indent=2, separators=(',', ': '))
+        else:
+            encoder = JsonSetEncoder(separators=(',', ':'))
+
+        chunks = buffered(encoder.iterencode(data), self.json_chunk_size)
+        first = next(chunks, '')
+        second = next(chunks, None)
+
+        if second is None:
+            request.setHeader('Content-Length', intToBytes(len(first)))
+            request.write(first)
+            return defer.succeed(True)
+
+        request.write(first)
+        return ChunkProducer(request, itertools.chain([second], chunks)).start()
+
     def get_token(self, request):
+        """Returns the security token for the request, or a deferred if the credentials
+        have to be authenticated first."""
         from opennode.oms.endpoint.httprest.auth import IHttpRestAuthenticationUtility
 
         authenticator = getUtility(IHttpRestAuthenticationUtility)
@@ -213,13 +344,15 @@ class HttpRestServer(resource.Resource):
         keystone_token = authenticator.get_keystone_auth_credentials(request) \
                             if self.use_keystone_tokens else None
         if http_credentials:
-            blocking_yield(authenticator.authenticate(request, http_credentials,
-                                                      basic_auth=True))
-            return authenticator.generate_token(http_credentials)
+            # the token emitted by the authentication is used for the rest of the request
+            d = authenticator.authenticate(request, http_credentials, basic_auth=True, login=False)
+            d.addCallback(lambda result: result['token'])
+            return d
         elif keystone_token:
-            keystone_credential = blocking_yield(authenticator.authenticate_keystone(request,
-                                                                                     keystone_token))
-            return keystone_credential['token']  # we expect token to be generated by the authenticator
+            d = authenticator.authenticate_keystone(request, keystone_token)
+            # we expect token to be generated by the authenticator
+            d.addCallback(lambda keystone_credential: keystone_credential['token'])
+            return d
         else:
             return authenticator.get_token(request)  # FIXME: Should not emit token here
 
@@ -242,13 +375,55 @@ class HttpRestServer(resource.Resource):
 
         return subview
 
-    @db.transact
+    @defer.inlineCallbacks
     def handle_request(self, request):
         """Takes a request, maps it to a domain object and a corresponding IHttpRestView
         and returns the rendered output of that view.
+
+        Safe methods are rendered in a read only transaction, which is never committed nor
+        retried, the other methods in a read-write transaction.
+
+        Authentication and views returning deferreds don't hold a threadpool thread
+        while waiting.
         """
-        token = self.get_token(request)
+        token = yield self.get_token(request)
+        request.interaction = self.get_interaction(request, token)
+
+        if request.method in SAFE_METHODS:
+            res = yield self.render_read_only(request, token)
+        else:
+            res = yield self.render_read_write(request, token)
+        defer.returnValue(res)
+
+    @db.async_ro_transact
+    def render_read_only(self, request, token):
+        renderer, needs_rw_transaction = self.resolve(request, token)
+        res = yield renderer(request)
+        defer.returnValue(res)
+
+    @db.async_transact
+    def render_read_write(self, request, token):
+        renderer, needs_rw_transaction = self.resolve(request, token)
+        res = yield renderer(request)
+        defer.returnValue(res if needs_rw_transaction else db.RollbackValue(res))
 
+    @defer.inlineCallbacks
+    def handle_batch(self, request):
+        """Executes the operations posted to /batch with a single authentication and as few
+        transactions as possible, see `BatchRequest`."""
+        from opennode.oms.endpoint.httprest.batch import BatchRequest
+
+        token = yield self.get_token(request)
+        request.interaction = self.get_interaction(request, token)
+
+        res = yield BatchRequest(self, request, token).execute()
+        defer.returnValue(res)
+
+    def resolve(self, request, token):
+        """Maps a request to the view method rendering it. Returns the method and whether the
+        request needs to commit its changes.
+
+        """
         oms_root = db.get_root()['oms_root']
         objs, unresolved_path = traverse_path(oms_root, request.path[1:])
 
@@ -257,8 +432,7 @@ class HttpRestServer(resource.Resource):
 
         obj = objs[-1]
 
-        interaction = self.get_interaction(request, token)
-        request.interaction = interaction
+        interaction = request.interaction
 
         if self.use_security_proxy:
             obj = proxy_factory(obj, interaction)
@@ -289,16 +463,41 @@ class HttpRestServer(resource.Resource):
                     raise Forbidden('User does not have permission to access this resource')
                 raise Unauthorized()
 
-        for method in ('render_' + request.method,
-                       'render_' + request.method.lower(),
-                       'render'):
+        methods = ['render_' + request.method, 'render_' + request.method.lower(), 'render']
+        if request.method == 'HEAD':
+            # twisted discards the body of HEAD responses
+            methods.append('render_GET')
 
+        for method in methods:
             renderer = get_renderer(view, method)
             if renderer:
-                res = renderer(request)
-                return res if needs_rw_transaction else db.RollbackValue(res)
+                break
+        else:
+            raise NotImplementedError("Method %s is not implemented in %s\n" % (request.method, view))
+
+        # the validators are checked only once access to the renderer has been granted, so that
+        # they don't disclose anything about the objects the principal cannot render
+        if request.method in ('GET', 'HEAD'):
+            if self.not_modified(request, view):
+                return (lambda request: EmptyResponse), False
+            if request.method == 'HEAD' and getattr(request, 'etag', None) is not None:
+                # answered from the cache validators
+                request.setHeader('Content-Type', 'application/json')
+                return (lambda request: EmptyResponse), False
+
+        return renderer, needs_rw_transaction
+
+    def not_modified(self, request, view):
+        """Sets the ETag and Last-Modified headers of the response, if the view can compute them
+        without rendering, and returns true if the client's cached representation is current.
+
+        """
+        try:
+            validators = removeSecurityProxy(view).cache_validators(request)
+        except zope.security.interfaces.Unauthorized:
+            return False
 
-        raise NotImplementedError("Method %s is not implemented in %s\n" % (request.method, view))
+        return validators is not None and check_not_modified(request, *validators)
 
     def get_interaction(self, request, token):
         # TODO: we can quickly disable rest auth
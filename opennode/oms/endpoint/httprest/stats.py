@@ -0,0 +1,118 @@
+from grokcore.component import context, name, baseclass
+
+from opennode.oms.backend.indexer import IndexerDaemonProcess
+from opennode.oms.endpoint.httprest.base import HttpRestView
+from opennode.oms.endpoint.httprest.root import BadRequest, Forbidden
+from opennode.oms.model.model.proc import Proc
+from opennode.oms.security.audit import attribute_audit
+from opennode.oms.security.authentication import credential_cache, token_cache
+from opennode.oms.security.interaction import permission_cache
+from opennode.oms.security.principals import effective_principals
+from opennode.oms.security.sessions import session_registry
+from opennode.oms.zodb import db
+from opennode.oms.zodb.profiler import get_profiles
+from opennode.oms.zodb.retry import hotspots
+
+
+class AdminOnlyView(HttpRestView):
+    """Base class for the diagnostic views, which are accessible only to admins."""
+    baseclass()
+
+    def check_admins(self, request):
+        principals = [p.id for p in effective_principals(request.interaction)]
+        if 'admins' not in principals:
+            raise Forbidden('Only admins can access diagnostic data')
+
+    def rw_transaction(self, request):
+        return False
+
+
+class TransactionStatsView(AdminOnlyView):
+    """Threadpool lane counters and latency histograms of transactional functions.
+
+    Accepts `sort` (total, calls, wait, exec, commit, conflicts) and `limit` parameters.
+
+    """
+    context(Proc)
+    name('transactions')
+
+    def render_GET(self, request):
+        self.check_admins(request)
+
+        sort = request.args.get('sort', ['total'])[0]
+        try:
+            limit = int(request.args.get('limit', [0])[0])
+            profiles = get_profiles(sort=sort, limit=limit)
+        except (ValueError, KeyError):
+            raise BadRequest('Invalid sort or limit parameter')
+
+        return {'lanes': db.get_threadpool_stats(),
+                'functions': [dict(profile.summary(), source=profile.description)
+                              for profile in profiles]}
+
+
+class ConflictHotSpotsView(AdminOnlyView):
+    """Objects which caused most transaction conflicts, with the functions which hit them.
+
+    Accepts a `limit` parameter.
+
+    """
+    context(Proc)
+    name('conflicts')
+
+    def render_GET(self, request):
+        self.check_admins(request)
+
+        try:
+            limit = int(request.args.get('limit', [0])[0])
+        except ValueError:
+            raise BadRequest('Invalid limit parameter')
+
+        return hotspots.top(limit)
+
+
+class IndexerStatsView(AdminOnlyView):
+    """Depth and coalescing counters of the indexer queue and duration of the last batch."""
+    context(Proc)
+    name('indexer')
+
+    def render_GET(self, request):
+        self.check_admins(request)
+        return IndexerDaemonProcess.stats()
+
+
+class AuthStatsView(AdminOnlyView):
+    """Hit counters of the verified credential and keystone token caches, with the latency of
+    token validations, the number of active and revoked sessions and the hit rate of the
+    permission decision cache."""
+    context(Proc)
+    name('auth')
+
+    def render_GET(self, request):
+        self.check_admins(request)
+        return {'credentials': credential_cache().stats(),
+                'keystone_tokens': token_cache().stats(),
+                'sessions': session_registry().stats(),
+                'permissions': permission_cache().stats()}
+
+
+class AttributeAuditView(AdminOnlyView):
+    """Accesses to attributes without declared permissions, by attribute, type and effective
+    principals, with the stack sampled when each was first seen.
+
+    Accepts a `limit` parameter.
+
+    """
+    context(Proc)
+    name('audit')
+
+    def render_GET(self, request):
+        self.check_admins(request)
+
+        try:
+            limit = int(request.args.get('limit', [0])[0])
+        except ValueError:
+            raise BadRequest('Invalid limit parameter')
+
+        audit = attribute_audit()
+        return dict(audit.stats(), attributes=audit.report(limit))
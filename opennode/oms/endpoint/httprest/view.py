@@ -13,7 +13,8 @@ from zope.component import queryAdapter, handle
 from zope.security.interfaces import Unauthorized
 from zope.security.proxy import removeSecurityProxy
 
-from opennode.oms.endpoint.httprest.base import HttpRestView, IHttpRestView
+from opennode.oms.endpoint.httprest.base import HttpRestView, IHttpRestView, requested_fields
+from opennode.oms.endpoint.httprest.conditional import cache_validators
 from opennode.oms.endpoint.httprest.root import BadRequest, NotFound
 from opennode.oms.endpoint.ssh.cmd.security import effective_perms
 from opennode.oms.endpoint.ssh.detached import DetachedProtocol
@@ -24,13 +25,13 @@ from opennode.oms.model.model.base import IContainer
 from opennode.oms.model.model.bin import ICommand
 from opennode.oms.model.model.byname import ByNameContainer
 from opennode.oms.model.model.events import ModelDeletedEvent
-from opennode.oms.model.model.filtrable import IFiltrable
-from opennode.oms.model.model.search import SearchContainer, SearchResult
+from opennode.oms.model.model.filtrable import FieldValues, IFiltrable, compile_query
+from opennode.oms.model.model.search import SearchContainer, SearchResult, SearchResults
 from opennode.oms.model.model.stream import IStream, StreamSubscriber
 from opennode.oms.model.model.symlink import Symlink, follow_symlinks
 from opennode.oms.model.schema import model_to_dict
 from opennode.oms.model.traversal import traverse_path
-from opennode.oms.security.checker import get_interaction
+from opennode.oms.security.checker import get_interaction, proxy_factory
 from opennode.oms.zodb import db
 
 
@@ -41,17 +42,21 @@ class DefaultView(HttpRestView):
         if not request.interaction.checkPermission('view', self.context):
             raise NotFound
 
-        data = model_to_dict(self.context)
+        # unrequested fields are not computed at all
+        fields, omitted = requested_fields(request)
+        data = model_to_dict(self.context, fields=fields, exclude=omitted)
 
         data['id'] = self.context.__name__
         data['__type__'] = type(removeSecurityProxy(self.context)).__name__
-        try:
-            data['url'] = ILocation(self.context).get_url()
-        except Unauthorized:
-            data['url'] = ''
+        if self.wants_attribute(request, 'url'):
+            try:
+                data['url'] = ILocation(self.context).get_url()
+            except Unauthorized:
+                data['url'] = ''
 
-        interaction = get_interaction(self.context)
-        data['permissions'] = effective_perms(interaction, self.context) if interaction else []
+        if self.wants_attribute(request, 'permissions'):
+            interaction = get_interaction(self.context)
+            data['permissions'] = effective_perms(interaction, self.context) if interaction else []
 
         # XXX: simplejson can't serialize sets
         if 'tags' in data:
@@ -59,6 +64,21 @@ class DefaultView(HttpRestView):
 
         return data
 
+    def cache_validators(self, request):
+        # views rendering more than the state of the model objects cannot tell if it changed
+        if not self.renders_model_state() or not request.interaction.checkPermission('view', self.context):
+            return None
+        return cache_validators(request, self.rendered_objects(request))
+
+    def renders_model_state(self):
+        return (type(self).render_GET.im_func in (DefaultView.render_GET.im_func,
+                                                  ContainerView.render_GET.im_func) and
+                type(self).render_recursive.im_func in (HttpRestView.render_recursive.im_func,
+                                                        ContainerView.render_recursive.im_func))
+
+    def rendered_objects(self, request):
+        return [self.context]
+
     def render_PUT(self, request):
         data = json.load(request.content)
         if 'id' in data:
@@ -98,13 +118,42 @@ class ContainerView(DefaultView):
     context(IContainer)
 
     def render_GET(self, request):
-        depth = request.args.get('depth', ['0'])[0]
+        return self.render_recursive(request, self.depth(request), top_level=True)
+
+    def depth(self, request):
         try:
-            depth = int(depth)
+            return int(request.args.get('depth', ['0'])[0])
         except ValueError:
-            depth = 0
+            return 0
+
+    def rendered_objects(self, request):
+        objs = []
 
-        return self.render_recursive(request, depth, top_level=True)
+        def collect(obj, depth):
+            objs.append(obj)
+            if depth < 1 or not IContainer.providedBy(obj):
+                return
+            for child in obj.listcontent():
+                child = follow_symlinks(child)
+                if not self.blacklisted(child):
+                    collect(child, depth - 1)
+
+        depth = self.depth(request)
+        limit, offset = self.paging(request)
+        sort, reverse, after = self.sorting(request)
+        count = getattr(removeSecurityProxy(self.context), '_count', None)
+
+        paged = limit or offset or sort is not None or after is not None
+        if (depth < 1 or not paged or 'q' in request.args or sort not in (None, 'name')
+                or count is None):
+            collect(self.context, depth)
+            return objs
+
+        # the page and the number of children, which changes the counter's serial
+        objs.extend([self.context, count])
+        for child in self.visible_page(request, offset, limit, after, reverse):
+            collect(child, depth - 1)
+        return objs
 
     def render_recursive(self, request, depth, filter_=[], top_level=False):
         container_properties = super(ContainerView, self).render_GET(request)
@@ -112,6 +161,149 @@ class ContainerView(DefaultView):
         if depth < 1:
             return self.filter_attributes(request, container_properties)
 
+        qlist = []
+        limit = None
+        offset = 0
+        sort, reverse, after = None, False, None
+
+        if top_level:
+            try:
+                qlist = [compile_query(q.decode('utf-8')) for q in request.args.get('q', [])]
+            except ValueError as e:
+                raise BadRequest(str(e))
+            qlist = filter(None, qlist)
+            limit, offset = self.paging(request)
+            sort, reverse, after = self.sorting(request)
+
+        paged = limit or offset or sort is not None or after is not None
+        if paged and not qlist and sort in (None, 'name'):
+            # only the requested page of children is loaded and rendered; totalChildren is then
+            # the number of children of the container, including the ones hidden from the user
+            items = self.visible_page(request, offset, limit, after, reverse)
+            children = self.render_children(request, items, depth)
+            return self.container_result(request, container_properties, children,
+                                         self.context.content_count(), depth, top_level)
+
+        items = self.filtered_children(request, qlist)
+
+        if not paged:
+            children = self.render_children(request, items, depth)
+            return self.container_result(request, container_properties, children, len(children),
+                                         depth, top_level)
+
+        items = [item for item in items
+                 if queryAdapter(item, IHttpRestView) and not self.blacklisted(item)]
+        items = self.sort_children(items, sort or 'name', reverse, after)
+        total_children = len(items)
+        items = items[offset:offset + limit if limit else None]
+
+        children = self.render_children(request, items, depth)
+        return self.container_result(request, container_properties, children, total_children,
+                                     depth, top_level)
+
+    def filtered_children(self, request, qlist):
+        """Returns the visible children matching all the compiled queries in `qlist`."""
+        # terms on indexed fields are answered by the catalog before checking any child
+        search = db.get_root()['oms_root']['search'] if qlist else None
+        items = None
+        residual = []
+        for q in qlist:
+            docs, q = search.plan(q)
+            if docs is not None:
+                items = (self.indexed_children(request, search, docs) if items is None
+                         else search.filter_indexed(items, docs))
+            if q is not None:
+                residual.append(q)
+
+        if items is None:
+            items = self.context.listcontent()
+        items = self.visible_children(request, items)
+
+        def secure_filter_match(item, q):
+            try:
+                return IFiltrable(item).match(q)
+            except Unauthorized:
+                return
+
+        for q in residual:
+            items = filter(lambda item: secure_filter_match(item, q), items)
+        return items
+
+    def indexed_children(self, request, search, docs):
+        """Returns the children whose document is among `docs`, without loading all the
+        children when there are fewer hits than children."""
+        children = search.indexed_children(self.context, docs)
+        if children is None:
+            return search.filter_indexed(self.context.listcontent(), docs)
+        return [proxy_factory(child, request.interaction) for child in children]
+
+    def sort_children(self, items, sort, reverse, after):
+        if sort == 'name':
+            items = sorted(items, key=lambda item: item.__name__, reverse=reverse)
+            if after is not None:
+                items = [item for item in items
+                         if (item.__name__ < after if reverse else item.__name__ > after)]
+            return items
+
+        if after is not None:
+            raise BadRequest('after can only be used when sorting by name')
+
+        def key(item):
+            try:
+                return FieldValues(item).get(sort)
+            except Unauthorized:
+                return None
+
+        return sorted(items, key=key, reverse=reverse)
+
+    def paging(self, request):
+        """Returns the `limit` (0 means no limit) and the 1-based `offset` arguments of the request,
+        the latter converted to a 0-based index.
+
+        """
+        limit = int(request.args.get('limit', [0])[0])
+        offset = max(0, int(request.args.get('offset', [1])[0]) - 1)
+        return limit, offset
+
+    def sorting(self, request):
+        """Returns the field to sort children by (given as `sort=field` or `sort=-field` for
+        descending order, None if not requested), the order and the `after` argument, the name of
+        the child after which a page starts.
+
+        """
+        sort = request.args.get('sort', [None])[0]
+        reverse = sort is not None and sort.startswith('-')
+        if reverse:
+            sort = sort[1:]
+        if sort in ('id', '__name__'):
+            sort = 'name'
+        after = request.args.get('after', [None])[0]
+        return sort or None, reverse, after and after.decode('utf-8')
+
+    def visible_page(self, request, offset, limit, after, reverse):
+        """Returns `limit` (0 means no limit) visible children in name order, skipping the first
+        `offset` ones, loading the children in chunks rather than all of them so that pages are
+        not shortened by the hidden ones.
+
+        """
+        page = []
+        chunk = offset + limit if limit else None
+        while True:
+            items = self.context.listcontent_page(0, chunk, after, reverse)
+            for item in self.visible_children(request, items):
+                if not queryAdapter(item, IHttpRestView) or self.blacklisted(item):
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                page.append(item)
+                if len(page) == limit:
+                    return page
+            if chunk is None or len(items) < chunk:
+                return page
+            after = items[-1].__name__
+
+    def visible_children(self, request, objs):
         exclude = [excluded.strip() for excluded in request.args.get('exclude', [''])[0].split(',')]
 
         def preconditions(obj):
@@ -124,8 +316,9 @@ class ContainerView(DefaultView):
             yield obj.__name__ not in exclude
             yield obj.target.__parent__ == obj.__parent__ if type(obj) is Symlink else True
 
-        items = map(follow_symlinks, filter(lambda obj: all(preconditions(obj)), self.context.listcontent()))
+        return map(follow_symlinks, filter(lambda obj: all(preconditions(obj)), objs))
 
+    def render_children(self, request, items, depth):
         def secure_render_recursive(item):
             try:
                 return IHttpRestView(item).render_recursive(request, depth - 1)
@@ -135,35 +328,10 @@ class ContainerView(DefaultView):
                     return dict(access='denied', permissions=permissions,
                                 __type__=type(removeSecurityProxy(item)).__name__)
 
-        qlist = []
-        limit = None
-        offset = 0
-
-        if top_level:
-            qlist = request.args.get('q', [])
-            qlist = map(lambda q: q.decode('utf-8'), qlist)
-            limit = int(request.args.get('limit', [0])[0])
-            offset = int(request.args.get('offset', [1])[0]) - 1
-            if offset <= 0:
-                offset = 0
-
-        def secure_filter_match(item, q):
-            try:
-                return IFiltrable(item).match(q)
-            except Unauthorized:
-                return
-
-        for q in qlist:
-            items = filter(lambda item: secure_filter_match(item, q), items)
-
-        children = filter(None, [secure_render_recursive(item) for item in items
-                                 if queryAdapter(item, IHttpRestView) and not self.blacklisted(item)])
-
-        total_children = len(children)
-
-        if (limit is not None and limit != 0) or offset:
-            children = children[offset : offset + limit]
+        return filter(None, [secure_render_recursive(item) for item in items
+                             if queryAdapter(item, IHttpRestView) and not self.blacklisted(item)])
 
+    def container_result(self, request, container_properties, children, total_children, depth, top_level):
         # backward compatibility:
         # top level results for pure containers are plain lists
         if top_level and (not container_properties or len(container_properties.keys()) == 1):
@@ -189,11 +357,33 @@ class SearchView(ContainerView):
             return super(SearchView, self).render_GET(request)
 
         search = db.get_root()['oms_root']['search']
-        res = SearchResult(search, q.decode('utf-8'))
+        # proxied like any other context, so that permissions are checked on the hits
+        res = proxy_factory(SearchResult(search, q.decode('utf-8')), request.interaction)
 
         return IHttpRestView(res).render_GET(request)
 
 
+class SearchResultsView(ContainerView):
+    """Renders only the requested page of search hits: `limit` and `offset` are applied by the
+    catalog before the hits are loaded. `totalChildren` is the number of hits, including the
+    ones which the user is not allowed to see.
+
+    """
+    context(SearchResults)
+
+    def render_recursive(self, request, depth, filter_=[], top_level=False):
+        if not top_level or depth < 1:
+            return super(SearchResultsView, self).render_recursive(request, depth, filter_, top_level)
+
+        container_properties = DefaultView.render_GET(self, request)
+
+        limit, offset = self.paging(request)
+        total, page = self.context.page(offset, limit or None)
+
+        children = self.render_children(request, self.visible_children(request, page), depth)
+        return self.container_result(request, container_properties, children, total, depth, top_level)
+
+
 class StreamView(HttpRestView):
     context(StreamSubscriber)
 
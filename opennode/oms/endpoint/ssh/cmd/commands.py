@@ -34,7 +34,6 @@ from opennode.oms.model.model.proc import Proc
 from opennode.oms.model.model.symlink import Symlink, follow_symlinks
 from opennode.oms.model.schema import Path, get_schema_fields, model_to_dict
 from opennode.oms.model.traversal import canonical_path
-from opennode.oms.util import blocking_yield
 from opennode.oms.zodb import db
 
 
@@ -534,7 +533,7 @@ class CreateObjCmd(Cmd):
         parser.add_argument('type', choices=choices, help="object type to be created")
         return parser
 
-    @db.transact
+    @db.async_transact
     def execute(self, args):
         model_cls = creatable_models.get(args.type)
 
@@ -549,7 +548,7 @@ class CreateObjCmd(Cmd):
 
         vh = PreValidateHookMixin(obj)
         try:
-            blocking_yield(vh.validate_hook(self.protocol.principal))
+            yield vh.validate_hook(self.protocol.principal)
         except Exception:
             msg = 'Cancelled executing "%s" due to validate_hook failure' % self.name
             self.write('%s\n' % msg)
@@ -9,6 +9,8 @@ from opennode.oms.endpoint.ssh.cmd.security import require_admins_only
 from opennode.oms.endpoint.ssh.cmdline import ICmdArgumentsSyntax, VirtualConsoleArgumentParser
 from opennode.oms.model.model.base import IIncomplete
 from opennode.oms.zodb import db
+from opennode.oms.zodb.profiler import get_profiles, reset_profiles
+from opennode.oms.zodb.retry import hotspots
 
 
 class DBAdminCat(Cmd):
@@ -92,3 +94,62 @@ class DBAdminCat(Cmd):
         if IIncomplete.providedBy(obj):
             self.write("-----------------\n")
             self.write("This %s is incomplete.\n" % (type(removeSecurityProxy(obj)).__name__))
+
+
+class TransactionStatsCmd(Cmd):
+    """ Shows where the ZODB threadpools spend their time: queue counters of every threadpool lane
+    and latencies of the transactional functions (times are in milliseconds). """
+    implements(ICmdArgumentsSyntax)
+
+    command('txstats')
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('-n', type=int, default=20, help="Show only the top N functions (default=20)")
+        parser.add_argument('-s', '--sort', default='total',
+                            choices=['total', 'calls', 'wait', 'exec', 'commit', 'conflicts'],
+                            help="Sort functions by the given measure (default=total)")
+        parser.add_argument('-c', '--conflicts', action='store_true',
+                            help="Show the objects which caused most conflicts instead")
+        parser.add_argument('--reset', action='store_true', help="Reset the collected data")
+        return parser
+
+    @require_admins_only
+    def execute(self, args):
+        if args.reset:
+            reset_profiles()
+            db.reset_threadpool_stats()
+            hotspots.reset()
+            return
+
+        if args.conflicts:
+            self.write("%6s %5s %6s  %-20s %s\n" % ('COUNT', 'READ', 'WRITE', 'OID', 'CLASS / FUNCTIONS'))
+            for entry in hotspots.top(args.n):
+                self.write("%6s %5s %6s  %-20s %s\n" % (entry['count'], entry['read'], entry['write'],
+                                                        entry['oid'], entry['class']))
+                for function, count in sorted(entry['functions'].items(), key=lambda (f, c): -c):
+                    self.write("%42s %s (%s)\n" % ('', function, count))
+            return
+
+        self.write("%-12s %5s %7s %5s %6s %10s %8s %9s %9s\n" %
+                   ('LANE', 'SIZE', 'WORKING', 'IDLE', 'QUEUED', 'MAX_QUEUED', 'STARTED', 'AVG_WAIT',
+                    'MAX_WAIT'))
+        for name, stats in sorted(db.get_threadpool_stats().items()):
+            self.write("%-12s %5s %7s %5s %6s %10s %8s %9.1f %9.1f\n" %
+                       (name, stats['size'], stats['working'], stats['idle'], stats['queued'],
+                        stats['max_queued'], stats['started'], stats['avg_wait'] * 1000,
+                        stats['max_wait'] * 1000))
+
+        self.write("\n%5s %7s %7s %9s %6s %15s %15s %15s  %s\n" %
+                   ('KIND', 'CALLS', 'RETRIES', 'CONFLICTS', 'ERRORS', 'WAIT p50/p99', 'EXEC p50/p99',
+                    'COMMIT p50/p99', 'FUNCTION'))
+        for profile in get_profiles(sort=args.sort, limit=args.n):
+            summary = profile.summary()
+
+            def timing(measure):
+                return '%.1f/%.1f' % (summary[measure]['p50'] * 1000, summary[measure]['p99'] * 1000)
+
+            self.write("%5s %7s %7s %9s %6s %15s %15s %15s  %s\n" %
+                       (summary['kind'], summary['calls'], summary['retries'], summary['conflicts'],
+                        summary['errors'], timing('queue_wait'), timing('execution'), timing('commit'),
+                        profile.description))
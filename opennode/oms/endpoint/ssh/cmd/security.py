@@ -20,6 +20,7 @@ from opennode.oms.model.model.base import IContainer
 from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.model.traversal import canonical_path
 from opennode.oms.security.acl import NoSuchPermission
+from opennode.oms.security.audit import attribute_audit
 from opennode.oms.security.checker import proxy_factory
 from opennode.oms.security.passwd import add_user, update_passwd, UserManagementError
 from opennode.oms.security.permissions import Role
@@ -153,6 +154,39 @@ class PermCheckCmd(Cmd):
         self.write("+%s:-%s\n" % (','.join('@' + i for i in allowed), ','.join('@' + i for i in denied)))
 
 
+class AttributeAuditCmd(Cmd):
+    """ Shows the accesses to attributes without declared permissions, as recorded when
+    audit_all_missing_attribute_rights_definitions is enabled. """
+    implements(ICmdArgumentsSyntax)
+
+    command('attraudit')
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('-n', type=int, default=20, help="Show only the top N entries (default=20)")
+        parser.add_argument('-s', '--stack', action='store_true',
+                            help="Show the stack sampled when the entry was first seen")
+        parser.add_argument('--reset', action='store_true', help="Reset the collected data")
+        return parser
+
+    @require_admins_only
+    def execute(self, args):
+        audit = attribute_audit()
+        if args.reset:
+            audit.reset()
+            return
+
+        stats = audit.stats()
+        self.write("%s entries, %s accesses, %s dropped\n" %
+                   (stats['entries'], stats['accesses'], stats['dropped']))
+        self.write("%8s  %-25s %-40s %s\n" % ('COUNT', 'ATTRIBUTE', 'TYPE', 'PRINCIPALS'))
+        for entry in audit.report(args.n):
+            self.write("%8s  %-25s %-40s %s\n" % (entry['count'], entry['attribute'], entry['type'],
+                                                  ','.join(entry['principals'])))
+            if args.stack:
+                self.write(''.join(entry['stack']))
+
+
 class GetAclCmd(Cmd):
     implements(ICmdArgumentsSyntax)
 
@@ -196,7 +196,7 @@ class UserEventLogZODBHandler(logging.Handler):
         assert hasattr(record, 'asctime'), str(record)
         self.queue.put(record)
 
-        @db.transact
+        @db.transact(lane=db.LANE_BACKGROUND)
         def flush():
             eventlog = db.get_root()['oms_root']['eventlog']
             try:
@@ -4,6 +4,7 @@ import time
 import logging
 from uuid import uuid4
 
+from BTrees.Length import Length
 from BTrees.OOBTree import OOBTree
 from grokcore.component import Subscription, querySubscriptions, baseclass
 from zope import schema
@@ -50,6 +51,13 @@ class IContainer(IModel):
     def listcontent():
         """Lists all the items contained in this container."""
 
+    def content_count():
+        """Returns the number of items in this container, without loading them if possible."""
+
+    def listcontent_page(offset=0, limit=None, after=None, reverse=False):
+        """Lists at most `limit` items in name order, starting from the `offset`-th one after the
+        item named `after` (or from the first), without loading the other items if possible."""
+
     def __iter__():
         """Returns an iterator over the items in this container."""
 
@@ -286,6 +294,8 @@ class ReadonlyContainer(Model):
     implements(IContainer)
     permissions(dict(listnames='traverse',
                      listcontent='traverse',
+                     content_count='traverse',
+                     listcontent_page='traverse',
                      __iter__='traverse',
                      __getitem__='traverse',
                      can_contain='add',
@@ -302,6 +312,17 @@ class ReadonlyContainer(Model):
     def listcontent(self):
         return self.content().values()
 
+    def content_count(self):
+        return len(self.content())
+
+    def listcontent_page(self, offset=0, limit=None, after=None, reverse=False):
+        items = self.content()
+        names = sorted(items, reverse=reverse)
+        if after is not None:
+            names = [name for name in names if (name < after if reverse else name > after)]
+        end = offset + limit if limit is not None else None
+        return [items[name] for name in names[offset:end]]
+
     def __iter__(self):
         return iter(self.listcontent())
 
@@ -311,6 +332,12 @@ class ReadonlyContainer(Model):
 
     @exception_logger
     def content(self):
+        self._inject()
+        items = dict(**self._items)
+        items.update(self._extensions())
+        return items
+
+    def _inject(self):
         injectors = querySubscriptions(self, IContainerInjector)
         for injector in injectors:
             interface_filter = getattr(injector, '__interfaces__', [])
@@ -321,9 +348,11 @@ class ReadonlyContainer(Model):
                 if k not in self._items:
                     v.__parent__ = self
                     self._items[k] = v
+                    self._items_changed(1)
 
-        items = dict(**self._items)
-
+    def _extensions(self):
+        """Returns the transient items added by the container extenders."""
+        items = {}
         extenders = querySubscriptions(self, IContainerExtender)
         for extender in extenders:
             interface_filter = getattr(extender, '__interfaces__', [])
@@ -336,9 +365,11 @@ class ReadonlyContainer(Model):
                 v.__transient__ = True
                 v.inherit_permissions = True
             items.update(children)
-
         return items
 
+    def _items_changed(self, delta):
+        pass
+
     _items = {}
 
 
@@ -396,9 +427,74 @@ class Container(AddingContainer):
 
     __contains__ = Interface
 
+    # number of stored items, kept up to date as they are added and removed, so that it can be
+    # read without loading all the buckets of the tree. Created on the first change.
+    _count = None
+
     def __init__(self):
         self._items = OOBTree()
 
+    def _items_changed(self, delta):
+        if self._count is None:
+            self._count = Length(len(self._items))
+        else:
+            self._count.change(delta)
+
+    def content_count(self):
+        self._inject()
+        count = self._count() if self._count is not None else len(self._items)
+        return count + len(self._extensions())
+
+    def listcontent_page(self, offset=0, limit=None, after=None, reverse=False):
+        """Transient items are merged in name order with a slice of the keys of the tree, so that
+        only the requested stored items are loaded.
+
+        """
+        self._inject()
+        extensions = self._extensions()
+        if any(name in self._items for name in extensions):
+            return super(Container, self).listcontent_page(offset, limit, after, reverse)
+
+        def between(low, high):
+            """Stored names strictly between `low` and `high` (None meaning unbounded)."""
+            bounds = {}
+            if low is not None:
+                bounds.update(min=low, excludemin=True)
+            if high is not None:
+                bounds.update(max=high, excludemax=True)
+            return self._items.keys(**bounds)
+
+        names = sorted(extensions, reverse=reverse)
+        if after is not None:
+            names = [name for name in names if (name < after if reverse else name > after)]
+        stored = between(None, after) if reverse else between(after, None)
+        total = len(stored)
+
+        # position of each transient item in the merged sequence
+        positions = {}
+        for i, name in enumerate(names):
+            preceding = between(name, after) if reverse else between(after, name)
+            positions[len(preceding) + i] = name
+
+        end = total + len(names)
+        if limit is not None:
+            end = min(end, offset + limit)
+        start = offset - len([position for position in positions if position < offset])
+        count = max(0, end - offset) - len([position for position in positions
+                                            if offset <= position < end])
+        if reverse:
+            keys = reversed(list(stored[max(0, total - start - count):max(0, total - start)]))
+        else:
+            keys = iter(stored[start:start + count])
+
+        page = []
+        for position in xrange(offset, end):
+            if position in positions:
+                page.append(extensions[positions[position]])
+            else:
+                page.append(self._items[next(keys)])
+        return page
+
     def _add(self, item):
         item = removeSecurityProxy(item)
         if item.__parent__:
@@ -411,13 +507,17 @@ class Container(AddingContainer):
         if not id:
             id = self._new_id()
 
+        added = id not in self._items
         self._items[id] = item
         item.__name__ = id
+        if added:
+            self._items_changed(1)
 
         return id
 
     def remove(self, item):
-        del self._items[item.__name__]
+        del self[item.__name__]
 
     def __delitem__(self, key):
         del self._items[key]
+        self._items_changed(-1)
@@ -79,7 +79,7 @@ class UserEventLog(Container):
 
         if self.sizelimit is not None:
             while self.sizelimit <= len(self._items):
-                del self._items[min(self._items.keys())]
+                del self[self._items.minKey()]
 
         self.cur_index += 1
         item = UserEvent(rawevent, self.cur_index)
@@ -1,5 +1,9 @@
+import operator
+import re
+
 from grokcore.component import Adapter, context
-from zope.interface import Interface, implements
+from zope.interface import Interface, implements, providedBy
+from zope.security.proxy import removeSecurityProxy
 
 from opennode.oms.model.schema import get_schema_fields
 from opennode.oms.model.model.base import IModel
@@ -7,47 +11,279 @@ from opennode.oms.model.model.base import IModel
 
 class IFiltrable(Interface):
     def match(query):
-        """Returns true if this object matches the given query."""
+        """Returns true if this object matches the given query, either a string or a query
+        compiled with `compile_query`."""
 
 
-class ModelFieldFiltrable(Adapter):
-    implements(IFiltrable)
-    context(IModel)
+QUERY_TERM = re.compile(r'^([^:<>=\s]+)(>=|<=|>|<|:)(.*)$')
 
-    def match(self, query):
-        terms = [t for t in query.split(' ') if t]
+QUERY_TOKEN = re.compile(r'[()]|(?:[^\s()"]|"[^"]*")+')
 
-        def matches(keyword, value):
-            if isinstance(value, unicode):
-                value = value.encode('utf-8')
+QUOTED = re.compile(r'"([^"]*)"')
 
-            if isinstance(value, list) or isinstance(value, set) or isinstance(value, str):
-                if keyword in value:
-                    return True
+OPERATORS = ('AND', 'OR', 'NOT')
 
-            if keyword == value:
-                return True
+COMPARISONS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+
+def parse_term(term):
+    """Splits a query term in field name, operator and value. Terms which don't name a field
+    are returned as (None, None, term).
+
+    >>> parse_term('state:active'), parse_term('mtime>=10'), parse_term('foo')
+    (('state', ':', 'active'), ('mtime', '>=', '10'), (None, None, 'foo'))
+
+    """
+    match = QUERY_TERM.match(term)
+    if not match:
+        return None, None, term
+    return match.groups()
+
+
+def unquote(text):
+    """Removes the double quotes around the literal parts of a query token.
+
+    >>> unquote('"OR"'), unquote('hostname:"web (1)"')
+    ('OR', 'hostname:web (1)')
+
+    """
+    return QUOTED.sub(r'\1', text)
+
+
+def quote(text):
+    if text in OPERATORS or re.search(r'[\s()"]', text) or QUERY_TERM.match(text):
+        return u'"%s"' % text
+    return text
+
+
+def contains(keyword, value):
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+
+    if isinstance(value, (list, set, frozenset, tuple, unicode)):
+        if keyword in value:
+            return True
+
+    return keyword == value
 
-            return False
 
-        def any_field(keyword):
-            return any(matches(keyword, field.get(schema(self.context)))
-                       for name, field, schema in get_schema_fields(self.context))
+class FieldValues(object):
+    """Schema field values of a model object, computed lazily and at most once.
 
-        def specific_field(fieldname, value):
-            schema = get_schema_fields(self.context)
-            result = filter(lambda (name, field, schema): name == fieldname,
-                            get_schema_fields(self.context))
+    The fields are resolved by name once for each class and set of provided interfaces, instead of
+    once for each object and query term.
 
-            if len(result) == 0:
+    """
+
+    _accessors = {}
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.values = {}
+
+        unproxied = removeSecurityProxy(obj)
+        key = (type(unproxied), providedBy(unproxied))
+        fields = self._accessors.get(key)
+        if fields is None:
+            fields = self._accessors[key] = {}
+            for name, field, schema in get_schema_fields(unproxied):
+                fields.setdefault(name, (field, schema))
+        self.fields = fields
+
+    def get(self, name, default=None):
+        if name not in self.values:
+            if name not in self.fields:
+                return default
+            field, schema = self.fields[name]
+            self.values[name] = field.get(schema(self.obj))
+        return self.values[name]
+
+    def __iter__(self):
+        for name in self.fields:
+            yield self.get(name)
+
+
+class Query(object):
+    """A node of a compiled query, evaluated against the FieldValues of an object."""
+
+    def __call__(self, values):
+        raise NotImplementedError
+
+
+class AnyField(Query):
+    def __init__(self, keyword):
+        self.keyword = keyword.lower()
+
+    def __call__(self, values):
+        return any(contains(self.keyword, value) for value in values)
+
+    def __unicode__(self):
+        return quote(self.keyword)
+
+
+class FieldTerm(Query):
+    def __init__(self, name, op, value):
+        self.name, self.op, self.value = name, op, value
+        try:
+            self.number = float(value)
+        except ValueError:
+            self.number = None
+
+    def __call__(self, values):
+        fieldvalue = values.get(self.name)
+        if fieldvalue is None:
+            return False
+
+        value = self.value
+        if isinstance(fieldvalue, (int, long, float)) and not isinstance(fieldvalue, bool):
+            if self.number is None:
                 return False
+            value = self.number
+
+        if self.op == ':':
+            return contains(value, fieldvalue)
+        return COMPARISONS[self.op](fieldvalue, value)
+
+    def __unicode__(self):
+        return u'%s%s%s' % (self.name, self.op, quote(self.value))
 
-            name, field, schema = result[0]
-            fieldvalue = field.get(schema(self.context))
-            return matches(value, fieldvalue)
 
-        return all(any_field(term.lower()) if ':' not in term else specific_field(*term.split(':', 1))
-                   for term in terms)
+class And(Query):
+    def __init__(self, operands):
+        self.operands = operands
+
+    def __call__(self, values):
+        return all(operand(values) for operand in self.operands)
+
+    def __unicode__(self):
+        return u' '.join(unicode(operand) for operand in self.operands)
+
+
+class Or(Query):
+    def __init__(self, operands):
+        self.operands = operands
+
+    def __call__(self, values):
+        return any(operand(values) for operand in self.operands)
+
+    def __unicode__(self):
+        return u'(%s)' % u' OR '.join(unicode(operand) for operand in self.operands)
+
+
+class Not(Query):
+    def __init__(self, operand):
+        self.operand = operand
+
+    def __call__(self, values):
+        return not self.operand(values)
+
+    def __unicode__(self):
+        return u'NOT %s' % unicode(self.operand)
+
+
+class QueryParser(object):
+    """Parses queries made of terms separated by spaces, all of which have to match, unless
+    joined by OR. Terms can be negated with NOT and grouped with parentheses:
+
+        state:active (hostname:web OR hostname:db) NOT memory<1024
+
+    Terms are either `field:value`, which matches if the value of the field contains or equals
+    the value, comparisons such as `field>=value` (numeric when the field value is a number), or
+    keywords matching any field.
+
+    Double quoted text is taken literally, so that values can contain spaces, parentheses or
+    the operator words:
+
+        hostname:"web (old)" "OR"
+
+    """
+
+    def __init__(self, query):
+        if query.count('"') % 2:
+            raise ValueError('Unbalanced quotes in query')
+        self.tokens = QUERY_TOKEN.findall(query)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        query = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError("Unexpected '%s' in query" % self.peek())
+        return query
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.next()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def parse_and(self):
+        operands = []
+        while self.peek() not in (None, ')', 'OR'):
+            if self.peek() == 'AND':
+                self.next()
+                continue
+            operands.append(self.parse_unary())
+        if not operands:
+            raise ValueError('Missing term in query')
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def parse_unary(self):
+        token = self.next()
+        if token == 'NOT':
+            if self.peek() in (None, ')', 'OR'):
+                raise ValueError('Missing term after NOT in query')
+            return Not(self.parse_unary())
+        if token == '(':
+            query = self.parse_or()
+            if self.next() != ')':
+                raise ValueError('Unbalanced parentheses in query')
+            return query
+
+        name, op, value = parse_term(token) if not token.startswith('"') else (None, None, token)
+        if name is None:
+            return AnyField(unquote(token))
+        return FieldTerm(name, op, unquote(value))
+
+
+_compiled = {}
+
+
+def compile_query(query):
+    """Parses a query once, returning a predicate over FieldValues. Empty queries yield None.
+
+    Raises ValueError if the query cannot be parsed.
+
+    """
+    if isinstance(query, Query) or query is None:
+        return query
+    if not query.strip():
+        return None
+
+    compiled = _compiled.get(query)
+    if compiled is None:
+        # compiled queries are immutable, a small cache avoids parsing them in every `match`
+        if len(_compiled) > 256:
+            _compiled.clear()
+        compiled = _compiled[query] = QueryParser(query).parse()
+    return compiled
+
+
+class ModelFieldFiltrable(Adapter):
+    implements(IFiltrable)
+    context(IModel)
+
+    def match(self, query):
+        query = compile_query(query)
+        return query is None or query(FieldValues(self.context))
 
 
 class DefaultFiltrable(Adapter):
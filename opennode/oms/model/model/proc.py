@@ -137,8 +137,8 @@ class Proc(ReadonlyContainer):
             self.spawn(i)
 
     def spawn(self, process):
-        self._register(process.run(), process, IProcessStateRenderer(process),
-                       signal_handler=process.signal_handler)
+        return self._register(process.run(), process, IProcessStateRenderer(process),
+                              signal_handler=process.signal_handler)
 
     def __str__(self):
         return 'Tasks'
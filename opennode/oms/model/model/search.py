@@ -1,14 +1,21 @@
 from __future__ import absolute_import
 
-from BTrees.OOBTree import OOTreeSet, difference
+import itertools
+import persistent
+
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet, difference
 from grokcore.component import context, subscribe, Adapter, baseclass
 from twisted.python import log
 from zope import schema
 from zope.app.catalog.catalog import Catalog
 from zope.app.intid import IntIds
 from zope.app.intid.interfaces import IIntIds
+from zope.catalog.attribute import AttributeIndex
+from zope.catalog.field import FieldIndex
 from zope.catalog.keyword import KeywordIndex
 from zope.catalog.text import TextIndex
+from zope.index.interfaces import IIndexSort
 from zope.component import provideAdapter, provideUtility, provideSubscriptionAdapter, queryAdapter
 from zope.interface import Interface, implements
 from zope.keyreference.interfaces import NotYet
@@ -18,7 +25,11 @@ from zope.security.proxy import removeSecurityProxy
 from .actions import ActionsContainerExtension, Action, action
 from .base import ReadonlyContainer, AddingContainer, Model, IDisplayName, IContainer, IModel, Container
 from .symlink import Symlink, follow_symlinks
+from .filtrable import And, FieldTerm, compile_query
+from opennode.oms.config import get_config
 from opennode.oms.model.model.events import IModelModifiedEvent, IModelCreatedEvent, IModelDeletedEvent
+from opennode.oms.model.schema import get_schema_fields
+from opennode.oms.security.directives import permissions
 
 
 class ITokenized(Interface):
@@ -122,9 +133,123 @@ class ModelTags(Adapter):
     tags = property(get_tags, set_tags)
 
 
+class IIndexedFields(Interface):
+    """Values of the model attributes which are indexed by the field indexes."""
+
+
+class ModelIndexedFields(Adapter):
+    implements(IIndexedFields)
+    context(Model)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        if name == 'owner':
+            value = self.context.__owner__
+        elif name in ('ctime', 'mtime'):
+            value = getattr(self.context, name)
+        else:
+            value = None
+            for field_name, field, schema in get_schema_fields(self.context):
+                if field_name == name:
+                    value = field.get(schema(self.context))
+                    break
+
+        # only scalars can be kept sorted in a field index
+        if isinstance(value, (basestring, int, long, float)):
+            return value
+
+
+class ModelFieldIndex(FieldIndex):
+    """Indexes a model attribute, so that filter queries on it don't need to check each object.
+
+    Query values are strings, they are converted with `value_type` before being compared to the
+    indexed values.
+
+    """
+
+    def __init__(self, field_name, value_type=unicode):
+        super(ModelFieldIndex, self).__init__(field_name, IIndexedFields)
+        self.value_type = value_type
+
+    def range(self, low=None, high=None, exclude_low=False, exclude_high=False):
+        """Returns the ids of the documents whose value is between `low` and `high`."""
+        return self.family.IF.multiunion(
+            self._fwd_index.values(low, high, excludemin=exclude_low, excludemax=exclude_high))
+
+    def query(self, op, value):
+        """Returns the ids of the documents matching a filter query term, or None if the value
+        cannot be compared with the indexed values."""
+        try:
+            value = self.value_type(value)
+        except ValueError:
+            return None
+
+        if op == ':':
+            if self.value_type is unicode:
+                # IFiltrable matches substrings of text fields; text indexes are meant for
+                # fields with few distinct values, like states or owners
+                return self.family.IF.multiunion(
+                    [docs for key, docs in self._fwd_index.items()
+                     if isinstance(key, basestring) and value in key])
+            return self.range(value, value)
+        if op in ('>', '>='):
+            return self.range(low=value, exclude_low=(op == '>'))
+        return self.range(high=value, exclude_high=(op == '<'))
+
+
+FIELD_INDEX_TYPES = {'text': unicode, 'int': int, 'float': float}
+
+
+def configured_field_indexes():
+    """Returns the names and value types of the field indexes listed in the configuration
+    as `name` or `name:type`.
+
+    """
+    spec = get_config().getstring('indexer', 'field_indexes', 'state, owner, ctime:float, mtime:float')
+    indexes = {}
+    for item in (i.strip() for i in spec.split(',')):
+        if not item:
+            continue
+        name, _, type_name = item.partition(':')
+        if name in SearchContainer.reserved_indexes:
+            log.msg("cannot define a field index named %s" % name, system='search')
+            continue
+        if (type_name or 'text') not in FIELD_INDEX_TYPES:
+            log.msg("unknown type %s of the field index %s, ignoring it" % (type_name, name),
+                    system='search')
+            continue
+        indexes[name] = FIELD_INDEX_TYPES[type_name or 'text']
+    return indexes
+
+
+def is_indexable(obj):
+    # HACK, handle non indexable stuff:
+    if IContainer.providedBy(obj) and not isinstance(obj, Container):
+        return False
+    return IModel.providedBy(obj) and not isinstance(obj, Symlink)
+
+
 class SearchContainer(ReadonlyContainer):
+    """Full text and tag search over the model objects.
+
+    The catalog is kept up to date by the indexer daemon and survives restarts: `watermark` is the
+    id of the transaction up to which all changes are known to be indexed and `indexed_serials`
+    maps each indexed document to the serial of the object state it was built from. A watermark
+    of None means that the catalog has to be rebuilt from scratch.
+
+    """
     __name__ = 'search'
 
+    reserved_indexes = ('tags', 'name', '__all')
+
+    # defaults for catalogs created before the watermarks were introduced
+    watermark = None
+    indexed_serials = None
+    reindex_cursor = None
+    facets = None
+
     def __init__(self):
         self.clear()
 
@@ -134,26 +259,173 @@ class SearchContainer(ReadonlyContainer):
         self.catalog['tags'] = KeywordIndex('tags', ITagged)
         self.catalog['name'] = TextIndex('display_name', IDisplayName, True)
         self.catalog['__all'] = TextIndex('tokens', ITokenized, True)
+        for name, value_type in configured_field_indexes().items():
+            self.catalog[name] = ModelFieldIndex(name, value_type)
 
         self.ids = IntIds()
 
+        self.watermark = None
+        self.indexed_serials = IOBTree()
+        self.reindex_cursor = None
+        self.facets = TagFacets()
+
+    def missing_field_indexes(self):
+        """Returns the configured field indexes which the catalog doesn't have yet, and which
+        thus require a reindex."""
+        return [name for name in configured_field_indexes() if name not in self.catalog]
+
+    def plan(self, query):
+        """Splits a filter query (see IFiltrable) in the terms which can be answered by the field
+        indexes and the rest of the query.
+
+        Returns the ids of the documents matching the former, or None if no term can use an
+        index, and the compiled query made of the remaining terms (None if there are none),
+        which has to be matched against each candidate object. Only terms which all results must
+        match are answered by the indexes, and indexes aren't used while the catalog is being
+        rebuilt. Indexed fields are matched like IFiltrable does, so that the results don't
+        depend on whether the indexes can be used.
+
+        """
+        query = compile_query(query)
+        if self.watermark is None or self.reindex_cursor is not None or query is None:
+            return None, query
+
+        docs = None
+        residual = []
+        for term in (query.operands if isinstance(query, And) else [query]):
+            index = None
+            if isinstance(term, FieldTerm) and term.name not in self.reserved_indexes:
+                index = self.catalog.get(term.name)
+            hits = index.query(term.op, term.value) if isinstance(index, ModelFieldIndex) else None
+            if hits is None:
+                residual.append(term)
+                continue
+            docs = hits if docs is None else index.family.IF.intersection(docs, hits)
+
+        if not residual:
+            return docs, None
+        return docs, residual[0] if len(residual) == 1 else And(residual)
+
+    def indexed_children(self, container, docs):
+        """Returns the children of `container` whose document is among `docs`, sorted by name,
+        by looking at the parents of the hits instead of loading every child.
+
+        Only the children stored in the container are found this way, symlinks aren't
+        followed. Returns None if the container isn't a stored one or it has fewer children than
+        the hits, in which case the children have to be checked with `filter_indexed`.
+
+        """
+        container = removeSecurityProxy(container)
+        if not isinstance(container, Container) or len(docs) > container.content_count():
+            return None
+
+        children = []
+        for doc_id in docs:
+            obj = self.ids.queryObject(doc_id)
+            if obj is not None and obj.__parent__ is container:
+                children.append(obj)
+        return sorted(children, key=lambda obj: obj.__name__)
+
+    def filter_indexed(self, objs, docs):
+        """Returns the objects whose document is among `docs`."""
+        res = []
+        for obj in objs:
+            doc_id = self.ids.queryId(removeSecurityProxy(follow_symlinks(obj)))
+            if doc_id is not None and doc_id in docs:
+                res.append(obj)
+        return res
+
     def index_object(self, obj):
-        real_obj = follow_symlinks(obj)
         try:
-            self.catalog.index_doc(self.ids.register(real_obj), real_obj)
+            self._index_object(obj)
         except NotYet:
             log.msg("cannot index object %s because it's not yet committed" % obj, system='search')
 
     def _index_object(self, obj):
         real_obj = follow_symlinks(obj)
-        self.catalog.index_doc(self.ids.register(real_obj), real_obj)
+        doc_id = self.ids.register(real_obj)
+        old_tags = self._doc_tags(doc_id)
+        self.catalog.index_doc(doc_id, real_obj)
+        self._update_facets(doc_id, old_tags)
+        if self.indexed_serials is not None:
+            self.indexed_serials[doc_id] = real_obj._p_serial
 
     def unindex_object(self, obj):
         try:
-            self.catalog.unindex_doc(self.ids.register(obj))
+            self._unindex_doc(self.ids.register(obj))
         except NotYet:
             log.msg("cannot unindex object %s because it's not yet committed" % obj, system='search')
 
+    def extract_document(self, obj):
+        """Computes the values which the catalog indexes would extract from `obj`.
+
+        This is the expensive part of indexing (adapters computing tokens and tags), and it doesn't
+        write anything, so it can run in read only transactions in parallel; the document is then
+        applied by `apply_document`. Indexes for which `obj` cannot be adapted are left out, a
+        None value means that the index has to forget the object.
+
+        """
+        document = {}
+        for name, index in self.catalog.items():
+            adapted = index.interface(obj, None) if index.interface is not None else obj
+            if adapted is None:
+                continue
+
+            value = getattr(adapted, index.field_name, None)
+            if value is not None and index.field_callable:
+                value = value()
+            document[name] = value
+        return document
+
+    def apply_document(self, obj, serial, document):
+        """Indexes `obj` with a document previously computed by `extract_document` from the object
+        state with the given `serial`. If the object has changed meanwhile, it's indexed normally.
+
+        """
+        if obj._p_serial != serial:
+            return self._index_object(obj)
+
+        doc_id = self.ids.register(obj)
+        old_tags = self._doc_tags(doc_id)
+        for name, value in document.items():
+            index = self.catalog[name]
+            # bypass the value extraction of zope.catalog.attribute.AttributeIndex
+            if value is None:
+                super(AttributeIndex, index).unindex_doc(doc_id)
+            else:
+                super(AttributeIndex, index).index_doc(doc_id, value)
+        self._update_facets(doc_id, old_tags)
+
+        if self.indexed_serials is not None:
+            self.indexed_serials[doc_id] = serial
+
+    def unindex_deleted(self, obj):
+        """Unindexes an object which has been deleted, possibly in another connection."""
+        doc_id = self.ids.queryId(obj)
+        if doc_id is not None:
+            self._unindex_doc(doc_id)
+
+    def _unindex_doc(self, doc_id):
+        old_tags = self._doc_tags(doc_id)
+        self.catalog.unindex_doc(doc_id)
+        self._update_facets(doc_id, old_tags)
+        if self.indexed_serials is not None and doc_id in self.indexed_serials:
+            del self.indexed_serials[doc_id]
+
+    def _doc_tags(self, doc_id):
+        return list(self.catalog['tags']._rev_index.get(doc_id, ()))
+
+    def _update_facets(self, doc_id, old_tags):
+        if self.facets is not None:
+            self.facets.update(old_tags, self._doc_tags(doc_id))
+
+    def is_up_to_date(self, obj):
+        """Whether the current state of `obj` is already indexed."""
+        if self.indexed_serials is None:
+            return False
+        doc_id = self.ids.queryId(obj)
+        return doc_id is not None and self.indexed_serials.get(doc_id) == obj._p_serial
+
     def search(self, **kwargs):
         # HACK, we should be able to setup a persistent utility
         provideUtility(self.ids, IIntIds)
@@ -163,12 +435,205 @@ class SearchContainer(ReadonlyContainer):
         # hack, zope catalog treats ':' specially
         return self.search(__all=query.replace(':', '_'))
 
+    def search_page(self, offset=0, limit=None, sort_on=None, reverse=False, **query):
+        """Like `search` but returns only a page of the results, along with the total number
+        of hits. Only the objects of the page are loaded, and the cost of paging doesn't depend
+        on the number of hits, except when sorting on an index.
+
+        """
+        results = self.catalog.apply(query)
+        if not results:
+            return 0, []
+
+        total = len(results)
+        end = offset + limit if limit is not None else None
+
+        if sort_on is not None:
+            index = self.catalog[sort_on]
+            if not IIndexSort.providedBy(index):
+                raise ValueError('Index %s does not support sorting' % sort_on)
+            uids = itertools.islice(index.sort(results, limit=end, reverse=reverse), offset, None)
+        elif reverse:
+            start = max(0, total - end) if end is not None else 0
+            uids = reversed(results.keys()[start:total - offset])
+        else:
+            uids = results.keys()[offset:end]
+
+        return total, [self.ids.getObject(uid) for uid in uids]
+
+    def search_goog_page(self, query, offset=0, limit=None):
+        return self.search_page(offset, limit, __all=query.replace(':', '_'))
+
     @property
     def _items(self):
         return {'by-tag': self.tag_container}
 
 
-class SearchResult(ReadonlyContainer):
+class ReindexCursor(persistent.Persistent):
+    """Progress of a full reindex, which is performed in batches of objects by a background task
+    and can thus be resumed after a restart.
+
+    The objects are collected while reindexing: `containers` maps the oids of the containers
+    still to be walked to the name of the last child walked, so that every batch only walks a
+    page of children. `total` is the number of objects collected so far.
+
+    `tid` is the last transaction committed before the walk started: once all the objects are
+    collected and indexed, the catalog is up to date with it.
+
+    """
+
+    # cursors saved before the objects were collected incrementally have all of them pending
+    containers = None
+
+    def __init__(self, tid, root):
+        self.tid = tid
+        self.pending = OOTreeSet()
+        self.containers = OOBTree()
+        self.containers[root._p_oid] = None
+        self.total = 0
+        self.done = 0
+
+    @property
+    def finished(self):
+        return not self.pending and not self.containers
+
+    def collect(self, connection, size):
+        """Walks the containers until at least `size` objects are pending, or all have been
+        collected."""
+        while len(self.pending) < size and self.containers:
+            oid = self.containers.minKey()
+            page = connection.get(oid).listcontent_page(0, size, self.containers[oid])
+            for item in page:
+                # HACK, handle non indexable stuff:
+                if IContainer.providedBy(item) and not isinstance(item, Container):
+                    continue
+                if getattr(item, '_p_oid', None) is None:
+                    continue
+
+                if IModel.providedBy(item) and not isinstance(item, Symlink):
+                    if item._p_oid not in self.pending:
+                        self.pending.insert(item._p_oid)
+                        self.total += 1
+
+                if IContainer.providedBy(item):
+                    self.containers[item._p_oid] = None
+
+            if len(page) < size:
+                del self.containers[oid]
+            else:
+                self.containers[oid] = page[-1].__name__
+
+
+class TagFacets(persistent.Persistent):
+    """Number of indexed documents carrying each tag and each pair of tags.
+
+    It's maintained incrementally as documents are (un)indexed, so that browsing by tag can list
+    the refinements of a tag and their hit counts with a lookup instead of a search for each
+    candidate tag. Counts dropping to zero are removed.
+
+    """
+
+    def __init__(self):
+        self.counts = OOBTree()
+        # tag -> OOBTree(co-occurring tag -> count)
+        self.pairs = OOBTree()
+
+    def update(self, old_tags, new_tags):
+        old, new = set(old_tags), set(new_tags)
+        if old == new:
+            return
+
+        for tag in old - new:
+            self._add(self.counts, tag, -1)
+        for tag in new - old:
+            self._add(self.counts, tag, 1)
+
+        for tag in old | new:
+            if tag in old:
+                lost = old - new if tag in new else old
+                for other in lost - set([tag]):
+                    self._add(self._pairs_of(tag), other, -1)
+            if tag in new:
+                gained = new - old if tag in old else new
+                for other in gained - set([tag]):
+                    self._add(self._pairs_of(tag), other, 1)
+
+            if tag in self.pairs and not self.pairs[tag]:
+                del self.pairs[tag]
+
+    def _pairs_of(self, tag):
+        if tag not in self.pairs:
+            self.pairs[tag] = OOBTree()
+        return self.pairs[tag]
+
+    def _add(self, counts, key, delta):
+        value = counts.get(key, 0) + delta
+        if value > 0:
+            counts[key] = value
+        elif key in counts:
+            del counts[key]
+
+    def count(self, tag):
+        return self.counts.get(tag, 0)
+
+    def cooccurring(self, tag):
+        """Returns the tags which appear together with `tag` in some document, with the number
+        of such documents.
+
+        """
+        return dict(self.pairs.get(tag, {}).items())
+
+
+def make_symlinks(items):
+    """Returns symlinks to `items` named after their display names, adding a numeric suffix to
+    duplicate names (`name`, `name_0`, `name_1`...).
+
+    """
+    res = {}
+    next_suffix = {}
+    for item in items:
+        name = item.__name__
+        if IDisplayName.providedBy(item):
+            name = IDisplayName(item).display_name()
+
+        free_name = name
+        suffix = next_suffix.get(name, 0)
+        while free_name in res:
+            free_name = '%s_%s' % (name, suffix)
+            suffix += 1
+        next_suffix[name] = suffix
+
+        res[free_name] = Symlink(free_name, item)
+    return res
+
+
+class SearchResults(ReadonlyContainer):
+    """Base class for containers of search hits, which are materialized as symlinks lazily.
+
+    Listing the container creates a symlink for every hit, while `page` fetches and links only
+    a page of hits; names are unique only within the page.
+
+    """
+    baseclass()
+    permissions(dict(page='traverse', count='traverse'))
+
+    def search_page(self, offset, limit):
+        """Returns the total number of hits and the hits in the given page."""
+        raise NotImplementedError
+
+    def page(self, offset=0, limit=None):
+        total, items = self.search_page(offset, limit)
+        return total, make_symlinks(items).values()
+
+    def count(self):
+        return self.search_page(0, 0)[0]
+
+    @property
+    def _items(self):
+        return make_symlinks(self.search_page(0, None)[1])
+
+
+class SearchResult(SearchResults):
     def __init__(self, parent, query):
         self.__parent__ = parent
         self.__name__ = query
@@ -177,23 +642,8 @@ class SearchResult(ReadonlyContainer):
     def search_goog(self, query):
         return self.__parent__.search_goog(query)
 
-    @property
-    def _items(self):
-        res = {}
-        for item in self.__parent__.search_goog(self.query):
-            name = item.__name__
-            if IDisplayName.providedBy(item):
-                name = IDisplayName(item).display_name()
-
-            def find_free_name(tentative_name, idx):
-                next_name = '%s_%s' % (name, idx)
-                if tentative_name in res:
-                    return find_free_name(next_name, idx + 1)
-                return tentative_name
-
-            name = find_free_name(name, 0)
-            res[name] = Symlink(name, item)
-        return res
+    def search_page(self, offset, limit):
+        return self.__parent__.search_goog_page(self.query, offset, limit)
 
 
 @subscribe(Model, IModelModifiedEvent)
@@ -205,6 +655,15 @@ def enqueue_for_indexing(model, event):
     if isinstance(model, Symlink):
         return
 
+    if IModelDeletedEvent.providedBy(event):
+        # deleting doesn't modify the object: giving it a new serial lets the catch up find it
+        # among the changed objects and unindex it, should the indexer not get to it before a
+        # restart, without writing any state shared with other transactions
+        model = removeSecurityProxy(model)
+        if model._p_jar is not None:
+            model._p_activate()
+            model._p_changed = True
+
     IndexerDaemonProcess.enqueue(model, event)
 
 
@@ -236,39 +695,15 @@ class ReindexAction(Action):
     def execute(self, cmd, args):
 
         # TODO: break this import cycle by moving this action somewhere else
-        from opennode.oms.zodb import db
-
-        @db.transact
-        def doit():
-            search = db.get_root()['oms_root']['search']
-            search.clear()
-
-            objs = set()
+        from opennode.oms.backend.indexer import ReindexProcess
 
-            def collect(container):
-                for item in container.listcontent():
-                    # HACK, handle non indexable stuff:
-                    if IContainer.providedBy(item) and not isinstance(item, Container):
-                        continue
-
-                    if IModel.providedBy(item) and not isinstance(item, Symlink):
-                        objs.add(item)
-
-                    if IContainer.providedBy(item):
-                        collect(item)
-
-            collect(db.get_root()['oms_root'])
-
-            for obj in objs:
-                search.index_object(obj)
-
-            cmd.write("reindexed %s objects\n" % (len(objs)))
-
-        return doit()
+        pid = ReindexProcess.start(restart=True)
+        cmd.write("reindexing in background, see /proc/%s\n" % pid)
 
 
 class ITag(Interface):
     name = schema.TextLine(title=u"Name")
+    count = schema.Int(title=u"Hits", readonly=True)
 
 
 class Tag(ReadonlyContainer):
@@ -282,42 +717,50 @@ class Tag(ReadonlyContainer):
         self.other_tags = difference(other_tags, OOTreeSet([self.__name__]))
         self.tag_path = tag_path + [name]
 
+    @property
+    def count(self):
+        facets = self.searcher.facets
+        if facets is not None and len(self.tag_path) == 1:
+            return facets.count(self.name)
+        return TagItems(self, self.searcher).count()
+
+    def refinements(self):
+        """Returns the tags which, added to this tag path, still yield some results."""
+        facets = self.searcher.facets
+        if facets is None:
+            return [i for i in self.other_tags
+                    if TagItems(Tag(i, self.searcher, self, self.other_tags, self.tag_path),
+                                self.searcher).count()]
+
+        candidates = None
+        for tag in self.tag_path:
+            cooccurring = set(facets.cooccurring(tag))
+            candidates = cooccurring if candidates is None else candidates & cooccurring
+        candidates = [i for i in self.other_tags if i in candidates]
+
+        if len(self.tag_path) == 1:
+            return candidates
+        # pair counts only tell that each tag of the path appears with the candidate
+        return [i for i in candidates
+                if self.searcher.search_page(0, 0, tags=self.tag_path + [i])[0]]
+
     @property
     def _items(self):
         res = {'items': TagItems(self, self.searcher)}
-        for i in self.other_tags:
-            sub_tag = Tag(i, self.searcher, self, self.other_tags, self.tag_path)
-
-            # only add it if it yields some results.
-            if TagItems(sub_tag, self.searcher)._items:
-                res[i] = sub_tag
+        for i in self.refinements():
+            res[i] = Tag(i, self.searcher, self, self.other_tags, self.tag_path)
         return res
 
 
-class TagItems(ReadonlyContainer):
+class TagItems(SearchResults):
     __name__ = 'items'
 
     def __init__(self, parent, searcher):
         self.__parent__ = parent
         self.searcher = searcher
 
-    @property
-    def _items(self):
-        res = {}
-        for item in self.searcher.search(tags=self.__parent__.tag_path):
-            name = item.__name__
-            if IDisplayName.providedBy(item):
-                name = IDisplayName(item).display_name()
-
-            def find_free_name(tentative_name, idx):
-                next_name = '%s_%s' % (name, idx)
-                if tentative_name in res:
-                    return find_free_name(next_name, idx + 1)
-                return tentative_name
-
-            name = find_free_name(name, 0)
-            res[name] = Symlink(name, item)
-        return res
+    def search_page(self, offset, limit):
+        return self.searcher.search_page(offset, limit, tags=self.__parent__.tag_path)
 
 
 class SearchByTagContainer(AddingContainer):
@@ -138,12 +138,17 @@ class BoolFromUnicode(Adapter):
         return (value in ('True', 'true'))
 
 
-def model_to_dict(obj, use_titles=False, use_fields=False):
+def model_to_dict(obj, use_titles=False, use_fields=False, fields=None, exclude=()):
+    """Returns the values of the schema fields of `obj`, or only of the ones named in `fields`
+    and not in `exclude`; the others are not read at all."""
     data = OrderedDict()
     got_unauthorized = False
 
     error_attributes = []
     for key, field, schema in get_schema_fields(obj):
+        if (fields is not None and key not in fields) or key in exclude:
+            continue
+
         if use_fields:
             key = field
         elif not use_titles:
@@ -162,8 +167,9 @@ def model_to_dict(obj, use_titles=False, use_fields=False):
                         exc_info=sys.exc_info())
             continue
 
-    data['mtime'] = obj.mtime
-    data['ctime'] = obj.ctime
+    for key in ('mtime', 'ctime'):
+        if (fields is None or key in fields) and key not in exclude:
+            data[key] = getattr(obj, key)
 
     if got_unauthorized and not data:
         raise Unauthorized((obj, error_attributes, 'read'))
@@ -0,0 +1,118 @@
+"""Audit of the accesses to attributes without declared permissions.
+
+Accesses are aggregated by attribute, type and effective principals with plain counters; the
+stack is sampled, and a warning logged, only the first time an entry is seen.
+
+"""
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from opennode.oms.config import get_config
+from opennode.oms.security.principals import effective_principals
+
+
+log = logging.getLogger(__name__)
+
+_audit = None
+
+
+class AuditEntry(object):
+    __slots__ = ('count', 'first_seen', 'last_seen', 'stack')
+
+    def __init__(self, stack):
+        self.count = 0
+        self.first_seen = self.last_seen = time.time()
+        self.stack = stack
+
+
+class AttributeAudit(object):
+    """Counts the accesses to undeclared attributes, for at most `size` distinct entries; the
+    ones exceeding it are only counted as `dropped`. Counters are updated under `lock`, so they
+    are exact even with concurrent accesses."""
+
+    def __init__(self, size=10000, stack_depth=12):
+        self.size = size
+        self.stack_depth = stack_depth
+        self.entries = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def principals(self, interaction):
+        """Effective principal ids of an interaction, computed once per interaction."""
+        if interaction is None:
+            return ()
+        principals = getattr(interaction, '_audit_principals', None)
+        if principals is None:
+            principals = tuple(sorted(set(p.id for p in effective_principals(interaction))))
+            interaction._audit_principals = principals
+        return principals
+
+    def record(self, name, obj, interaction):
+        key = (name, type(obj), self.principals(interaction))
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self._first_seen(key)
+            if entry is None:
+                return
+        with self.lock:
+            entry.count += 1
+            entry.last_seen = time.time()
+
+    def _first_seen(self, key):
+        if len(self.entries) >= self.size:
+            with self.lock:
+                self.dropped += 1
+            return None
+
+        # skip the frames of the audit, of the permission dictionary and of the checker
+        stack = traceback.format_list(traceback.extract_stack(sys._getframe(4), self.stack_depth))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry
+            if len(self.entries) >= self.size:
+                self.dropped += 1
+                return None
+            entry = self.entries[key] = AuditEntry(stack)
+
+        log.warning("Audit: permissive mode; granting attribute=%s, principals=(%s), obj=%s",
+                    key[0], ','.join(key[2]), key[1].__name__)
+        return entry
+
+    def report(self, limit=0):
+        """Entries by decreasing number of accesses."""
+        with self.lock:
+            entries = [(key, entry.count, entry.first_seen, entry.last_seen, entry.stack)
+                       for key, entry in self.entries.items()]
+        entries.sort(key=lambda entry: -entry[1])
+        if limit:
+            entries = entries[:limit]
+        return [{'attribute': name,
+                 'type': '%s.%s' % (cls.__module__, cls.__name__),
+                 'principals': list(principals),
+                 'count': count,
+                 'first_seen': first_seen,
+                 'last_seen': last_seen,
+                 'stack': stack}
+                for (name, cls, principals), count, first_seen, last_seen, stack in entries]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'dropped': self.dropped,
+                    'accesses': sum(entry.count for entry in self.entries.values())}
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+            self.dropped = 0
+
+
+def attribute_audit():
+    global _audit
+    if _audit is None:
+        _audit = AttributeAudit(get_config().getint('auth', 'audit_size', 10000),
+                                get_config().getint('auth', 'audit_stack_depth', 12))
+    return _audit
@@ -1,5 +1,7 @@
+import calendar
 import grp
 import hashlib
+import hmac
 import logging
 import os
 import pkg_resources
@@ -8,18 +10,20 @@ import pwd
 import sys
 import time
 import subprocess
+import threading
 from sys import platform as _platform
 import json
 
 from base64 import decodestring as decode
 from base64 import encodestring as encode
+from collections import OrderedDict
 from contextlib import closing
 from grokcore.component import GlobalUtility, subscribe
 from twisted.cred.checkers import FilePasswordDB
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.credentials import IUsernamePassword
 from twisted.cred.error import UnauthorizedLogin
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
 from twisted.python import filepath
 from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility, provideUtility, queryUtility
@@ -35,14 +39,19 @@ from opennode.oms.core import IApplicationInitializedEvent
 from opennode.oms.config import get_config
 from opennode.oms.endpoint.ssh.pubkey import InMemoryPublicKeyCheckerDontUse
 from opennode.oms.security import acl, checker
-from opennode.oms.security.interaction import new_interaction
+from opennode.oms.security.cms import CmsError, CmsVerifier
+from opennode.oms.security.interaction import new_interaction, permissions_changed
 from opennode.oms.security.permissions import Role
 from opennode.oms.security.principals import User, Group
+from opennode.oms.zodb.profiler import RollingHistogram
 
 
 log = logging.getLogger(__name__)
 
 _checkers = None
+_credential_cache = None
+_token_cache = None
+_linux_groups = {}
 
 if _platform == "linux" or _platform == "linux2":
     from twisted.internet import inotify
@@ -51,10 +60,127 @@ if _platform == "linux" or _platform == "linux2":
 
 
 def get_linux_groups_for_user(user):
+    """Returns the names of the linux groups of `user`, remembered for the lifetime of the
+    credential cache, since enumerating all the groups is slow."""
+    cached = _linux_groups.get(user)
+    if cached is not None and cached[1] > time.time():
+        return list(cached[0])
+
     groups = [g.gr_name for g in grp.getgrall() if user in g.gr_mem]
     gid = pwd.getpwnam(user).pw_gid
     groups.append(grp.getgrgid(gid).gr_name)
-    return groups
+    _linux_groups[user] = (groups, time.time() + credential_cache().ttl)
+    return list(groups)
+
+
+class ExpiringCache(object):
+    """A bounded mapping whose entries expire after `ttl` seconds, or earlier if an expiry time is
+    given when adding them. The least recently used entries are evicted beyond `size` entries.
+
+    Items are looked up by `key(item)`.
+
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def key(self, item):
+        return item
+
+    def get(self, item):
+        key = self.key(item)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def add(self, item, value, expires=None):
+        if self.size <= 0 or self.ttl <= 0:
+            return
+        expires = min(expires or float('inf'), time.time() + self.ttl)
+        key = self.key(item)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class CredentialCache(ExpiringCache):
+    """Remembers which usernames and passwords have been successfully verified by the checkers,
+    so that the clients sending credentials with every request (e.g. basic auth) are
+    authenticated by a dictionary lookup.
+
+    Credentials are stored as keyed hashes, with a key generated at startup, so passwords are
+    never kept in memory. Failed verifications are not cached.
+
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        super(CredentialCache, self).__init__(size, ttl)
+        self.salt = os.urandom(16)
+
+    def key(self, credentials):
+        username, password = credentials.username, credentials.password
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac.new(self.salt, '%s\0%s' % (username, password), hashlib.sha256).digest()
+
+
+class TokenCache(ExpiringCache):
+    """Remembers the content of validated keystone tokens until they expire, keyed by their
+    digest. Also keeps the latency of the validations, which happen on misses."""
+
+    def __init__(self, size=1000, ttl=300):
+        super(TokenCache, self).__init__(size, ttl)
+        self.verification = RollingHistogram()
+
+    def key(self, token):
+        return hashlib.sha256(token).digest()
+
+    def stats(self):
+        return dict(super(TokenCache, self).stats(), verification=self.verification.summary())
+
+
+def credential_cache():
+    global _credential_cache
+    if _credential_cache is None:
+        _credential_cache = CredentialCache(get_config().getint('auth', 'credential_cache_size', 1000),
+                                            get_config().getint('auth', 'credential_cache_ttl', 300))
+    return _credential_cache
+
+
+def token_cache():
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = TokenCache(get_config().getint('keystone', 'token_cache_size', 1000),
+                                  get_config().getint('keystone', 'token_cache_ttl', 300))
+    return _token_cache
+
+
+def invalidate_credentials():
+    """Forgets the verified credentials and group memberships, when the users or the groups
+    are reloaded."""
+    credential_cache().clear()
+    _linux_groups.clear()
 
 
 class PamAuthChecker(object):
@@ -69,7 +195,7 @@ class PamAuthChecker(object):
             oms_user = User(credentials.username)
             oms_user.groups.extend(get_linux_groups_for_user(credentials.username))
             log.info(' Adding user groups: %s' % ', '.join(oms_user.groups))
-            for g in get_linux_groups_for_user(credentials.username):
+            for g in oms_user.groups:
                 auth.registerPrincipal(Group(g))
             auth.registerPrincipal(oms_user)
             return defer.succeed(credentials.username)
@@ -101,12 +227,21 @@ class KeystoneChecker(object):
     
         return formatted
 
-    def validate_and_parse_keystone_token(self, cms_token):
-        """Validate Keystone CMS token.
-
-        Partially taken from Keystone's common/cms.py module."""
+    def verify_cms(self, cms_token):
+        """Returns the content of the token if its signature is valid, verified in process when
+        `in_process_verification` is enabled and libcrypto can be used, otherwise by the openssl
+        command."""
         signing_cert_file_name = get_config().get('keystone', 'signing_cert_file_name')
         ca_file_name = get_config().get('keystone', 'ca_file_name')
+
+        verifier = self.in_process_verifier(signing_cert_file_name, ca_file_name)
+        if verifier is not None:
+            try:
+                return verifier.verify(self.token_to_cms(cms_token))
+            except CmsError as e:
+                log.info('Token validation has failed: %s' % e)
+                raise UnauthorizedLogin()
+
         openssl_cmd = get_config().get('keystone', 'openssl_cmd')
         process = subprocess.Popen([openssl_cmd, "cms", "-verify",
                                   "-certfile",
@@ -123,25 +258,63 @@ class KeystoneChecker(object):
         if retcode:
             log.info('Token validation has failed, return code: %s' % retcode)
             raise UnauthorizedLogin()
+        return output
+
+    _verifiers = {}
+    _verifiers_lock = threading.Lock()
+
+    def in_process_verifier(self, signing_cert_file_name, ca_file_name):
+        if not get_config().getboolean('keystone', 'in_process_verification', False):
+            return None
+
+        key = (signing_cert_file_name, ca_file_name)
+        with self._verifiers_lock:
+            if key not in self._verifiers:
+                try:
+                    self._verifiers[key] = CmsVerifier(signing_cert_file_name, ca_file_name)
+                except (CmsError, IOError) as e:
+                    log.warning('Cannot verify Keystone tokens in process, using openssl: %s' % e)
+                    self._verifiers[key] = None
+            return self._verifiers[key]
+
+    def validate_and_parse_keystone_token(self, cms_token):
+        """Validate Keystone CMS token.
+
+        Partially taken from Keystone's common/cms.py module."""
+        started = time.time()
+        try:
+            output = self.verify_cms(cms_token)
+        finally:
+            token_cache().verification.record(time.time() - started)
+
         token_info = json.loads(output)
         #print json.dumps(token_info, sort_keys=True,
         #          indent=4, separators=(',', ': '))
         res = {'username': str(token_info['access']['user']['username']),
-               'groups': [str(token_info['access']['token']['tenant']['name'])]}
+               'groups': [str(token_info['access']['token']['tenant']['name'])],
+               'expires': parse_keystone_time(token_info['access']['token'].get('expires'))}
         return res
 
-
+    @defer.inlineCallbacks
     def requestAvatarId(self, token):
-        # validate credential signature
-        token_info = None
-        try:
-            token_info = self.validate_and_parse_keystone_token(token)
+        # validate credential signature, unless the token has already been validated
+        token_info = token_cache().get(token)
+        if token_info is None:
+            try:
+                # spawning openssl blocks
+                token_info = yield threads.deferToThread(self.validate_and_parse_keystone_token, token)
+            except Exception:
+                log.debug('Exception while validating Keystone token', exc_info=True)
+                log.warning('Authentication failed with Keystone token')
+                raise UnauthorizedLogin('Invalid credentials')
+
+            if token_info['expires'] is not None and token_info['expires'] <= time.time():
+                log.warning('Authentication failed with expired Keystone token')
+                raise UnauthorizedLogin('Expired token')
+
+            token_cache().add(token, token_info, token_info['expires'])
             log.info('Successful login with Keystone token, extracted data: %s' % token_info)
             log.debug('Token: %s' % token)
-        except Exception:
-            log.debug('Exception while validating Keystone token', exc_info=True)
-            log.warning('Authentication failed with Keystone token')
-            return defer.fail(UnauthorizedLogin('Invalid credentials'))
 
         # extract avatar info from the token
         auth = getUtility(IAuthentication)
@@ -152,7 +325,16 @@ class KeystoneChecker(object):
         for g in oms_user.groups:
             auth.registerPrincipal(Group(g))
         auth.registerPrincipal(oms_user)
-        return defer.succeed(token_info['username'])
+        defer.returnValue(token_info['username'])
+
+
+def parse_keystone_time(value):
+    """Returns the seconds since the epoch of a keystone UTC timestamp, such as
+    2013-06-26T16:38:12Z, or None if it's missing or not valid."""
+    try:
+        return calendar.timegm(time.strptime(value.rstrip('Z').split('.')[0], '%Y-%m-%dT%H:%M:%S'))
+    except (AttributeError, ValueError):
+        return None
 
 
 class AuthenticationUtility(GlobalUtility):
@@ -202,6 +384,25 @@ def checkers():
     return _checkers
 
 
+def verify_credentials(credentials):
+    """Returns the avatar id of the first checker accepting `credentials`, or None.
+
+    Blocks until the checkers have answered, it's meant to be run in a thread.
+
+    """
+    for i in checkers():
+        log.debug('Authenticating using %s on %s' % (i, credentials.username))
+        d = i.requestAvatarId(credentials)
+        try:
+            # asynchronous checkers answer in the reactor thread, wait there for their result
+            avatar = threads.blockingCallFromThread(reactor, lambda: d)
+        except UnauthorizedLogin:
+            log.warning('Authentication failed with %s on %s!' % (i, credentials.username))
+            continue
+        log.debug('Authentication successful using %s on %s!' % (i, credentials.username))
+        return avatar
+
+
 def setup_conf_reload_watch(path, handler):
     """Registers a inotify watch which will invoke `handler` for passing the open file"""
 
@@ -230,6 +431,7 @@ def setup_roles(event):
 
 def reload_roles(stream):
     log.info("(Re)Loading OMS permission definitions")
+    permissions_changed()
     for line in stream:
         nick, role, permissions = line.split(':', 4)
         oms_role = Role(role, nick)
@@ -237,6 +439,7 @@ def reload_roles(stream):
         for perm in permissions.split(','):
             if perm.strip():
                 rolePermissionManager.grantPermissionToRole(perm.strip(), role.strip())
+    permissions_changed()
 
 
 @subscribe(IApplicationInitializedEvent)
@@ -258,6 +461,8 @@ def setup_groups(event):
 def reload_groups(stream):
     log.info("(Re)Loading OMS groups definitions")
 
+    invalidate_credentials()
+    permissions_changed()
     auth = queryUtility(IAuthentication)
 
     for line in stream:
@@ -272,6 +477,7 @@ def reload_groups(stream):
             for role in roles.split(','):
                 if role.strip():
                     principalRoleManager.assignRoleToPrincipal(role.strip(), group.strip())
+    permissions_changed()
 
 
 @subscribe(IApplicationInitializedEvent)
@@ -347,6 +553,8 @@ def create_special_principals():
 def reload_users(stream):
     log.info("(Re)Loading OMS users definitions")
 
+    invalidate_credentials()
+    permissions_changed()
     create_special_principals()
     auth = queryUtility(IAuthentication)
 
@@ -367,6 +575,7 @@ def reload_users(stream):
             oms_user.groups = [group.strip() for group in groups.split(',') if group.strip()]
             log.debug('Loaded %s', oms_user)
             auth.registerPrincipal(oms_user)
+    permissions_changed()
 
 
 class Sudo(object):
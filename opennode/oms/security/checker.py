@@ -1,4 +1,3 @@
-import inspect
 import logging
 
 from collections import defaultdict
@@ -11,7 +10,7 @@ from zope.security.checker import CheckerPublic, TracebackSupplement, getChecker
 from zope.security.interfaces import INameBasedChecker, Unauthorized, ForbiddenAttribute
 
 from opennode.oms.config import get_config
-from opennode.oms.security.principals import effective_principals
+from opennode.oms.security.audit import attribute_audit
 
 
 log = logging.getLogger(__name__)
@@ -42,40 +41,43 @@ def get_interaction(obj):
 
 
 class AuditingPermissionDictionary(dict):
-    marker = object()
-
-    seen = {}
+    """Permission table granting access to undeclared attributes, whose accesses are recorded
+    by the checker in the attribute audit (see opennode.oms.security.audit)."""
 
     def __getitem__(self, key):
         return self.get(key)
 
     def get(self, key, default=None):
-        val = super(AuditingPermissionDictionary, self).get(key, self.marker)
-        if val is self.marker:
-            if key not in _available_by_default:
-                checker_locals = inspect.getouterframes(inspect.currentframe())[1][0].f_locals
-                checker = checker_locals['self']
-                principals = effective_principals(checker.interaction)
-                seen_key = (key, ','.join(i.id for i in principals), type(checker_locals['obj']).__name__)
-                if seen_key not in self.seen:
-                    log.warning("Audit: permissive mode; granting attribute=%s, principals=(%s), obj=%s" %
-                                seen_key)
-                    self.seen[seen_key] = True
-            return CheckerPublic
-        return val
+        return super(AuditingPermissionDictionary, self).get(key, CheckerPublic)
 
+    def audit(self, key, obj, interaction):
+        if key not in self and key not in _available_by_default:
+            attribute_audit().record(key, obj, interaction)
 
-def _select_checker(value, interaction):
-    checker = getCheckerForInstancesOf(type(value))
-    if not checker:
-        if get_config().getboolean('auth', 'enforce_attribute_rights_definition'):
-            perms = {}
-        else:
-            if get_config().getboolean('auth', 'audit_all_missing_attribute_rights_definitions'):
-                perms = AuditingPermissionDictionary()
-            else:
-                perms = strong_defaultdict(lambda: CheckerPublic)
 
+_shared_permissions = {}
+
+
+def _default_permissions():
+    """Permission table for types which don't declare their attribute rights, shared by all
+    the checkers for them."""
+    if get_config().getboolean('auth', 'enforce_attribute_rights_definition'):
+        mode, factory = 'enforce', dict
+    elif get_config().getboolean('auth', 'audit_all_missing_attribute_rights_definitions'):
+        mode, factory = 'audit', AuditingPermissionDictionary
+    else:
+        mode, factory = 'permissive', lambda: strong_defaultdict(lambda: CheckerPublic)
+
+    perms = _shared_permissions.get(mode)
+    if perms is None:
+        perms = _shared_permissions.setdefault(mode, factory())
+    return perms
+
+
+def _new_checker(cls, interaction):
+    checker = getCheckerForInstancesOf(cls)
+    if not checker:
+        perms = _default_permissions()
         return Checker(perms, perms, interaction=interaction)
 
     # handle checkers for "primitive" types like str
@@ -85,6 +87,23 @@ def _select_checker(value, interaction):
     return Checker(checker.get_permissions, checker.set_permissions, interaction=interaction)
 
 
+def _select_checker(value, interaction):
+    """Checkers only depend on the type of the value and on the interaction, so they are
+    created once per type and kept on the interaction, which lives as long as the request or
+    the shell session."""
+    cls = type(value)
+    checkers = getattr(interaction, '_checkers', None)
+    if checkers is None:
+        if interaction is None:
+            return _new_checker(cls, interaction)
+        checkers = interaction._checkers = {}
+
+    checker = checkers.get(cls)
+    if checker is None:
+        checker = checkers[cls] = _new_checker(cls, interaction)
+    return checker
+
+
 def proxy_factory(value, interaction):
     if type(value) is Proxy:
         return value
@@ -118,6 +137,7 @@ class Checker(object):
         self.set_permissions = set_permissions
 
         self.interaction = interaction
+        self.audit = getattr(get_permissions, 'audit', None)
 
     def permission_id(self, name):
         'See INameBasedChecker'
@@ -149,6 +169,8 @@ class Checker(object):
     def check_setattr(self, obj, name):
         'See IChecker'
         permission = self.set_permissions.get(name)
+        if self.audit is not None:
+            self.audit(name, obj, self.interaction)
         self._checkPermission(obj, name, permission)
 
     def check(self, obj, name):
@@ -156,6 +178,8 @@ class Checker(object):
         permission = self.get_permissions.get(name)
         if permission is None and name in _available_by_default:
             return
+        if self.audit is not None:
+            self.audit(name, obj, self.interaction)
         self._checkPermission(obj, name, permission)
 
     def proxy(self, value):
@@ -0,0 +1,155 @@
+"""In-process verification of CMS signed data, as done by `openssl cms -verify`, through the
+libcrypto shared library.
+
+The trusted CA and the signing certificates are loaded once, instead of for every verification.
+If libcrypto cannot be loaded `CmsVerifier` raises CmsError when created and callers are expected
+to fall back to the openssl command.
+
+"""
+import ctypes
+import ctypes.util
+import threading
+
+
+BIO_CTRL_INFO = 3
+
+# as `openssl cms -verify -nocerts -noattr -nosmimecap`: only the given signing certificates are
+# used, not the ones possibly carried by the message
+CMS_NOINTERN = 0x10
+CMS_NOATTR = 0x100
+CMS_NOSMIMECAP = 0x200
+
+_libcrypto = None
+_lock = threading.Lock()
+
+
+class CmsError(Exception):
+    pass
+
+
+def _load_libcrypto():
+    global _libcrypto
+    with _lock:
+        if _libcrypto is not None:
+            return _libcrypto
+
+        path = ctypes.util.find_library('crypto')
+        if path is None:
+            raise CmsError('libcrypto not found')
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError as e:
+            raise CmsError('Cannot load %s: %s' % (path, e))
+
+        p, i = ctypes.c_void_p, ctypes.c_int
+        signatures = {'BIO_new_mem_buf': (p, [ctypes.c_char_p, i]),
+                      'BIO_s_mem': (p, []),
+                      'BIO_new': (p, [p]),
+                      'BIO_free': (i, [p]),
+                      'BIO_ctrl': (ctypes.c_long, [p, i, ctypes.c_long, p]),
+                      'PEM_read_bio_CMS': (p, [p, p, p, p]),
+                      'CMS_ContentInfo_free': (None, [p]),
+                      'CMS_verify': (i, [p, p, p, p, p, ctypes.c_uint]),
+                      'PEM_read_bio_X509': (p, [p, p, p, p]),
+                      'X509_free': (None, [p]),
+                      'X509_STORE_new': (p, []),
+                      'X509_STORE_free': (None, [p]),
+                      'X509_STORE_load_locations': (i, [p, ctypes.c_char_p, ctypes.c_char_p]),
+                      'ERR_get_error': (ctypes.c_ulong, []),
+                      'ERR_clear_error': (None, []),
+                      'ERR_error_string_n': (None, [ctypes.c_ulong, ctypes.c_char_p, ctypes.c_size_t])}
+        # the generic stack functions have been renamed in OpenSSL 1.1
+        prefix = 'OPENSSL_' if hasattr(lib, 'OPENSSL_sk_new_null') else ''
+        stack = {'sk_new_null': (p, []), 'sk_push': (i, [p, p]), 'sk_free': (None, [p])}
+
+        try:
+            for name, (restype, argtypes) in signatures.items():
+                getattr(lib, name).restype = restype
+                getattr(lib, name).argtypes = argtypes
+            for name, (restype, argtypes) in stack.items():
+                fun = getattr(lib, prefix + name)
+                fun.restype, fun.argtypes = restype, argtypes
+                setattr(lib, '_' + name, fun)
+        except AttributeError as e:
+            raise CmsError('Unsupported libcrypto: %s' % e)
+
+        _libcrypto = lib
+        return lib
+
+
+def _error(lib, message):
+    code = lib.ERR_get_error()
+    lib.ERR_clear_error()
+    if code:
+        buf = ctypes.create_string_buffer(256)
+        lib.ERR_error_string_n(code, buf, len(buf))
+        message = '%s: %s' % (message, buf.value)
+    return CmsError(message)
+
+
+class CmsVerifier(object):
+    """Verifies PEM encoded CMS signed data against a CA file, with the signing certificates
+    given in a separate file (the message doesn't need to carry them), and returns the signed
+    content. Instances can be shared between threads.
+
+    """
+
+    flags = CMS_NOINTERN | CMS_NOATTR | CMS_NOSMIMECAP
+
+    def __init__(self, signing_cert_file, ca_file):
+        self.lib = lib = _load_libcrypto()
+        self.store = self.certs = None
+        self.cert_list = []
+
+        self.store = lib.X509_STORE_new()
+        if not self.store or lib.X509_STORE_load_locations(self.store, ca_file, None) != 1:
+            raise _error(lib, 'Cannot load the CA certificates from %s' % ca_file)
+
+        with open(signing_cert_file) as f:
+            pem = f.read()
+        self.certs = lib._sk_new_null()
+        bio = lib.BIO_new_mem_buf(pem, len(pem))
+        try:
+            while True:
+                cert = lib.PEM_read_bio_X509(bio, None, None, None)
+                if not cert:
+                    break
+                self.cert_list.append(cert)
+                lib._sk_push(self.certs, cert)
+        finally:
+            lib.BIO_free(bio)
+        # reading stops with an "end of file" error
+        lib.ERR_clear_error()
+
+    def verify(self, pem):
+        """Returns the content signed by `pem`, raises CmsError if the signature or the signing
+        certificate are not valid."""
+        lib = self.lib
+        cms = out = None
+        bio = lib.BIO_new_mem_buf(pem, len(pem))
+        try:
+            cms = lib.PEM_read_bio_CMS(bio, None, None, None)
+            if not cms:
+                raise _error(lib, 'Invalid CMS message')
+
+            out = lib.BIO_new(lib.BIO_s_mem())
+            if lib.CMS_verify(cms, self.certs, self.store, None, out, self.flags) != 1:
+                raise _error(lib, 'CMS verification failed')
+
+            data = ctypes.c_void_p()
+            length = lib.BIO_ctrl(out, BIO_CTRL_INFO, 0, ctypes.byref(data))
+            return ctypes.string_at(data, length) if length > 0 else ''
+        finally:
+            if cms:
+                lib.CMS_ContentInfo_free(cms)
+            if out:
+                lib.BIO_free(out)
+            lib.BIO_free(bio)
+
+    def __del__(self):
+        for cert in self.cert_list:
+            self.lib.X509_free(cert)
+        if self.certs:
+            self.lib._sk_free(self.certs)
+        if self.store:
+            self.lib.X509_STORE_free(self.store)
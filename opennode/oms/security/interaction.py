@@ -1,4 +1,9 @@
 import inspect
+import os
+import threading
+import time
+
+from collections import OrderedDict
 
 from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility
@@ -11,6 +16,8 @@ from zope.securitypolicy.interfaces import IPrincipalRoleMap
 from zope.securitypolicy.interfaces import IPrincipalPermissionMap
 from zope.securitypolicy.zopepolicy import ZopeSecurityPolicy
 
+from opennode.oms.config import get_config
+
 from zope.securitypolicy.principalpermission import principalPermissionManager
 globalPrincipalPermissionSetting = principalPermissionManager.getSetting
 
@@ -22,6 +29,115 @@ globalRolesForPrincipal = principalRoleManager.getRolesForPrincipal
 
 SettingAsBoolean = {Allow: True, Deny: False, Unset: None, None: None}
 
+_decisions = None
+
+# identifies the global roles, groups and users loaded by this process, and when they were loaded
+_generation = [os.urandom(4).encode('hex'), 0, time.time()]
+
+
+def permission_versions(obj):
+    """Returns the oids and serials of the persistent objects a permission decision on `obj`
+    depends on: `obj` and the parents it inherits permissions from, with their annotations,
+    where roles and permissions are stored.
+
+    Returns None if any of them is not persistent or has been changed in the current
+    transaction, in which case decisions on `obj` cannot be reused.
+
+    """
+    versions = []
+    while obj is not None:
+        if getattr(obj, '_p_oid', None) is None:
+            return None
+        annotations = getattr(obj, '__annotations__', None)
+        for value in [obj] + ([annotations] + list(annotations.values()) if annotations else []):
+            if getattr(value, '_p_oid', None) is None:
+                continue
+            if value._p_changed is None:
+                value._p_activate()
+            if value._p_changed:
+                return None
+            versions.append((value._p_oid, value._p_serial))
+
+        if not getattr(obj, 'inherit_permissions', False):
+            break
+        obj = removeSecurityProxy(getattr(obj, '__parent__', None))
+    return tuple(versions)
+
+
+class PermissionDecisionCache(object):
+    """Permission decisions shared by all the interactions, keyed by principal, groups, object
+    oid and permission.
+
+    Each decision is stored along with the serials of the objects it has been computed from (see
+    `permission_versions`), so that a change of the roles or permissions of an object, of its
+    `inherit_permissions` flag or of its parent invalidates precisely the decisions depending on
+    it. Changes to the global roles and permissions, i.e. reloading the roles, groups or users
+    files, have to `clear` the cache. The least recently used decisions are evicted beyond
+    `size` entries.
+
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.decisions = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.bypassed = self.invalidations = 0
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.decisions.pop(key, None)
+            if entry is None or entry[1] != versions:
+                self.misses += 1
+                return None
+            self.decisions[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, versions, decision):
+        with self.lock:
+            self.decisions.pop(key, None)
+            self.decisions[key] = (decision, versions)
+            while len(self.decisions) > self.size:
+                self.decisions.popitem(last=False)
+
+    def bypass(self):
+        with self.lock:
+            self.bypassed += 1
+
+    def clear(self):
+        with self.lock:
+            self.decisions.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.decisions), 'hits': self.hits, 'misses': self.misses,
+                    'bypassed': self.bypassed, 'invalidations': self.invalidations,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+def permission_cache():
+    global _decisions
+    if _decisions is None:
+        _decisions = PermissionDecisionCache(get_config().getint('auth', 'permission_cache_size', 100000))
+    return _decisions
+
+
+def permissions_generation():
+    """Returns an identifier which changes whenever the global roles, groups or users are
+    reloaded, and the time of the last reload, so that anything depending on the permissions of
+    the principals (e.g. HTTP cache validators) can tell."""
+    return '%s:%s' % tuple(_generation[:2]), _generation[2]
+
+
+def permissions_changed():
+    """To be called when the global roles, groups or users are reloaded, both before and after
+    loading them, so that no decision taken while loading is kept."""
+    _generation[1] += 1
+    _generation[2] = time.time()
+    permission_cache().clear()
+
 
 class OmsSecurityPolicy(ZopeSecurityPolicy):
     """A Security Policy represents an interaction with a principal
@@ -62,6 +178,32 @@ class OmsSecurityPolicy(ZopeSecurityPolicy):
     def __exit__(self, *args):
         del thread_local.interaction
 
+    def cached_decision(self, parent, principal, groups, permission):
+        # the decisions taken by this interaction come first, the shared ones only on a miss
+        interaction_cache = self.cache(parent)
+        try:
+            return interaction_cache.decision[principal][permission]
+        except (AttributeError, KeyError):
+            pass
+
+        versions = permission_versions(parent)
+        if versions is None:
+            permission_cache().bypass()
+            return super(OmsSecurityPolicy, self).cached_decision(parent, principal, groups, permission)
+
+        cache = permission_cache()
+        key = (principal, groups, parent._p_oid, permission)
+        decision = cache.get(key, versions)
+        if decision is None:
+            # also remembered by this interaction
+            decision = super(OmsSecurityPolicy, self).cached_decision(parent, principal, groups, permission)
+            cache.put(key, versions, decision)
+        else:
+            if not hasattr(interaction_cache, 'decision'):
+                interaction_cache.decision = {}
+            interaction_cache.decision.setdefault(principal, {})[permission] = decision
+        return decision
+
     def cached_prinper(self, parent, principal, groups, permission):
         cache = self.cache(parent)
         try:
@@ -0,0 +1,156 @@
+"""Registry of the sessions of the REST API.
+
+A session starts when a user authenticates and lives as long as the tokens identifying it are
+renewed. Sessions can be revoked, after which their tokens are refused even if they haven't
+expired yet. The registry is kept in memory only: revocations are lost on restart, and the tokens
+of revoked sessions are accepted again until they expire.
+
+"""
+import math
+import os
+import threading
+import time
+
+from opennode.oms.config import get_config
+
+
+_registry = None
+
+
+class TimingWheel(object):
+    """Schedules keys to expire at a given time, with a resolution of `tick` seconds.
+
+    Scheduling and cancelling are constant time; `advance` collects the keys whose time has come
+    by looking only at the slots elapsed since the previous call.
+
+    """
+
+    def __init__(self, tick=1.0):
+        self.tick = float(tick)
+        self.slots = {}
+        self.deadlines = {}
+        self.current = None
+
+    def schedule(self, key, when):
+        self.cancel(key)
+        slot = int(math.ceil(when / self.tick))
+        if self.current is not None:
+            slot = max(slot, self.current)
+        self.slots.setdefault(slot, set()).add(key)
+        self.deadlines[key] = slot
+
+    def cancel(self, key):
+        slot = self.deadlines.pop(key, None)
+        if slot is not None:
+            bucket = self.slots[slot]
+            bucket.discard(key)
+            if not bucket:
+                del self.slots[slot]
+
+    def advance(self, now):
+        """Returns the keys which expired up to `now`."""
+        now_slot = int(math.floor(now / self.tick))
+        if self.current is None:
+            self.current = min(self.slots) if self.slots else now_slot
+
+        if now_slot - self.current > len(self.slots):
+            # after a long pause it's faster to look at the scheduled slots
+            elapsed = sorted(slot for slot in self.slots if slot <= now_slot)
+        else:
+            elapsed = xrange(self.current, now_slot + 1)
+
+        expired = []
+        for slot in elapsed:
+            for key in self.slots.pop(slot, ()):
+                del self.deadlines[key]
+                expired.append(key)
+        self.current = max(self.current, now_slot + 1)
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+class Session(object):
+    __slots__ = ('id', 'principal', 'created', 'expires')
+
+    def __init__(self, id, principal, created, expires):
+        self.id = id
+        self.principal = principal
+        self.created = created
+        self.expires = expires
+
+
+class SessionRegistry(object):
+    """Keeps the active sessions until their last token expires, and the revoked ones until
+    their tokens would have expired.
+
+    Sessions unknown to the registry, e.g. started before a restart, are registered again when
+    one of their valid tokens is seen.
+
+    """
+
+    def __init__(self, tick=1.0):
+        self.sessions = {}
+        self.revoked = {}
+        self.wheel = TimingWheel(tick)
+        self.lock = threading.Lock()
+
+    def new_session_id(self):
+        return os.urandom(12).encode('hex')
+
+    def register(self, session_id, principal, expires):
+        """Starts or extends a session, returns False if it has been revoked."""
+        with self.lock:
+            self._expire(time.time())
+            if session_id in self.revoked:
+                return False
+
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(session_id, principal, time.time(), expires)
+            session.expires = max(session.expires, expires)
+            self.wheel.schedule(session_id, session.expires)
+            return True
+
+    def is_revoked(self, session_id):
+        with self.lock:
+            self._expire(time.time())
+            return session_id in self.revoked
+
+    def revoke(self, session_id, expires=None):
+        """Refuses the tokens of the session from now on."""
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if expires is None:
+                expires = (session.expires if session is not None else
+                           time.time() + get_config().getint('auth', 'token_ttl'))
+            self.revoked[session_id] = expires
+            self.wheel.schedule(session_id, expires)
+
+    def revoke_principal(self, principal):
+        for session in self.active(principal):
+            self.revoke(session.id)
+
+    def active(self, principal=None):
+        with self.lock:
+            self._expire(time.time())
+            return [session for session in self.sessions.values()
+                    if principal is None or session.principal == principal]
+
+    def _expire(self, now):
+        for session_id in self.wheel.advance(now):
+            self.sessions.pop(session_id, None)
+            self.revoked.pop(session_id, None)
+
+    def stats(self):
+        with self.lock:
+            self._expire(time.time())
+            return {'active': len(self.sessions), 'revoked': len(self.revoked)}
+
+
+def session_registry():
+    global _registry
+    if _registry is None:
+        _registry = SessionRegistry()
+    return _registry
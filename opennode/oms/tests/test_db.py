@@ -0,0 +1,234 @@
+import time
+import transaction
+import unittest
+
+from ZODB.POSException import ConflictError, ReadConflictError
+from nose.tools import eq_
+from twisted.internet import defer
+
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+from opennode.oms.zodb.profiler import RollingHistogram, get_profiles, _profiles
+from opennode.oms.zodb.retry import RetryPolicy, ConflictHotSpots, hotspots
+
+
+def read(key):
+    res = []
+    db.ro_transact(lambda: db.get_root().get(key))().addCallback(res.append)
+    return res[0]
+
+
+class AsyncTransactTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_commit_after_deferred(self):
+        d0 = defer.Deferred()
+
+        @db.async_transact
+        def store():
+            root = db.get_root()
+            value = yield d0
+            root['async_test'] = value
+            defer.returnValue(value)
+
+        res = []
+        store().addCallback(res.append)
+        eq_(res, [])
+        eq_(read('async_test'), None)
+
+        d0.callback('value')
+        eq_(res, ['value'])
+        eq_(read('async_test'), 'value')
+
+    @run_in_reactor
+    @clean_db
+    def test_abort_on_failure(self):
+        @db.async_transact
+        def store():
+            db.get_root()['async_fail'] = 'value'
+            yield defer.fail(ValueError('boom'))
+
+        errors = []
+        store().addErrback(lambda f: errors.append(f.trap(ValueError)))
+        eq_(errors, [ValueError])
+        eq_(read('async_fail'), None)
+
+    @run_in_reactor
+    @clean_db
+    def test_exception_thrown_into_generator(self):
+        @db.async_transact
+        def store():
+            try:
+                yield defer.fail(ValueError('boom'))
+            except ValueError:
+                db.get_root()['async_recovered'] = True
+
+        store()
+        eq_(read('async_recovered'), True)
+
+    @run_in_reactor
+    @clean_db
+    def test_rollback_value(self):
+        @db.async_transact
+        def store():
+            db.get_root()['async_rollback'] = 'value'
+            yield defer.succeed(None)
+            defer.returnValue(db.RollbackValue('result'))
+
+        res = []
+        store().addCallback(res.append)
+        eq_(res, ['result'])
+        eq_(read('async_rollback'), None)
+
+    @run_in_reactor
+    @clean_db
+    def test_read_only(self):
+        @db.async_ro_transact
+        def store():
+            db.get_root()['async_ro'] = 'value'
+            value = yield defer.succeed(db.get_root()['async_ro'])
+            defer.returnValue(value)
+
+        res = []
+        store().addCallback(res.append)
+        eq_(res, ['value'])
+        eq_(read('async_ro'), None)
+
+        profile = [p for p in get_profiles() if p.name.endswith('.store') and p.kind == 'ro'][0]
+        eq_((profile.calls, profile.commit.count), (1, 0))
+
+    def test_connection_pool_sized_to_lanes(self):
+        lanes = sum(db.get_lane(lane).threadpool.max for lane in db._default_lane_sizes)
+        assert db._db.getPoolSize() >= lanes
+
+
+class TransactionProfilerTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_records_calls_and_timings(self):
+        @db.transact
+        def profiled_store(value):
+            db.get_root()['profiled'] = value
+
+        profiled_store(1)
+        profiled_store(2)
+
+        profile = [p for p in get_profiles() if p.name.endswith('.profiled_store')][0]
+        eq_(profile.calls, 2)
+        eq_(profile.conflicts, 0)
+        eq_(profile.execution.count, 2)
+        eq_(profile.commit.count, 2)
+
+    @run_in_reactor
+    @clean_db
+    def test_functions_decorated_on_the_fly_share_a_profile(self):
+        profiles = len(_profiles)
+        for i in range(10):
+            read('profiled')
+        assert len(_profiles) - profiles <= 1
+
+    def test_rolling_histogram(self):
+        h = RollingHistogram(size=3)
+        for i in [5, 1, 2, 3]:
+            h.record(i)
+
+        eq_(h.count, 4)
+        eq_(h.total, 11)
+        eq_(h.percentile(50), 2)
+        eq_(h.max(), 3)
+
+
+class ConflictingDataManager(object):
+    """Joins a transaction and fails its commit with a conflict for the first `failures` times."""
+
+    transaction_manager = transaction.manager
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def commit(self, t):
+        if self.failures:
+            self.failures -= 1
+            raise ConflictError(oid='\0' * 7 + '\1')
+
+    def abort(self, t):
+        pass
+
+    tpc_begin = tpc_vote = tpc_finish = tpc_abort = abort
+
+    def sortKey(self):
+        return 'conflicting'
+
+
+class ConflictRetryTestCase(unittest.TestCase):
+
+    def test_policy_budget(self):
+        policy = RetryPolicy(retries=2, base_delay=0.1, max_delay=0.3, deadline=0)
+        for attempt in xrange(2):
+            assert 0 <= policy.next_delay(attempt, 0) <= min(0.3, 0.1 * 2 ** attempt)
+        eq_(policy.next_delay(2, 0), None)
+
+        policy = RetryPolicy(retries=10, base_delay=0.1, deadline=1.0)
+        eq_(policy.next_delay(0, 1.5), None)
+
+    def test_hotspots(self):
+        spots = ConflictHotSpots(max_entries=2)
+        spots.record(ConflictError(oid='\0' * 7 + '\1'), 'a')
+        spots.record(ConflictError(oid='\0' * 7 + '\1'), 'b')
+        spots.record(ReadConflictError(oid='\0' * 7 + '\2'), 'a')
+        spots.record(ConflictError(oid='\0' * 7 + '\3'), 'a')
+
+        top = spots.top()
+        eq_(len(top), 2)
+        eq_((top[0]['oid'], top[0]['count'], top[0]['write']), ('0x01', 2, 2))
+        eq_(top[0]['functions'], {'a': 1, 'b': 1})
+
+    @run_in_reactor
+    @clean_db
+    def test_retry_conflicting_commit(self):
+        dm = ConflictingDataManager(failures=2)
+        hotspots.reset()
+
+        @db.transact(retry_policy=RetryPolicy(retries=2, base_delay=0))
+        def conflicting():
+            transaction.get().join(dm)
+            db.get_root()['conflicting'] = True
+
+        conflicting()
+        eq_(dm.failures, 0)
+        eq_(read('conflicting'), True)
+        eq_(hotspots.top()[0]['count'], 2)
+
+    @run_in_reactor
+    @clean_db
+    def test_give_up(self):
+        dm = ConflictingDataManager(failures=2)
+
+        @db.transact(retry_policy=RetryPolicy(retries=1, base_delay=0))
+        def conflicting():
+            transaction.get().join(dm)
+            db.get_root()['conflicting'] = True
+
+        errors = []
+        conflicting().addErrback(lambda f: errors.append(f.trap(ConflictError)))
+        eq_(errors, [ConflictError])
+        eq_(read('conflicting'), None)
+
+    @run_in_reactor
+    @clean_db
+    def test_backoff_doesnt_block(self):
+        dm = ConflictingDataManager(failures=5)
+
+        @db.transact(retry_policy=RetryPolicy(retries=1, base_delay=1, max_delay=1, deadline=0))
+        def conflicting():
+            transaction.get().join(dm)
+            db.get_root()['conflicting'] = True
+
+        # the retry is scheduled in the reactor instead of sleeping in the thread
+        started = time.time()
+        d = conflicting()
+        assert time.time() - started < 1
+        eq_((d.called, dm.failures), (False, 4))
+        d.addErrback(lambda f: f.trap(ConflictError))
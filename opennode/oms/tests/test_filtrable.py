@@ -0,0 +1,49 @@
+import unittest
+
+from nose.tools import eq_, assert_raises
+
+from opennode.oms.model.model.filtrable import IFiltrable, compile_query
+from opennode.oms.tests.test_compute import Compute
+
+
+class FiltrableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.computes = [Compute(u'web1', u'active', memory=2048),
+                         Compute(u'db1', u'inactive', memory=512),
+                         Compute(u'web2', u'suspended')]
+
+    def matching(self, query):
+        return [c.hostname for c in self.computes if IFiltrable(c).match(query)]
+
+    def test_terms(self):
+        eq_(self.matching(u'web'), [u'web1', u'web2'])
+        eq_(self.matching(u'hostname:web state:active'), [u'web1'])
+        eq_(self.matching(u'memory>=512 memory<2048'), [u'db1'])
+        eq_(self.matching(u'memory:512'), [u'db1'])
+        eq_(self.matching(u'memory>big'), [])
+        eq_(self.matching(u''), [u'web1', u'db1', u'web2'])
+
+    def test_boolean_operators(self):
+        eq_(self.matching(u'state:inactive OR state:suspended'), [u'db1', u'web2'])
+        eq_(self.matching(u'NOT hostname:web'), [u'db1'])
+        eq_(self.matching(u'web AND NOT (state:active OR memory>4096)'), [u'web2'])
+
+    def test_quoting(self):
+        self.computes[0].hostname = u'web (OR) 1'
+        eq_(self.matching(u'hostname:"web (OR)"'), [u'web (OR) 1'])
+        eq_(self.matching(u'hostname:"OR" OR db'), [u'web (OR) 1', u'db1'])
+
+        query = compile_query(u'hostname:"a b" "c:d"')
+        eq_(unicode(query), u'hostname:"a b" "c:d"')
+        eq_(unicode(compile_query(unicode(query))), unicode(query))
+        assert_raises(ValueError, compile_query, u'hostname:"web')
+
+    def test_compiled_once(self):
+        query = compile_query(u'hostname:web OR memory<1024')
+        eq_(compile_query(query), query)
+        eq_(unicode(query), u'(hostname:web OR memory<1024)')
+        eq_([c.hostname for c in self.computes if IFiltrable(c).match(query)], [u'web1', u'db1', u'web2'])
+
+        for invalid in [u'(web', u'web)', u'NOT', u'web OR']:
+            assert_raises(ValueError, compile_query, invalid)
@@ -0,0 +1,399 @@
+import json
+import transaction
+import unittest
+
+from cStringIO import StringIO
+from nose.tools import eq_, assert_raises
+from twisted.web.http import NOT_MODIFIED, datetimeToString
+from twisted.web.server import Request
+from twisted.web.test.requesthelper import DummyChannel
+from zope.authentication.interfaces import IAuthentication
+from zope.component import getUtility
+from zope.securitypolicy.interfaces import IPrincipalRoleManager
+from zope.securitypolicy.principalpermission import principalPermissionManager
+
+from opennode.oms.endpoint.httprest.base import IHttpRestView
+from opennode.oms.endpoint.httprest.conditional import check_not_modified
+from opennode.oms.endpoint.httprest.root import HttpRestServer, Forbidden
+from opennode.oms.model.model.base import ReadonlyContainer
+from opennode.oms.security.interaction import new_interaction, permissions_changed
+from opennode.oms.security.principals import User
+from opennode.oms.tests.test_compute import Compute
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+
+
+class AllowAll(object):
+    participations = []
+
+    def checkPermission(self, permission, obj):
+        return True
+
+
+def get_request(depth, **headers):
+    request = Request(DummyChannel(), False)
+    request.method = 'GET'
+    request.args = {'depth': [str(depth)]}
+    request.interaction = AllowAll()
+    for name, value in headers.items():
+        request.requestHeaders.setRawHeaders(name.replace('_', '-'), [value])
+    return request
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+
+    def request(self, depth, **headers):
+        return get_request(depth, **headers)
+
+    def validators(self, depth):
+        machines = db.get_root()['oms_root']['machines']
+        return IHttpRestView(machines).cache_validators(self.request(depth))
+
+    @run_in_reactor
+    @clean_db
+    def test_validators(self):
+        compute = Compute(u'etag', u'active')
+        db.get_root()['oms_root']['machines'].add(compute)
+        transaction.commit()
+
+        etag, last_modified = self.validators(1)
+        eq_(self.validators(1)[0], etag)
+        shallow = self.validators(0)[0]
+        assert shallow != etag
+
+        request = self.request(1, If_None_Match=etag)
+        assert check_not_modified(request, etag, last_modified)
+        eq_(request.code, NOT_MODIFIED)
+
+        request = self.request(1, If_Modified_Since=datetimeToString(last_modified + 1))
+        assert check_not_modified(request, etag, last_modified)
+        assert not check_not_modified(self.request(1, If_None_Match='"other"'), etag, last_modified)
+
+        # children changes are seen only when they are rendered
+        compute.hostname = u'changed'
+        transaction.commit()
+        assert self.validators(1)[0] != etag
+        eq_(self.validators(0)[0], shallow)
+
+        # permissions are part of the representation
+        permissions_changed()
+        assert self.validators(0)[0] != shallow
+
+    @run_in_reactor
+    @clean_db
+    def test_inherited_roles(self):
+        machines = db.get_root()['oms_root']['machines']
+        compute = Compute(u'inheriting', u'active')
+        compute.inherit_permissions = True
+        machines.add(compute)
+        transaction.commit()
+
+        etag = IHttpRestView(compute).cache_validators(self.request(0))[0]
+
+        # roles granted on the parent change the permissions rendered for the child
+        with new_interaction('root'):
+            IPrincipalRoleManager(machines).assignRoleToPrincipal('owner', 'someone')
+        eq_(IHttpRestView(compute).cache_validators(self.request(0)), None)
+        transaction.commit()
+        assert IHttpRestView(compute).cache_validators(self.request(0))[0] != etag
+
+    @run_in_reactor
+    @clean_db
+    def test_not_modified_requires_permission(self):
+        getUtility(IAuthentication, context=None).registerPrincipal(User('viewer'))
+        principalPermissionManager.grantPermissionToPrincipal('view', 'viewer')
+        machines = db.get_root()['oms_root']['machines']
+
+        request = self.request(0)
+        request.interaction = new_interaction('viewer')
+        etag, last_modified = IHttpRestView(machines).cache_validators(request)
+
+        # validators are not disclosed without the permission to render the object
+        request = self.request(0, If_None_Match=etag)
+        request.interaction = new_interaction('viewer')
+        request.path = '/machines'
+        with assert_raises(Forbidden):
+            HttpRestServer().resolve(request, None)
+        assert request.code != NOT_MODIFIED
+
+
+def get_finishable_request(**args):
+    request = Request(DummyChannel(), False)
+    request.method = 'GET'
+    request.clientproto = 'HTTP/1.1'
+    request.args = args
+    request.gotLength(0)
+    # missing from the dummy transport of this twisted version
+    request.transport.unregisterProducer = lambda: None
+    return request
+
+
+class JsonStreamingTestCase(unittest.TestCase):
+
+    def request(self, **args):
+        return get_finishable_request(**args)
+
+    def written(self, request):
+        return request.transport.written.getvalue().split('\r\n\r\n', 1)
+
+    def test_small_response(self):
+        request = self.request()
+        done = []
+        HttpRestServer().write_json(request, {'a': [1, 2]}).addCallback(done.append)
+        headers, body = self.written(request)
+        eq_((done, body), ([True], '{"a":[1,2]}'))
+        assert 'Content-Length: 11' in headers
+
+        request = self.request(pretty=['1'])
+        HttpRestServer().write_json(request, {'a': 1})
+        eq_(self.written(request)[1], '{\n  "a": 1\n}')
+
+    def test_large_response_is_streamed(self):
+        server = HttpRestServer()
+        server.json_chunk_size = 100
+        data = [{'id': i, 'name': 'x' * 20} for i in xrange(100)]
+
+        request = self.request()
+        done = []
+        server.write_json(request, data).addCallback(done.append)
+        producer = request.transport.producers[0][0]
+        while not done:
+            producer.resumeProducing()
+        request.finish()
+
+        headers, body = self.written(request)
+        assert 'Transfer-Encoding: chunked' in headers
+        assert 'Content-Length' not in headers
+        chunks = body.split('\r\n')[1:-1:2]
+        eq_(json.loads(''.join(chunks)), data)
+        eq_(done, [True])
+
+    def test_stop_on_disconnect(self):
+        server = HttpRestServer()
+        server.json_chunk_size = 10
+
+        request = self.request()
+        done = []
+        server.write_json(request, range(100)).addCallback(done.append)
+        request.connectionLost(Exception('gone'))
+        eq_(done, [False])
+
+
+class StaticResponseTestCase(unittest.TestCase):
+
+    def render(self, method, path, **headers):
+        request = get_finishable_request()
+        request.method, request.path = method, path
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name.replace('_', '-'), [value])
+
+        server = HttpRestServer()
+        server.handle_request = lambda request: self.fail('%s %s reached the database' % (method, path))
+        server._render(request)
+        return request
+
+    def test_preflight(self):
+        request = self.render('OPTIONS', '/machines', Origin='http://example.com',
+                              Access_Control_Request_Method='PUT')
+        eq_(request.code, 200)
+        eq_(request.responseHeaders.getRawHeaders('Access-Control-Allow-Origin'), ['http://example.com'])
+        assert int(request.responseHeaders.getRawHeaders('Access-Control-Max-Age')[0]) > 0
+
+    def test_logout(self):
+        request = self.render('GET', '/logout/')
+        eq_(json.loads(request.transport.written.getvalue().split('\r\n\r\n', 1)[1]), {'status': 'success'})
+        assert request.cookies[0].startswith('oms_auth_token=;')
+
+        eq_(self.render('GET', '/basicauthlogout').code, 401)
+
+
+class TransactionRoutingTestCase(unittest.TestCase):
+
+    def handle(self, method, rw_transaction=True):
+        compute = db.get_root()['oms_root']['machines']['vm']
+        view_class = type(IHttpRestView(compute))
+
+        def mutate(view, request):
+            view.context.hostname = u'changed-by-%s' % request.method
+            return {}
+
+        server = HttpRestServer()
+        server.use_security_proxy = False
+        server.get_token = lambda request: None
+        server.get_interaction = lambda request, token: AllowAll()
+        request = get_request(0)
+        request.method, request.path = method, '/machines/vm'
+
+        saved = dict((name, view_class.__dict__.get(name))
+                     for name in ('render_GET', 'render_PUT', 'rw_transaction'))
+        view_class.render_GET = view_class.render_PUT = mutate
+        view_class.rw_transaction = lambda view, request: rw_transaction
+        try:
+            results = []
+            server.handle_request(request).addBoth(results.append)
+            eq_(results, [{}])
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    delattr(view_class, name)
+                else:
+                    setattr(view_class, name, value)
+
+        transaction.begin()
+        return db.get_root()['oms_root']['machines']['vm'].hostname
+
+    @run_in_reactor
+    @clean_db
+    def test_routing(self):
+        compute = Compute(u'routed', u'active')
+        compute.__name__ = 'vm'
+        db.get_root()['oms_root']['machines'].add(compute)
+        transaction.commit()
+
+        # safe methods run in a read only transaction, which is never committed
+        eq_(self.handle('GET'), u'routed')
+        eq_(self.handle('GET', rw_transaction=True), u'routed')
+
+        # the other methods commit only if the view asks for it
+        eq_(self.handle('PUT', rw_transaction=False), u'routed')
+        eq_(self.handle('PUT'), u'changed-by-PUT')
+
+
+class ContainerPagingTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_listcontent_page(self):
+        machines = db.get_root()['oms_root']['machines']
+        extensions = sorted(set(machines.content()) - set(machines._items))
+        # stored names before, between and after the ones of the transient items
+        stored = ['a', 'vm0', 'vm1', 'zz'] + [name + '-x' for name in extensions]
+        for name in stored:
+            compute = Compute(u'host-%s' % name, u'active')
+            compute.__name__ = name
+            machines.add(compute)
+        transaction.commit()
+
+        eq_(machines.content_count(), len(stored) + len(extensions))
+        eq_(machines._count(), len(stored))
+
+        def names(page):
+            return [c.__name__ for c in page]
+
+        all_names = sorted(stored + extensions)
+        eq_(names(machines.listcontent_page()), all_names)
+        eq_(names(machines.listcontent_page(reverse=True)), all_names[::-1])
+        for after in [None] + all_names:
+            for reverse in (False, True):
+                for offset in xrange(len(all_names) + 1):
+                    for limit in (None, 1, 2, 3):
+                        eq_(names(machines.listcontent_page(offset, limit, after, reverse)),
+                            names(ReadonlyContainer.listcontent_page.im_func(
+                                machines, offset, limit, after, reverse)))
+
+        del machines['vm0']
+        machines['vm1'].__parent__.remove(machines['vm1'])
+        eq_(machines.content_count(), len(stored) - 2 + len(extensions))
+
+    @run_in_reactor
+    @clean_db
+    def test_render_page(self):
+        machines = db.get_root()['oms_root']['machines']
+        for i in xrange(5):
+            compute = Compute(u'host%s' % i, u'active')
+            compute.__name__ = 'vm%s' % i
+            machines.add(compute)
+        transaction.commit()
+
+        request = get_request(1)
+        request.args.update(limit=['2'], after=['vm4'], sort=['-name'])
+        result = IHttpRestView(machines).render_GET(request)
+        eq_([c['id'] for c in result['children']], ['vm3', 'vm2'])
+        eq_(result['totalChildren'], machines.content_count())
+
+        # hidden children don't shorten the page
+        request = get_request(1)
+        request.args.update(limit=['2'], offset=['2'], sort=['-name'], exclude=['vm3,vm2'])
+        result = IHttpRestView(machines).render_GET(request)
+        eq_([c['id'] for c in result['children']], ['vm1', 'vm0'])
+
+
+class SparseFieldsetTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_fields(self):
+        machines = db.get_root()['oms_root']['machines']
+        compute = Compute(u'sparse', u'active')
+        compute.__name__ = 'vm'
+        machines.add(compute)
+        transaction.commit()
+
+        request = get_request(1)
+        request.args.update(fields=['hostname,state'], limit=['1'], after=['v'])
+        result = IHttpRestView(machines).render_GET(request)
+        eq_(sorted(result['children'][0].keys()), ['hostname', 'id', 'state'])
+
+        request = get_request(0)
+        request.args.update(omit=['permissions,url,memory'])
+        data = IHttpRestView(compute).render_GET(request)
+        assert 'hostname' in data and 'mtime' in data
+        for name in ('permissions', 'url', 'memory'):
+            assert name not in data
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def execute(self, operations, **options):
+        from opennode.oms.endpoint.httprest.batch import BatchRequest
+
+        server = HttpRestServer()
+        server.use_security_proxy = False
+        request = get_request(0)
+        request.method = 'POST'
+        request.content = StringIO(json.dumps(dict(options, operations=operations)))
+
+        results = []
+        BatchRequest(server, request, None).execute().addCallback(results.append)
+        return [(r['status'], r.get('body')) for r in results[0]['results']]
+
+    def hostname(self, name):
+        transaction.begin()
+        return db.get_root()['oms_root']['machines'][name].hostname
+
+    @run_in_reactor
+    @clean_db
+    def test_batch(self):
+        compute = Compute(u'batch', u'active')
+        compute.__name__ = 'vm'
+        db.get_root()['oms_root']['machines'].add(compute)
+        transaction.commit()
+
+        operations = [{'path': '/machines/vm', 'args': {'fields': 'hostname'}},
+                      {'method': 'PUT', 'path': '/machines/vm', 'body': {'hostname': 'renamed'}},
+                      {'method': 'PUT', 'path': '/machines/missing', 'body': {'hostname': 'x'}},
+                      {'path': '/machines/vm', 'args': {'fields': 'hostname'}}]
+
+        results = self.execute(operations)
+        eq_([status for status, body in results], [200, 200, 404, 200])
+        eq_((results[0][1]['hostname'], results[3][1]['hostname']), ('batch', 'renamed'))
+        eq_(self.hostname('vm'), 'renamed')
+
+        # atomic batches are rolled back by the first failure
+        operations[1]['body']['hostname'] = 'again'
+        results = self.execute(operations, atomic=True)
+        eq_([status for status, body in results], [200, 200, 404, 424])
+        eq_(self.hostname('vm'), 'renamed')
+
+    @run_in_reactor
+    def test_invalid_batch(self):
+        from opennode.oms.endpoint.httprest.batch import BatchRequest
+        from opennode.oms.endpoint.httprest.root import BadRequest
+
+        for spec in ({'operations': [], 'transaction_size': 'many'},
+                     {'operations': [{'path': '/machines', 'args': ['depth']}]},
+                     {'operations': [{'path': '/machines', 'method': 1}]},
+                     {'operations': [{'method': 'GET'}]}):
+            request = get_request(0)
+            request.content = StringIO(json.dumps(spec))
+            assert_raises(BadRequest, BatchRequest, HttpRestServer(), request, None)
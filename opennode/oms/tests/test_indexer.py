@@ -0,0 +1,247 @@
+import transaction
+import unittest
+
+from nose.tools import eq_
+from ZODB.utils import p64
+from zope.component import handle
+
+from opennode.oms.backend.indexer import IndexerDaemonProcess, ReindexProcess, CoalescingQueue, extract_documents
+from opennode.oms.endpoint.httprest.base import IHttpRestView
+from opennode.oms.model.model.events import ModelDeletedEvent, ModelModifiedEvent
+from opennode.oms.model.model.filtrable import IFiltrable
+from opennode.oms.model.model.search import ITagged, SearchResult
+from opennode.oms.model.traversal import canonical_path
+from opennode.oms.security.interaction import new_interaction
+from opennode.oms.tests.test_compute import Compute
+from opennode.oms.tests.test_httprest import get_request
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+
+
+class IndexerCatchUpTestCase(unittest.TestCase):
+
+    def search(self, query):
+        search = db.get_root()['oms_root']['search']
+        return sorted(c.hostname for c in search.search_goog(query))
+
+    def add_compute(self, hostname):
+        compute = Compute(hostname, u'active')
+        db.get_root()['oms_root']['machines'].add(compute)
+        transaction.commit()
+        return compute
+
+    def catch_up(self):
+        IndexerDaemonProcess.queue.clear()
+        IndexerDaemonProcess().catch_up()
+        transaction.commit()
+
+    @run_in_reactor
+    @clean_db
+    def test_catch_up_from_watermark(self):
+        search = db.get_root()['oms_root']['search']
+        eq_(search.watermark, None)
+
+        kept = self.add_compute(u'kept')
+        removed = self.add_compute(u'removed')
+        self.catch_up()
+        assert search.watermark is not None
+        eq_(self.search(u'kept'), [u'kept'])
+        eq_(self.search(u'removed'), [u'removed'])
+
+        # changes which the indexer didn't process before a restart
+        self.add_compute(u'added')
+        kept.hostname = u'renamed'
+        machines = db.get_root()['oms_root']['machines']
+        del machines[removed.__name__]
+        handle(removed, ModelDeletedEvent(machines))
+        # deletions don't write the catalog in the deleting transaction
+        assert not search._p_changed
+        transaction.commit()
+
+        self.catch_up()
+        eq_(self.search(u'added'), [u'added'])
+        eq_(self.search(u'renamed'), [u'renamed'])
+        eq_(self.search(u'kept'), [])
+        eq_(self.search(u'removed'), [])
+
+    @run_in_reactor
+    @clean_db
+    def test_resume_reindex(self):
+        search = db.get_root()['oms_root']['search']
+        for i in xrange(3):
+            self.add_compute(u'host%s' % i)
+
+        process = ReindexProcess()
+        process.batch_size = 2
+        process.prepare(db.last_transaction())
+        process.index_batch()
+        transaction.commit()
+        eq_(search.reindex_cursor.done, 2)
+        # the objects are collected a batch at a time
+        assert search.reindex_cursor.total < 5
+        assert not search.reindex_cursor.finished
+
+        # the indexer resumes the interrupted reindex instead of catching up
+        self.catch_up()
+        eq_(search.reindex_cursor, None)
+        assert search.watermark is not None
+        eq_(self.search(u'host*'), [u'host0', u'host1', u'host2'])
+
+    @run_in_reactor
+    @clean_db
+    def test_reindex_errors(self):
+        search = db.get_root()['oms_root']['search']
+        self.add_compute(u'survivor')
+
+        process = ReindexProcess()
+        process.prepare(db.last_transaction())
+        transaction.commit()
+
+        # objects deleted after their documents have been extracted are skipped
+        deleted = p64(2 ** 40)
+        search.reindex_cursor.pending.insert(deleted)
+        process.apply_batch([deleted], {deleted: (deleted, None, {})})
+        assert deleted not in search.reindex_cursor.pending
+
+        # a reindex which keeps failing is given up and the indexes are used again
+        def fail():
+            raise Exception('fatal')
+        process.index_batch = fail
+        process.retries = 0
+        process.run()
+        eq_(search.reindex_cursor, None)
+        assert search.watermark is not None
+
+    @run_in_reactor
+    @clean_db
+    def test_extract_and_apply_document(self):
+        compute = self.add_compute(u'extracted')
+        path = canonical_path(compute)
+
+        documents = []
+        extract_documents([path], by_path=True).addCallback(documents.append)
+        oid, serial, document = documents[0][path]
+        eq_(sorted(document.keys()), ['__all', 'ctime', 'mtime', 'name', 'owner', 'state', 'tags'])
+        eq_(document['state'], u'active')
+
+        search = db.get_root()['oms_root']['search']
+        search.apply_document(compute, serial, document)
+        eq_(self.search(u'extracted'), [u'extracted'])
+        assert search.is_up_to_date(compute)
+
+    @run_in_reactor
+    @clean_db
+    def test_search_page(self):
+        for i in xrange(5):
+            self.add_compute(u'dup')
+        self.catch_up()
+
+        result = SearchResult(db.get_root()['oms_root']['search'], u'dup')
+        total, page = result.page(1, 2)
+        eq_((total, len(page)), (5, 2))
+        eq_(result.count(), 5)
+        eq_(sorted(result.listnames()), [u'dup', u'dup_0', u'dup_1', u'dup_2', u'dup_3'])
+
+        # reverse pages walk the same hits backwards
+        search = db.get_root()['oms_root']['search']
+        forward = search.search_goog_page(u'dup', 0, None)[1]
+        eq_(search.search_page(1, 2, reverse=True, __all=u'dup')[1], forward[::-1][1:3])
+
+    @run_in_reactor
+    @clean_db
+    def test_tag_facets(self):
+        search = db.get_root()['oms_root']['search']
+        computes = []
+        for hostname, tags in [(u'ab', [u'a', u'b']), (u'abc', [u'a', u'b', u'c']), (u'c', [u'c'])]:
+            compute = self.add_compute(hostname)
+            ITagged(compute).tags = tags
+            search.index_object(compute)
+            computes.append(compute)
+
+        by_tag = search['by-tag']
+
+        def labels(tag):
+            return sorted(i for i in tag.listnames() if i.startswith('label:'))
+
+        eq_((by_tag['label:a'].count, by_tag['label:c'].count), (2, 2))
+        eq_(search.facets.cooccurring(u'label:c')[u'label:a'], 1)
+        eq_(labels(by_tag['label:a']), ['label:b', 'label:c'])
+        eq_(labels(by_tag['label:a']['label:b']), ['label:c'])
+        eq_(by_tag['label:a']['label:b'].count, 2)
+
+        ITagged(computes[1]).tags = [u'a']
+        search.index_object(computes[1])
+        search.unindex_object(computes[2])
+        eq_(search.facets.count(u'label:c'), 0)
+        eq_(labels(by_tag['label:a']), ['label:b'])
+
+        # the facets give the same listing as searching for each refinement
+        facets, search.facets = search.facets, None
+        eq_(labels(by_tag['label:a']), ['label:b'])
+        search.facets = facets
+
+    @run_in_reactor
+    @clean_db
+    def test_field_index_plan(self):
+        search = db.get_root()['oms_root']['search']
+        active, inactive = self.add_compute(u'on'), self.add_compute(u'off')
+        inactive.state = u'inactive'
+        inactive._mtime = active.mtime + 10
+        transaction.commit()
+        self.catch_up()
+
+        computes = [active, inactive]
+        docs, residual = search.plan(u'state:inact foo')
+        eq_(unicode(residual), u'foo')
+        eq_(search.filter_indexed(computes, docs), [inactive])
+        eq_(search.indexed_children(db.get_root()['oms_root']['machines'], docs), [inactive])
+
+        # text fields are matched by substring, like IFiltrable does
+        eq_(search.filter_indexed(computes, search.plan(u'state:active')[0]),
+            [c for c in computes if IFiltrable(c).match(u'state:active')])
+
+        docs, residual = search.plan(u'mtime>%r state:inactive' % active.mtime)
+        eq_((search.filter_indexed(computes, docs), residual), ([inactive], None))
+
+        eq_(search.filter_indexed(computes, search.plan(u'mtime>=%r' % active.mtime)[0]), computes)
+        eq_(search.filter_indexed(computes, search.plan(u'mtime>%r' % active.mtime)[0]), [inactive])
+        docs, residual = search.plan(u'hostname:on OR state:active')
+        eq_((docs, unicode(residual)), (None, u'(hostname:on OR state:active)'))
+
+        request = get_request(1)
+        request.args.update(q=['state:inact'])
+        request.interaction = new_interaction('root')
+        result = IHttpRestView(db.get_root()['oms_root']['machines']).render_GET(request)
+        eq_([c['hostname'] for c in result['children']], [u'off'])
+
+        # unindexed fields are compared by IFiltrable
+        eq_([c.hostname for c in computes if IFiltrable(c).match(u'memory<1 hostname:o')], [])
+        inactive.memory = 512
+        eq_([c.hostname for c in computes if IFiltrable(c).match(u'memory>=512.0 hostname:of')], [u'off'])
+
+
+class CoalescingQueueTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_coalescing(self):
+        machines = db.get_root()['oms_root']['machines']
+        a, b = Compute(u'a', u'active'), Compute(u'b', u'active')
+        machines.add(a)
+        machines.add(b)
+        transaction.commit()
+
+        queue = CoalescingQueue(max_size=2)
+        for i in xrange(3):
+            queue.append((a, ModelModifiedEvent({}, {})))
+        queue.append((b, ModelModifiedEvent({}, {})))
+        queue.append((a, ModelDeletedEvent(machines)))
+
+        eq_([type(event) for path, model, event in queue.drain()], [ModelModifiedEvent, ModelDeletedEvent])
+        eq_(queue.stats()['coalesced'], 3)
+        eq_(len(queue), 0)
+
+        for compute in (a, b, a):
+            queue.append((compute, ModelDeletedEvent(machines)))
+        assert queue.overflowed
+        eq_(queue.stats()['dropped'], 1)
@@ -1,27 +1,42 @@
+import json
 import os
+import shutil
+import subprocess
+import tempfile
+import time
+import transaction
 import unittest
 
+from distutils.spawn import find_executable
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_, assert_raises
+from twisted.cred.error import UnauthorizedLogin
+from twisted.cred.credentials import UsernamePassword
 from zope.annotation.interfaces import IAttributeAnnotatable
 from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility
 from zope.interface import implementer
+from zope.security.checker import CheckerPublic, getChecker
 from zope.security.interfaces import Unauthorized
+from zope.security.proxy import Proxy
 from zope.security.management import newInteraction, getInteraction, endInteraction, setSecurityPolicy
 from zope.securitypolicy import interfaces
 from zope.securitypolicy import zopepolicy
 from zope.securitypolicy.principalpermission import principalPermissionManager as prinperG
 
 
+from opennode.oms.config import get_config
 from opennode.oms.model.model.base import IContainer
 from opennode.oms.model.schema import model_to_dict
 from opennode.oms.tests.test_compute import Compute
 from opennode.oms.security import authentication
-from opennode.oms.security.checker import proxy_factory
-from opennode.oms.security.interaction import OmsSecurityPolicy
+from opennode.oms.security.audit import attribute_audit
+from opennode.oms.security.checker import Checker, AuditingPermissionDictionary, proxy_factory
+from opennode.oms.security.interaction import OmsSecurityPolicy, new_interaction, permission_cache
 from opennode.oms.security import passwd
 from opennode.oms.security.principals import User
-from opennode.oms.tests.util import run_in_reactor
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
 
 
 class SessionStub(object):
@@ -380,3 +395,330 @@ class TestPasswd(unittest.TestCase):
             passwd.delete_user(self.username)
             passwd.delete_user(self.username + '1')
             passwd.delete_user(self.username + '2')
+
+
+class CredentialCacheTestCase(unittest.TestCase):
+
+    def test_asynchronous_checker(self):
+        from nose.twistedtools import threaded_reactor
+        from twisted.internet import defer
+        reactor, reactor_thread = threaded_reactor()
+
+        class Rejecting(object):
+            def requestAvatarId(self, credentials):
+                return defer.fail(UnauthorizedLogin())
+
+        class Delayed(object):
+            def requestAvatarId(self, credentials):
+                d = defer.Deferred()
+                reactor.callFromThread(reactor.callLater, 0.1, d.callback, credentials.username)
+                return d
+
+        saved = authentication._checkers
+        authentication._checkers = [Rejecting(), Delayed()]
+        try:
+            # verify_credentials runs in a thread, waiting for the checkers answering later
+            eq_(authentication.verify_credentials(UsernamePassword('john', 'secret')), 'john')
+            authentication._checkers = [Rejecting()]
+            eq_(authentication.verify_credentials(UsernamePassword('john', 'secret')), None)
+        finally:
+            authentication._checkers = saved
+
+    def test_cache(self):
+        cache = authentication.CredentialCache(size=2, ttl=60)
+        cache.add(UsernamePassword('john', 'secret'), 'john')
+        eq_(cache.get(UsernamePassword('john', 'secret')), 'john')
+        eq_(cache.get(UsernamePassword('john', 'wrong')), None)
+        assert 'secret' not in repr(cache.entries)
+
+        # least recently used entries are evicted
+        cache.add(UsernamePassword('mary', 'x'), 'mary')
+        cache.get(UsernamePassword('john', 'secret'))
+        cache.add(UsernamePassword('paul', 'y'), 'paul')
+        eq_(cache.get(UsernamePassword('mary', 'x')), None)
+        eq_(cache.get(UsernamePassword('john', 'secret')), 'john')
+
+        for key, (avatar, expires) in cache.entries.items():
+            cache.entries[key] = (avatar, expires - 60)
+        eq_(cache.get(UsernamePassword('john', 'secret')), None)
+        eq_(cache.stats()['hits'], 3)
+
+    def test_invalidated_by_reload(self):
+        authentication.credential_cache().add(UsernamePassword('john', 'secret'), 'john')
+        authentication.reload_users('')
+        eq_(authentication.credential_cache().get(UsernamePassword('john', 'secret')), None)
+
+
+class KeystoneTokenTestCase(unittest.TestCase):
+    """Validates tokens signed with a locally generated CA and signing certificate."""
+
+    def openssl(self, *args, **kwargs):
+        process = subprocess.Popen(('openssl',) + args, cwd=self.dir, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate(kwargs.get('input'))
+        if process.returncode:
+            raise SkipTest('openssl failed: %s' % err)
+        return out
+
+    def setUp(self):
+        if not find_executable('openssl'):
+            raise SkipTest('openssl is not available')
+
+        self.dir = tempfile.mkdtemp()
+        self.openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=ca',
+                     '-keyout', 'ca.key', '-out', 'ca.pem')
+        self.openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=signing',
+                     '-keyout', 'signing.key', '-out', 'signing.csr')
+        self.openssl('x509', '-req', '-days', '1', '-in', 'signing.csr', '-CA', 'ca.pem',
+                     '-CAkey', 'ca.key', '-set_serial', '1', '-out', 'signing.pem')
+
+        self.config = get_config()
+        self.saved = dict(self.config.items('keystone'))
+        self.config.set('keystone', 'signing_cert_file_name', os.path.join(self.dir, 'signing.pem'))
+        self.config.set('keystone', 'ca_file_name', os.path.join(self.dir, 'ca.pem'))
+        self.config.set('keystone', 'openssl_cmd', find_executable('openssl'))
+
+    def tearDown(self):
+        for option, value in self.saved.items():
+            self.config.set('keystone', option, value)
+        shutil.rmtree(self.dir)
+
+    def token(self, username, expires):
+        content = json.dumps({'access': {'user': {'username': username},
+                                         'token': {'tenant': {'name': 'tenant'}, 'expires': expires}}})
+        pem = self.openssl('cms', '-sign', '-signer', 'signing.pem', '-inkey', 'signing.key',
+                           '-outform', 'PEM', '-nosmimecap', '-nodetach', '-nocerts', '-noattr',
+                           input=content)
+        return ''.join(pem.splitlines()[1:-1]).replace('/', '-')
+
+    def test_validation(self):
+        token = self.token('john', '2100-01-01T00:00:00Z')
+        checker = authentication.KeystoneChecker()
+        for in_process in ('no', 'yes'):
+            self.config.set('keystone', 'in_process_verification', in_process)
+            eq_(checker.validate_and_parse_keystone_token(token),
+                {'username': 'john', 'groups': ['tenant'], 'expires': 4102444800})
+            assert_raises(UnauthorizedLogin, checker.validate_and_parse_keystone_token,
+                          token[:100] + token[101:] + 'A')
+        assert authentication.token_cache().verification.count >= 4
+
+    def test_cache(self):
+        cache = authentication.TokenCache(size=10, ttl=60)
+        cache.add('token', {'username': 'john'}, time.time() + 600)
+        cache.add('expired', {'username': 'john'}, time.time() - 1)
+        eq_(cache.get('token'), {'username': 'john'})
+        eq_(cache.get('expired'), None)
+        eq_((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+        assert 'token' not in cache.entries
+
+        # cached tokens are accepted without validating them again
+        authentication.token_cache().add('cached', {'username': 'mary', 'groups': ['t']})
+        avatars = []
+        authentication.KeystoneChecker().requestAvatarId('cached').addCallback(avatars.append)
+        eq_(avatars, ['mary'])
+
+
+class SessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from opennode.oms.endpoint.httprest.auth import HttpRestAuthenticationUtility
+        self.auth = HttpRestAuthenticationUtility()
+
+    def test_lazy_renewal(self):
+        token = self.auth._generate_token('john')
+        eq_(self.auth.get_principal(token), 'john')
+        eq_(self.auth.verified_tokens.get(token)[0], 'john')
+
+        emitted = []
+        self.auth.emit_token = lambda request, new_token: emitted.append(new_token)
+        self.auth.renew_token(None, token)
+        eq_(emitted, [])
+
+        config = get_config()
+        config.set('auth', 'token_renew_fraction', '0')
+        try:
+            self.auth.renew_token(None, token)
+        finally:
+            config.remove_option('auth', 'token_renew_fraction')
+        eq_(self.auth.parse_token(emitted[0])[2], self.auth.parse_token(token)[2])
+
+    def test_revocation(self):
+        token = self.auth._generate_token('john')
+        other = self.auth._generate_token('john')
+        eq_(self.auth.get_principal(token), 'john')
+
+        self.auth.revoke_token(token)
+        assert_raises(Exception, self.auth.get_principal, token)
+        eq_(self.auth.get_principal(other), 'john')
+
+        # the revocation survives restarts of the token cache
+        self.auth.verified_tokens.clear()
+        assert_raises(Exception, self.auth.get_principal, token)
+
+    def test_basic_auth_token_reused(self):
+        from opennode.oms.security.authentication import credential_cache
+        from opennode.oms.security.sessions import session_registry
+
+        credentials = UsernamePassword('john', 'secret')
+        credential_cache().add(credentials, 'john')
+        self.auth.emit_token = lambda request, token: None
+        sessions = session_registry().stats()['active']
+
+        tokens = []
+        for i in xrange(3):
+            self.auth.authenticate(None, credentials, basic_auth=True, login=False).addCallback(
+                lambda result: tokens.append(result['token']))
+            eq_(self.auth.get_principal(tokens[-1]), 'john')
+        eq_(len(set(tokens)), 1)
+        assert session_registry().stats()['active'] <= sessions + 1
+        assert self.auth.verified_tokens.hits >= 2
+
+        # a revoked session is not reused
+        self.auth.revoke_token(tokens[0])
+        self.auth.authenticate(None, credentials, basic_auth=True, login=False).addCallback(
+            lambda result: tokens.append(result['token']))
+        eq_(self.auth.get_principal(tokens[-1]), 'john')
+        assert tokens[-1] != tokens[0]
+
+    def test_timing_wheel(self):
+        from opennode.oms.security.sessions import TimingWheel
+
+        wheel = TimingWheel(tick=10)
+        wheel.schedule('a', 105)
+        wheel.schedule('b', 120)
+        wheel.schedule('c', 1000)
+        eq_(wheel.advance(100), [])
+        eq_(wheel.advance(110), ['a'])
+        wheel.schedule('b', 130)
+        eq_(wheel.advance(125), [])
+        wheel.cancel('c')
+        eq_(wheel.advance(5000), ['b'])
+        eq_(len(wheel), 0)
+
+
+class PermissionCacheTestCase(unittest.TestCase):
+
+    def check(self, obj):
+        interaction = new_interaction('decider')
+        return interaction.checkPermission('modify', obj)
+
+    def set_role(self, obj, allow):
+        with new_interaction('root'):
+            prinrole = interfaces.IPrincipalRoleManager(obj)
+            if allow:
+                prinrole.assignRoleToPrincipal('owner', 'decider')
+            else:
+                prinrole.unsetRoleForPrincipal('owner', 'decider')
+
+    @run_in_reactor
+    @clean_db
+    def test_decisions_shared_between_interactions(self):
+        getUtility(IAuthentication, context=None).registerPrincipal(User('decider'))
+        machines = db.get_root()['oms_root']['machines']
+        compute = Compute(u'decided', u'active')
+        machines.add(compute)
+        transaction.commit()
+
+        cache = permission_cache()
+        hits = cache.hits
+        assert not self.check(compute)
+        assert not self.check(compute)
+        eq_(cache.hits, hits + 1)
+
+        # the decisions of an interaction are looked up before the shared ones
+        interaction = new_interaction('decider')
+        lookups = cache.hits + cache.misses
+        assert not interaction.checkPermission('modify', compute)
+        assert not interaction.checkPermission('modify', compute)
+        eq_(cache.hits + cache.misses, lookups + 1)
+
+        # uncommitted changes are not cached
+        self.set_role(compute, True)
+        assert self.check(compute)
+        transaction.commit()
+        assert self.check(compute)
+
+        # roles granted on the parent matter only while inheriting
+        self.set_role(compute, False)
+        self.set_role(machines, True)
+        transaction.commit()
+        assert not self.check(compute)
+        compute.inherit_permissions = True
+        transaction.commit()
+        assert self.check(compute)
+
+        authentication.reload_roles([])
+        eq_(len(cache.decisions), 0)
+
+    def test_eviction(self):
+        from opennode.oms.security.interaction import PermissionDecisionCache
+
+        cache = PermissionDecisionCache(size=2)
+        cache.put('a', (), True)
+        cache.put('b', (), False)
+        eq_(cache.get('a', ()), True)
+        cache.put('c', (), True)
+        eq_(sorted(cache.decisions), ['a', 'c'])
+        eq_(cache.get('a', ('changed',)), None)
+        eq_((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+
+class CheckerCacheTestCase(unittest.TestCase):
+
+    def test_checkers_reused_per_interaction(self):
+        interaction1 = new_interaction('root')
+        interaction2 = new_interaction('root')
+        obj = DummyObject()
+
+        checker = getChecker(proxy_factory(obj, interaction1))
+        assert getChecker(proxy_factory(DummyObject(), interaction1)) is checker
+        assert getChecker(getChecker(proxy_factory(obj, interaction1)).proxy(DummyObject())) is checker
+        eq_(checker.interaction, interaction1)
+
+        other = getChecker(proxy_factory(obj, interaction2))
+        assert other is not checker
+        eq_(other.interaction, interaction2)
+        assert other.get_permissions is checker.get_permissions
+
+
+class AttributeAuditTestCase(unittest.TestCase):
+
+    def test_undeclared_attributes_counted(self):
+        audit = attribute_audit()
+        audit.reset()
+
+        perms = AuditingPermissionDictionary()
+        perms['declared'] = CheckerPublic
+        obj = DummyObject()
+        obj.declared = obj.undeclared = 1
+        proxy = Proxy(obj, Checker(perms, perms, interaction=new_interaction('root')))
+
+        for i in range(3):
+            eq_(proxy.undeclared, 1)
+        eq_(proxy.declared, 1)
+
+        report = audit.report()
+        eq_(len(report), 1)
+        eq_(report[0]['attribute'], 'undeclared')
+        eq_(report[0]['type'], 'opennode.oms.tests.test_security.DummyObject')
+        eq_(report[0]['count'], 3)
+        assert 'root' in report[0]['principals']
+        assert 'test_undeclared_attributes_counted' in ''.join(report[0]['stack'])
+
+    def test_concurrent_counts(self):
+        import threading
+        from opennode.oms.security.audit import AttributeAudit
+
+        audit = AttributeAudit()
+        obj = DummyObject()
+
+        def record():
+            for i in xrange(2000):
+                audit.record('undeclared', obj, None)
+
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(audit.stats()['accesses'], 8000)
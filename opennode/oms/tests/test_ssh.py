@@ -90,6 +90,18 @@ class SshTestCase(unittest.TestCase):
             for cmd in commands().keys():
                 assert cmd in current_call(t).arg
 
+    @run_in_reactor
+    def test_txstats(self):
+        self._cmd('txstats')
+        with assert_mock(self.terminal) as t:
+            assert current_call(t).arg.startswith('LANE')
+
+    @run_in_reactor
+    def test_attraudit(self):
+        self._cmd('attraudit')
+        with assert_mock(self.terminal) as t:
+            assert current_call(t).arg.endswith('dropped\n')
+
     @run_in_reactor
     def test_cd(self):
         for folder in self.tlds:
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Measures the cost of creating security proxies, with checkers created for every proxied
+value as it used to be done and with the checkers cached on the interaction.
+
+Usage: python -m opennode.oms.tools.checker_benchmark [iterations]
+"""
+import sys
+import time
+
+from opennode.oms.security import checker
+from opennode.oms.security.interaction import OmsSecurityPolicy
+
+
+class Unsecured(object):
+    """A type without attribute rights, like most of the values reached by a REST render"""
+
+    def __init__(self):
+        self.child = self
+
+
+def uncached_checker(value, interaction):
+    return checker._new_checker(type(value), interaction)
+
+
+def proxy(value, interaction):
+    checker.proxy_factory(value, interaction)
+
+
+def proxy_and_traverse(value, interaction):
+    # proxying the value and then an attribute result, as views do when traversing
+    checker.proxy_factory(value, interaction).child
+
+
+def measure(operation, iterations):
+    interaction = OmsSecurityPolicy()
+    value = Unsecured()
+    start = time.time()
+    for i in xrange(iterations):
+        operation(value, interaction)
+    return (time.time() - start) / iterations
+
+
+def run():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    for operation in (proxy, proxy_and_traverse):
+        select_checker = checker._select_checker
+        checker._select_checker = uncached_checker
+        try:
+            before = measure(operation, iterations)
+        finally:
+            checker._select_checker = select_checker
+        after = measure(operation, iterations)
+        print "%s: %0.2f us per checker, %0.2f us cached (%0.1fx)" % (
+            operation.__name__, before * 1e6, after * 1e6, before / after)
+
+
+if __name__ == "__main__":
+    run()
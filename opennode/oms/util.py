@@ -130,7 +130,8 @@ def blocking_yield(deferred, timeout=None):
     otherwise we cannot block the caller or rollback the transaction in case of async code
     throwing exception (scenario: we want to prevent deletion of node)
 
-    Use this utility only until you refactor the upstream code in order to use pure async code.
+    Use this utility only until you refactor the upstream code in order to use pure async code;
+    code running inside a transaction can use `db.async_transact` and simply yield the deferred.
     """
 
     q = Queue()
@@ -1,5 +1,6 @@
 import functools
 import inspect
+import itertools
 import logging
 import pickle
 import random
@@ -12,9 +13,11 @@ import transaction
 from ZEO.ClientStorage import ClientStorage
 from ZODB.FileStorage import FileStorage
 from ZODB.POSException import ConflictError, ReadConflictError, StorageTransactionError
+from ZODB.utils import p64, u64
 from grokcore.component import subscribe
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
 from twisted.python.threadable import isInIOThread
 from twisted.python.threadpool import ThreadPool
 from zope.component import handle
@@ -27,16 +30,20 @@ from opennode.oms.zodb.proxy import (make_persistent_proxy,
                                      remove_persistent_proxy as _remove_persistent_proxy,
                                      get_peristent_context, PersistentProxy)
 from opennode.oms.zodb.extractors import context_from_method
+from opennode.oms.zodb.profiler import get_profile
+from opennode.oms.zodb.retry import get_default_retry_policy, hotspots
 
 
-__all__ = ['get_db', 'get_connection', 'get_root', 'transact', 'ref', 'deref']
+__all__ = ['get_db', 'get_connection', 'get_root', 'savepoint', 'transact', 'async_transact', 'ref', 'deref']
 
 
 _db = None
-_threadpool = None
+_threadpools = {}
 _connection = threading.local()
 _testing = False
 _context = threading.local()
+_phase = threading.local()
+_queue_wait = threading.local()
 
 
 log = logging.getLogger(__name__)
@@ -51,6 +58,14 @@ class RollbackValue(object):
         self.value = value
 
 
+class _RetryAfter(object):
+    """Returned by a transaction attempt which conflicted and has to be retried after `delay`
+    seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+
 class IBeforeDatabaseInitializedEvent(Interface):
     """Emitted before database is initialized"""
 
@@ -59,13 +74,110 @@ class BeforeDatabaseInitalizedEvent(object):
     implements(IBeforeDatabaseInitializedEvent)
 
 
+LANE_RO = 'ro'
+LANE_RW = 'rw'
+LANE_BACKGROUND = 'background'
+
+_default_lane_sizes = {LANE_RO: 20, LANE_RW: 10, LANE_BACKGROUND: 3}
+
+
+class ThreadPoolLane(object):
+    """A separately sized threadpool dedicated to a class of transactions.
+
+    Interactive read-only and read-write transactions and background daemons (indexer,
+    packer, user event log) each get their own lane, so that a burst of slow writes
+    cannot queue up in front of simple reads. Keeps queue depth and wait time counters.
+
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=size, name='zodb-%s' % name)
+
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.max_queued = 0
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def defer(self, fun, *args, **kwargs):
+        submitted = time.time()
+
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        def run():
+            wait = time.time() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            # picked up by the transaction profiler
+            _queue_wait.x = wait
+            return fun(*args, **kwargs)
+
+        return deferToThreadPool(reactor, self.threadpool, run)
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.threadpool.max,
+                    'working': len(self.threadpool.working),
+                    'idle': len(self.threadpool.waiters),
+                    'queued': self.queued,
+                    'max_queued': self.max_queued,
+                    'started': self.started,
+                    'avg_wait': self.total_wait / self.started if self.started else 0.0,
+                    'max_wait': self.max_wait}
+
+    def reset_stats(self):
+        with self._lock:
+            self.max_queued = self.queued
+            self.started = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+
 def init_threadpool():
-    global _threadpool
+    cfg = get_config()
+
+    for lane, default_size in _default_lane_sizes.items():
+        size = cfg.getint('db', '%s_threadpool_size' % lane, default_size)
+        _threadpools[lane] = pool = ThreadPoolLane(lane, size)
 
-    _threadpool = ThreadPool(minthreads=0, maxthreads=20)
+        reactor.callWhenRunning(pool.threadpool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', pool.threadpool.stop)
 
-    reactor.callWhenRunning(_threadpool.start)
-    reactor.addSystemEventTrigger('during', 'shutdown', _threadpool.stop)
+
+def connection_pool_size():
+    """Every lane thread keeps a connection of its own and each async transaction opens one
+    for as long as it's suspended, so the pool has to be larger than the ZODB default of 7,
+    otherwise connections (and their object caches) are discarded instead of reused."""
+    cfg = get_config()
+    lanes = sum(cfg.getint('db', '%s_threadpool_size' % lane, default_size)
+                for lane, default_size in _default_lane_sizes.items())
+    return cfg.getint('db', 'connection_pool_size', 0) or 2 * lanes
+
+
+def get_lane(lane):
+    if not _threadpools:
+        init_threadpool()
+
+    if lane not in _threadpools:
+        raise Exception("Unknown threadpool lane '%s'" % lane)
+    return _threadpools[lane]
+
+
+def get_threadpool_stats():
+    """Returns queue depth and wait time counters for every threadpool lane"""
+    return dict((name, lane.stats()) for name, lane in _threadpools.items())
+
+
+def reset_threadpool_stats():
+    for lane in _threadpools.values():
+        lane.reset_stats()
 
 
 def get_db_dir():
@@ -117,6 +229,7 @@ def init(test=False):
         _db = DB()
         _testing = True
 
+    _db.setPoolSize(connection_pool_size())
     init_schema()
 
 
@@ -140,6 +253,11 @@ def get_connection(accept_main_thread=False):
     if not accept_main_thread and isInIOThread() and not _testing:
         raise Exception('The ZODB should not be accessed from the main thread')
 
+    # inside a phase of an async_transact the connection is bound to the suspended transaction
+    suspended = getattr(_phase, 'x', None)
+    if suspended is not None:
+        return suspended.connection
+
     global _connection
     if not hasattr(_connection, 'x'):
         _connection.x = get_db().open()
@@ -150,6 +268,12 @@ def get_root(accept_main_thread=False):
     return get_connection(accept_main_thread).root()
 
 
+def savepoint():
+    """Creates a savepoint of the current transaction, also inside async transactions, which
+    don't use the default transaction manager."""
+    return get_connection().transaction_manager.savepoint()
+
+
 def assert_transact(fun):
     """Used to decorate methods which assume to be running in a threadpool used for blocking io,
     for example those created by @db.transact.
@@ -164,107 +288,388 @@ def assert_transact(fun):
     return wrapper
 
 
-def transact(fun):
+def transact(fun=None, lane=LANE_RW, retry_policy=None):
     """Runs a callable inside a separate thread within a ZODB transaction.
 
+    Background daemons should pass `lane=db.LANE_BACKGROUND` so that they don't compete
+    with interactive requests for threads:
+
+        >>> @db.transact(lane=db.LANE_BACKGROUND)
+        ... def flush():
+        ...     # ...
+
+    Commits failing because of a conflict are retried according to `retry_policy` (see
+    `opennode.oms.zodb.retry.RetryPolicy`), the default policy when None. No thread is held
+    while waiting for the next attempt.
+
     Returned values are deeply copied. Currently only zodb objects returned directly or
     contained in the first level content of lists/sets/dicts are copied.
     """
-    if not _threadpool:
-        init_threadpool()
+    if fun is None:
+        def wrapper(fun):
+            return _transact(fun, lane, retry_policy)
+        return wrapper
+    return _transact(fun, lane, retry_policy)
+
+
+def _trace(profile, msg, t, force=False):
+    if force or get_config().getboolean('debug', 'trace_transactions', False):
+        trace_fun = log.error
+    elif log.isEnabledFor(logging.DEBUG):
+        trace_fun = log.debug
+    else:
+        return
+
+    ch = '\\' if msg == 'BEGIN' else '/'
+    trace_fun("%s\ttx:%s %s\tin %s %s", msg, t.description, ch, profile.description, ch)
+
+
+def _pop_queue_wait():
+    wait = getattr(_queue_wait, 'x', 0.0)
+    _queue_wait.x = 0.0
+    return wait
+
+
+def _transact(fun, lane=LANE_RW, retry_policy=None):
+    pool = get_lane(lane)
+    profile = get_profile(fun, 'rw')
 
     @functools.wraps(fun)
-    def run_in_tx(fun, *args, **kwargs):
+    def run_in_tx(fun, policy, timings, attempt, first_started, *args, **kwargs):
         if not _db:
             raise Exception('DB not initalized')
 
-        context = context_from_method(fun, args, kwargs)
-        _context.x = context
+        timings['queue_wait'] += _pop_queue_wait()
+        return _run_in_tx(fun, profile, policy, timings, attempt, first_started, args, kwargs)
+
+    @functools.wraps(fun)
+    @defer.inlineCallbacks
+    def wrapper(*args, **kwargs):
+        policy = retry_policy or get_default_retry_policy()
+        timings = {'queue_wait': 0.0, 'execution': 0.0, 'commit': 0.0, 'retries': 0, 'conflicts': 0}
+        first_started = time.time()
+        error = True
+        try:
+            for i in itertools.count():
+                timings['retries'] = i
+                if not _testing:
+                    result = yield pool.defer(run_in_tx, fun, policy, timings, i, first_started,
+                                              *args, **kwargs)
+                else:
+                    # No threading during testing
+                    result = yield defer.execute(run_in_tx, fun, policy, timings, i, first_started,
+                                                 *args, **kwargs)
+                if not isinstance(result, _RetryAfter):
+                    error = False
+                    defer.returnValue(result)
+                # the conflict backoff doesn't hold a thread of the lane
+                if result.delay:
+                    yield task.deferLater(reactor, result.delay, lambda: None)
+        finally:
+            profile.record(timings['queue_wait'], timings['execution'], timings['commit'],
+                           retries=timings['retries'], conflicts=timings['conflicts'], error=error)
+    return wrapper
 
-        cfg = get_config()
 
-        def trace(msg, t, force=False):
-            ch = '/'
-            if msg == "BEGINNING":
-                ch = '\\'
-            if cfg.getboolean('debug', 'trace_transactions', False) or force:
-                trace_fun = log.error
-            else:
-                trace_fun = log.debug
-            trace_fun("%s\ttx:%s %s\tin %s from %s, line %s %s" %
-                      (msg, t.description, ch, fun, fun.__module__, inspect.getsourcelines(fun)[1], ch))
-
-        retries = cfg.getint('db', 'conflict_retries')
-
-        retrying = False
-        for i in xrange(0, retries + 1):
-            try:
-                t = transaction.begin()
-                t.note("%s" % (random.randint(0, 1000000)))
-                trace("BEGIN", t)
-                result = fun(*args, **kwargs)
-            except RollbackException:
-                transaction.abort()
-                return
-            except:
-                trace("ROLLBACK ON ERROR", t)
-                transaction.abort()
-                raise
-            else:
+def _conflict_delay(policy, profile, error, attempt, first_started):
+    """Records the conflict and returns how long to wait before retrying, or None to give up."""
+    hotspots.record(error, profile.name)
+    return policy.next_delay(attempt, time.time() - first_started)
+
+
+def _run_in_tx(fun, profile, policy, timings, attempt, first_started, args, kwargs):
+    """Runs an attempt of a transaction. Returns its result, or a `_RetryAfter` if the commit
+    conflicted and the transaction has to be retried."""
+    context = context_from_method(fun, args, kwargs)
+    _context.x = context
+
+    started = time.time()
+    try:
+        t = transaction.begin()
+        t.note("%s" % (random.randint(0, 1000000)))
+        _trace(profile, "BEGIN", t)
+        result = fun(*args, **kwargs)
+    except RollbackException:
+        transaction.abort()
+        return
+    except:
+        _trace(profile, "ROLLBACK ON ERROR", t)
+        transaction.abort()
+        raise
+    finally:
+        timings['execution'] += time.time() - started
+
+    started = time.time()
+    try:
+        if isinstance(result, RollbackValue):
+            _trace(profile, "ROLLBACK", t)
+            result = result.value
+            transaction.abort()
+        else:
+            _trace(profile, "COMMIT", t)
+            transaction.commit()
+            if attempt:
+                _trace(profile, "Succeeded commit, after %s attempts" % attempt, t)
+
+        _context.x = None
+        return make_persistent_proxy(result, context)
+    except ConflictError as e:
+        timings['conflicts'] += 1
+        kind = 'READ' if isinstance(e, ReadConflictError) else 'WRITE'
+        transaction.abort()
+        delay = _conflict_delay(policy, profile, e, attempt, first_started)
+        if delay is None:
+            _trace(profile, "GOT %s CONFLICT IN RW TRANSACT, giving up after %s attempts: %s" %
+                   (kind, attempt + 1, e), t, force=True)
+            raise
+        _trace(profile, "GOT %s CONFLICT IN RW TRANSACT, retrying %s: %s" % (kind, attempt, e), t,
+               force=True)
+        return _RetryAfter(delay)
+    except StorageTransactionError as e:
+        if e.args and e.args[0] == "Duplicate tpc_begin calls for same transaction":
+            # This may happen when an object attached to one connection is used in anther
+            # connection's transaction. Check and compare _p_jar attributes of all objects
+            # involved in this transaction! They all must be the same.
+            _trace(profile, "DUPLICATE tpc_begin IN RW TRANSACT", t, force=True)
+        raise
+    except:
+        _trace(profile, 'ABORT: bad commit attempt', t)
+        transaction.abort()
+        raise
+    finally:
+        timings['commit'] += time.time() - started
+
+
+def async_transact(fun=None, lane=LANE_RW, retry_policy=None):
+    """Like `transact`, but the decorated function can be a generator which yields deferreds,
+    in the same style as `defer.inlineCallbacks`:
+
+        >>> @db.async_transact
+        ... def execute(self, args):
+        ...     obj = self.traverse(args.path)
+        ...     yield PreValidateHookMixin(obj).validate_hook(self.protocol.principal)
+        ...     obj.state = u'active'
+        ...     defer.returnValue(obj)
+
+    The code between two yields runs in a threadpool thread. While a yielded deferred is pending
+    the transaction is suspended and no thread is held; it is resumed (possibly in another
+    thread of the same lane) when the deferred fires. Non generator functions returning a
+    deferred are also accepted: the transaction is committed when the deferred fires.
+
+    The transaction uses its own connection and transaction manager, so the function must not
+    use the `transaction` module directly. Do not decorate the function with
+    `defer.inlineCallbacks`, as that would resume it in the reactor thread.
+
+    In case of conflict the whole function is retried, including the asynchronous parts,
+    according to `retry_policy`, as with `transact`.
+    """
+    if fun is None:
+        def wrapper(fun):
+            return _async_transact(fun, lane, retry_policy)
+        return wrapper
+    return _async_transact(fun, lane, retry_policy)
+
+
+def _async_transact(fun, lane=LANE_RW, retry_policy=None):
+    pool = get_lane(lane)
+    profile = get_profile(fun, 'async')
+
+    @functools.wraps(fun)
+    @defer.inlineCallbacks
+    def wrapper(*args, **kwargs):
+        if not _db:
+            raise Exception('DB not initalized')
+
+        policy = retry_policy or get_default_retry_policy()
+        timings = {'queue_wait': 0.0, 'execution': 0.0, 'commit': 0.0, 'retries': 0, 'conflicts': 0}
+        first_started = time.time()
+        error = True
+        try:
+            for i in itertools.count():
+                timings['retries'] = i
+                tx = SuspendedTransaction(pool, context_from_method(fun, args, kwargs), timings)
                 try:
-                    if isinstance(result, RollbackValue):
-                        trace("ROLLBACK", t)
-                        result = result.value
-                        transaction.abort()
-                    else:
-                        trace("COMMIT", t)
-                        transaction.commit()
-                        if retrying:
-                            trace("Succeeded commit, after %s attempts" % i, t)
-
-                    _context.x = None
-                    return make_persistent_proxy(result, context)
-                except ReadConflictError as e:
-                    trace("GOT READ CONFLICT IN RW TRANSACT, retrying %s" % i, t, force=True)
-                    retrying = True
-                    time.sleep(random.random() * 0.2)
+                    result = yield tx.run(fun, *args, **kwargs)
                 except ConflictError as e:
-                    trace("GOT WRITE CONFLICT IN RW TRANSACT, retrying %s" % i, t, force=True)
-                    retrying = True
-                    time.sleep(random.random() * 0.2)
-                except StorageTransactionError as e:
-                    if e.args and e.args[0] == "Duplicate tpc_begin calls for same transaction":
-                        # This may happen when an object attached to one connection is used in anther
-                        # connection's transaction. Check and compare _p_jar attributes of all objects
-                        # involved in this transaction! They all must be the same.
-                        trace("DUPLICATE tpc_begin IN RW TRANSACT", t, force=True)
-                    raise
-                except:
-                    trace('ABORT: bad commit attempt', t)
-                    transaction.abort()
-                    raise
-        raise e
+                    timings['conflicts'] += 1
+                    delay = _conflict_delay(policy, profile, e, i, first_started)
+                    if delay is None:
+                        log.warning("GOT CONFLICT IN ASYNC TRANSACT, giving up after %s attempts: %s: %s",
+                                    i + 1, profile.description, e)
+                        raise
+                    log.warning("GOT CONFLICT IN ASYNC TRANSACT, retrying %s: %s: %s", i, profile.description, e)
+                    yield task.deferLater(reactor, delay, lambda: None)
+                else:
+                    error = False
+                    defer.returnValue(result)
+        finally:
+            profile.record(timings['queue_wait'], timings['execution'], timings['commit'],
+                           retries=timings['retries'], conflicts=timings['conflicts'], error=error)
+    return wrapper
+
+
+def async_ro_transact(fun=None, lane=LANE_RO):
+    """Like `async_transact`, but the transaction is always rolled back, as with `ro_transact`.
+
+    Read only transactions never commit, hence they never conflict on write and are not retried.
+    """
+    if fun is None:
+        def wrapper(fun):
+            return _async_ro_transact(fun, lane)
+        return wrapper
+    return _async_ro_transact(fun, lane)
+
+
+def _async_ro_transact(fun, lane=LANE_RO):
+    pool = get_lane(lane)
+    profile = get_profile(fun, 'ro')
 
     @functools.wraps(fun)
+    @defer.inlineCallbacks
     def wrapper(*args, **kwargs):
+        if not _db:
+            raise Exception('DB not initalized')
+
+        timings = {'queue_wait': 0.0, 'execution': 0.0, 'commit': 0.0}
+        error = True
+        try:
+            tx = SuspendedTransaction(pool, context_from_method(fun, args, kwargs), timings,
+                                      read_only=True)
+            result = yield tx.run(fun, *args, **kwargs)
+            error = False
+            defer.returnValue(result)
+        finally:
+            profile.record(timings['queue_wait'], timings['execution'], None, error=error)
+    return wrapper
+
+
+class SuspendedTransaction(object):
+    """A ZODB transaction which can span several threadpool jobs.
+
+    It owns a connection and a transaction manager, which are not bound to the thread
+    executing the current phase. Read only transactions are aborted instead of committed.
+
+    """
+
+    def __init__(self, pool, context, timings, read_only=False):
+        self.pool = pool
+        self.context = context
+        self.read_only = read_only
+        self.transaction_manager = transaction.TransactionManager()
+        self.connection = None
+        # time spent waiting for a thread, running and committing, summed over all the phases
+        self.timings = timings
+
+    def in_thread(self, fun, *args):
         if not _testing:
-            return deferToThreadPool(reactor, _threadpool,
-                                     run_in_tx, fun, *args, **kwargs)
+            return self.pool.defer(self.run_phase, fun, *args)
         else:
-            # No threading during testing
-            return defer.execute(run_in_tx, fun, *args, **kwargs)
-    return wrapper
+            return defer.execute(self.run_phase, fun, *args)
+
+    def run_phase(self, fun, *args, **kwargs):
+        self.timings['queue_wait'] += _pop_queue_wait()
+        started = time.time()
+
+        if self.connection is None:
+            self.connection = get_db().open(transaction_manager=self.transaction_manager)
+            self.transaction_manager.begin()
+
+        _phase.x = self
+        _context.x = self.context
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            _phase.x = None
+            _context.x = None
+            self.timings['execution'] += time.time() - started
+
+    @defer.inlineCallbacks
+    def run(self, fun, *args, **kwargs):
+        try:
+            if inspect.isgeneratorfunction(fun):
+                result = yield self.drive(fun(*args, **kwargs))
+            else:
+                result = yield self.in_thread(lambda: fun(*args, **kwargs))
+                if isinstance(result, defer.Deferred):
+                    result = yield result
+        except RollbackException:
+            yield self.in_thread(self.abort)
+            defer.returnValue(None)
+        except Exception:
+            failure = Failure()
+            yield self.in_thread(self.abort)
+            failure.raiseException()
+
+        result = yield self.in_thread(self.finish, result)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def drive(self, gen):
+        value, failure = None, None
+        while True:
+            done, yielded = yield self.in_thread(self.resume, gen, value, failure)
+            if done:
+                defer.returnValue(yielded)
+
+            value, failure = yielded, None
+            if isinstance(yielded, defer.Deferred):
+                try:
+                    value = yield yielded
+                except Exception:
+                    value, failure = None, Failure()
+
+    def resume(self, gen, value, failure):
+        try:
+            if failure is not None:
+                return False, failure.throwExceptionIntoGenerator(gen)
+            return False, gen.send(value)
+        except StopIteration:
+            return True, None
+        except defer._DefGen_Return as e:
+            return True, e.value
+
+    def finish(self, result):
+        started = time.time()
+        try:
+            if isinstance(result, RollbackValue):
+                result = result.value
+                self.transaction_manager.abort()
+            elif self.read_only:
+                self.transaction_manager.abort()
+            else:
+                self.transaction_manager.commit()
+        except:
+            self.transaction_manager.abort()
+            raise
+        finally:
+            self.close()
+            # finish() runs as a phase, don't account the commit as execution time
+            elapsed = time.time() - started
+            self.timings['commit'] += elapsed
+            self.timings['execution'] -= elapsed
+        return make_persistent_proxy(result, self.context)
+
+    def abort(self):
+        try:
+            self.transaction_manager.abort()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
 
-def ro_transact(fun=None, proxy=True):
+def ro_transact(fun=None, proxy=True, lane=LANE_RO):
     if fun is None:
         def wrapper(fun):
-            return _ro_transact(fun, proxy)
+            return _ro_transact(fun, proxy, lane)
         return wrapper
-    return _ro_transact(fun, proxy)
+    return _ro_transact(fun, proxy, lane)
 
 
-def _ro_transact(fun, proxy=True):
+def _ro_transact(fun, proxy=True, lane=LANE_RO):
     """Runs a callable inside a separate thread within a readonly ZODB transaction.
 
     Transaction is always rolledback.
@@ -274,8 +679,8 @@ def _ro_transact(fun, proxy=True):
 
     """
 
-    if not _threadpool:
-        init_threadpool()
+    pool = get_lane(lane)
+    profile = get_profile(fun, 'ro')
 
     @functools.wraps(fun)
     def run_in_tx(fun, *args, **kwargs):
@@ -285,29 +690,34 @@ def _ro_transact(fun, proxy=True):
         if not _db:
             raise Exception('DB not initalized')
 
+        queue_wait = _pop_queue_wait()
+        started = time.time()
+        error = True
         try:
             transaction.begin()
             _context.x = None
 
             res = fun(*args, **kwargs)
+            error = False
             if proxy:
                 return make_persistent_proxy(res, context)
             return res
         finally:
             transaction.abort()
+            profile.record(queue_wait, time.time() - started, None, error=error)
 
     @functools.wraps(fun)
     def wrapper(*args, **kwargs):
         if not _testing:
-            return deferToThreadPool(reactor, _threadpool,
-                                     run_in_tx, fun, *args, **kwargs)
+            return pool.defer(run_in_tx, fun, *args, **kwargs)
         else:
             return defer.execute(run_in_tx, fun, *args, **kwargs)
     return wrapper
 
 
 def data_integrity_validator(fun):
-    """Runs a callable inside all available threads in the threadpool within a readonly ZODB transaction.
+    """Runs a callable inside all available threads in all the threadpool lanes within a readonly ZODB
+    transaction.
 
     Calls function that is expected to assert some expectations about DB data and throw an exception if
     anything is wrong.
@@ -323,7 +733,7 @@ def data_integrity_validator(fun):
     Transaction is always rolled back.
     """
 
-    if not _threadpool:
+    if not _threadpools:
         init_threadpool()
 
     _done_threads = set()
@@ -364,15 +774,17 @@ def data_integrity_validator(fun):
         if not _testing:
             deferred_list = []
 
-            if len(_threadpool.working) > 0:
-                log.info('integrity: There are working threads while testing %s: %s',
-                         fun, _threadpool.working)
+            for lane in _threadpools.values():
+                threadpool = lane.threadpool
+                if len(threadpool.working) > 0:
+                    log.info('integrity: There are working threads in %s while testing %s: %s',
+                             lane.name, fun, threadpool.working)
 
-            for thread in _threadpool.waiters:
-                if thread in _done_threads:
-                    continue
-                d = deferToThreadPool(reactor, _threadpool, run_in_tx, fun, *args, **kwargs)
-                deferred_list.append(d)
+                for thread in threadpool.waiters:
+                    if thread in _done_threads:
+                        continue
+                    d = deferToThreadPool(reactor, threadpool, run_in_tx, fun, *args, **kwargs)
+                    deferred_list.append(d)
 
             dl = defer.DeferredList(deferred_list)
             _all_done.set()
@@ -399,6 +811,32 @@ def load_object(oid, tid):
         return deref(oid)
 
 
+def last_transaction():
+    """Returns the id of the last transaction committed to the storage."""
+    return get_db().lastTransaction()
+
+
+def changed_oids(after_tid, until_tid):
+    """Returns the set of the oids of all the objects modified by the transactions committed
+    after `after_tid` up to `until_tid` (included), using the storage transaction iterator.
+
+    Raises `NotImplementedError` if the storage cannot iterate its transactions.
+
+    """
+    if after_tid >= until_tid:
+        return set()
+
+    storage = get_db().storage
+    if not hasattr(storage, 'iterator'):
+        raise NotImplementedError('Storage %s does not support iteration' % storage)
+
+    oids = set()
+    for txn in storage.iterator(p64(u64(after_tid) + 1), until_tid):
+        for record in txn:
+            oids.add(record.oid)
+    return oids
+
+
 def get(obj, name):
     return ro_transact(lambda: getattr(obj, name))()
 
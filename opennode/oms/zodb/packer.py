@@ -34,7 +34,7 @@ class PackDaemonProcess(DaemonProcess):
 
             yield async_sleep(self.interval)
 
-    @db.ro_transact
+    @db.ro_transact(lane=db.LANE_BACKGROUND)
     def pack(self):
         storage_type = get_config().get('db', 'storage_type')
 
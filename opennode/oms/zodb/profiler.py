@@ -0,0 +1,157 @@
+import threading
+
+from collections import deque
+
+
+__all__ = ['RollingHistogram', 'TransactionProfile', 'get_profile', 'get_profiles', 'reset_profiles']
+
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def _percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p / 100.0))]
+
+
+class RollingHistogram(object):
+    """Keeps the last `size` samples of a measure; recording is constant time,
+    percentiles are computed only when the histogram is read.
+
+    >>> h = RollingHistogram(size=3)
+    >>> for i in [5, 1, 2, 3]: h.record(i)
+    >>> h.count, h.percentile(50), h.max()
+    (4, 2, 3)
+
+    """
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        return _percentile(sorted(self.samples), p)
+
+    def max(self):
+        return max(self.samples) if self.samples else 0.0
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        samples = sorted(self.samples)
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.mean(),
+                'p50': _percentile(samples, 50),
+                'p90': _percentile(samples, 90),
+                'p99': _percentile(samples, 99),
+                'max': samples[-1] if samples else 0.0}
+
+
+class TransactionProfile(object):
+    """Timings and counters of a single function decorated with one of the db.*transact decorators.
+
+    Static metadata about the function is computed once; the function itself is not referenced,
+    so that profiling functions decorated on the fly doesn't keep their closures alive.
+
+    """
+
+    def __init__(self, fun, kind):
+        self.kind = kind
+        self.module = getattr(fun, '__module__', None)
+        self.name = '%s.%s' % (self.module, getattr(fun, '__name__', type(fun).__name__))
+        code = _code(fun)
+        self.lineno = code.co_firstlineno if code is not None else 0
+
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def description(self):
+        return '%s from %s, line %s' % (self.name, self.module, self.lineno)
+
+    def reset(self):
+        with self.lock:
+            self.queue_wait = RollingHistogram()
+            self.execution = RollingHistogram()
+            self.commit = RollingHistogram()
+            self.calls = 0
+            self.retries = 0
+            self.conflicts = 0
+            self.errors = 0
+
+    def record(self, queue_wait, execution, commit, retries=0, conflicts=0, error=False):
+        with self.lock:
+            self.calls += 1
+            self.retries += retries
+            self.conflicts += conflicts
+            if error:
+                self.errors += 1
+            self.queue_wait.record(queue_wait)
+            self.execution.record(execution)
+            if commit is not None:
+                self.commit.record(commit)
+
+    def total_time(self):
+        return self.queue_wait.total + self.execution.total + self.commit.total
+
+    def summary(self):
+        with self.lock:
+            return {'name': self.name,
+                    'kind': self.kind,
+                    'calls': self.calls,
+                    'retries': self.retries,
+                    'conflicts': self.conflicts,
+                    'errors': self.errors,
+                    'queue_wait': self.queue_wait.summary(),
+                    'execution': self.execution.summary(),
+                    'commit': self.commit.summary()}
+
+
+def _code(fun):
+    fun = getattr(fun, 'im_func', fun)
+    return getattr(fun, '__code__', None)
+
+
+def get_profile(fun, kind):
+    """Profiles are shared by all the functions with the same code, e.g. the closures created
+    by each call of a function which decorates them on the fly."""
+    code = _code(fun)
+    if code is None:
+        code = (getattr(fun, '__module__', None), getattr(fun, '__name__', type(fun).__name__))
+
+    with _profiles_lock:
+        key = (code, kind)
+        if key not in _profiles:
+            _profiles[key] = TransactionProfile(fun, kind)
+        return _profiles[key]
+
+
+def get_profiles(sort='total', limit=None):
+    """Returns the profiles of the transactional functions which have been called at least once,
+    the most expensive first.
+
+    """
+    keys = {'total': lambda p: p.total_time(),
+            'calls': lambda p: p.calls,
+            'wait': lambda p: p.queue_wait.total,
+            'exec': lambda p: p.execution.total,
+            'commit': lambda p: p.commit.total,
+            'conflicts': lambda p: p.conflicts}
+
+    profiles = sorted((p for p in _profiles.values() if p.calls), key=keys[sort], reverse=True)
+    return profiles[:limit] if limit else profiles
+
+
+def reset_profiles():
+    for profile in _profiles.values():
+        profile.reset()
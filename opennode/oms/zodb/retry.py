@@ -0,0 +1,143 @@
+import random
+import threading
+import time
+
+from ZODB.POSException import ReadConflictError
+from ZODB.utils import oid_repr
+
+from opennode.oms.config import get_config
+
+
+__all__ = ['RetryPolicy', 'get_default_retry_policy', 'set_default_retry_policy',
+           'ConflictHotSpots', 'hotspots']
+
+
+class RetryPolicy(object):
+    """Decides whether and after how long a transaction which failed because of a conflict
+    is retried.
+
+    Delays grow exponentially with the number of attempts (`base_delay * 2 ** attempt`, capped
+    to `max_delay`) and are fully jittered, so that transactions which conflicted with each
+    other don't collide again on the next attempt. A transaction is given up after `retries`
+    retries or when the next attempt would start after `deadline` seconds since the first one.
+
+    Parameters left to None are read from the [db] section of the configuration file, so that
+    a function can override only part of its budget:
+
+        >>> @db.transact(retry_policy=RetryPolicy(retries=3, deadline=1.0))
+        ... def update_counter():
+        ...     # ...
+
+    """
+
+    def __init__(self, retries=None, base_delay=None, max_delay=None, deadline=None):
+        self._retries = retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._deadline = deadline
+
+    @property
+    def retries(self):
+        if self._retries is not None:
+            return self._retries
+        return get_config().getint('db', 'conflict_retries', 10)
+
+    @property
+    def base_delay(self):
+        if self._base_delay is not None:
+            return self._base_delay
+        return get_config().getfloat('db', 'conflict_backoff_base', 0.01)
+
+    @property
+    def max_delay(self):
+        if self._max_delay is not None:
+            return self._max_delay
+        return get_config().getfloat('db', 'conflict_backoff_max', 1.0)
+
+    @property
+    def deadline(self):
+        if self._deadline is not None:
+            return self._deadline
+        # 0 means no deadline
+        return get_config().getfloat('db', 'conflict_deadline', 0)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def next_delay(self, attempt, elapsed):
+        """Returns how many seconds to wait before retrying, after `attempt` (zero based) failed
+        `elapsed` seconds after the first attempt started, or None if the transaction should be
+        given up.
+
+        """
+        if attempt >= self.retries:
+            return None
+
+        delay = self.backoff(attempt)
+        deadline = self.deadline
+        if deadline and elapsed + delay > deadline:
+            return None
+        return delay
+
+
+_default_retry_policy = RetryPolicy()
+
+
+def get_default_retry_policy():
+    return _default_retry_policy
+
+
+def set_default_retry_policy(policy):
+    global _default_retry_policy
+    _default_retry_policy = policy
+
+
+class ConflictHotSpots(object):
+    """Counts conflicts by the OID and class of the object which caused them, in order to find
+    which objects are contended by concurrent transactions.
+
+    The table is bounded: when it exceeds `max_entries`, the least frequent half is dropped.
+
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+
+    def record(self, error, function=None):
+        oid = oid_repr(error.oid) if error.oid else None
+        key = (error.class_name, oid)
+        kind = 'read' if isinstance(error, ReadConflictError) else 'write'
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= self.max_entries:
+                    self._prune()
+                entry = self.entries[key] = {'class': error.class_name, 'oid': oid,
+                                             'count': 0, 'read': 0, 'write': 0, 'functions': {}}
+            entry['count'] += 1
+            entry[kind] += 1
+            entry['last'] = time.time()
+            if function:
+                entry['functions'][function] = entry['functions'].get(function, 0) + 1
+
+    def _prune(self):
+        by_count = sorted(self.entries.items(), key=lambda (key, entry): entry['count'])
+        for key, entry in by_count[:len(by_count) / 2 or 1]:
+            del self.entries[key]
+
+    def top(self, limit=None):
+        with self.lock:
+            entries = sorted((dict(entry, functions=dict(entry['functions']))
+                              for entry in self.entries.values()),
+                             key=lambda entry: entry['count'], reverse=True)
+        return entries[:limit] if limit else entries
+
+
+hotspots = ConflictHotSpots()